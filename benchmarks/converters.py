@@ -0,0 +1,137 @@
+"""Times standoff_to_inline and standoff_to_lbj against the original
+character-by-character implementations on a large synthetic document,
+checking the output is byte-identical.
+
+    cd benchmarks
+    python converters.py [TEXT_LENGTH [NUM_TAGS]]
+"""
+import sys, os, shutil, tempfile, time
+sys.path.insert(0, "../")
+
+from i2b2tools.lib.standoff_annotations import StandoffAnnotation
+from i2b2tools.converters.inline import standoff_to_inline
+from i2b2tools.converters.lbj import standoff_to_lbj, TYPE_lbj_name_mapping
+
+from synthetic import synthetic_standoff
+
+from lxml import etree
+
+TEXT_LENGTH = 100000
+NUM_TAGS = 2000
+
+def reference_standoff_to_inline(sa):
+    """The original implementation of standoff_to_inline."""
+    def start_of_phi(sa, position):
+        for phi in sa.get_phi():
+            if phi.get_start() == position:
+                return phi
+
+    def end_of_phi(sa, position):
+        for phi in sa.get_phi():
+            if phi.get_end() == position:
+                return phi
+
+    def create_tag(tree, tag, text):
+        etree.SubElement(tree, tag).text = text
+
+    def append_string(tree, s):
+        tags = tree.getchildren()
+
+        if tags:
+            tags[-1].tail = s
+        else:
+            tree.text = s
+
+    tree = etree.Element("ROOT")
+    buf = ""
+
+    for (i, character) in enumerate(sa.text):
+        start = start_of_phi(sa, i)
+        end = end_of_phi(sa, i)
+
+        if start and end:
+            create_tag(tree, end.TYPE, buf)
+        elif start:
+            append_string(tree, buf)
+        elif end:
+            create_tag(tree, end.TYPE, buf)
+
+        if start or end:
+            buf = character
+        else:
+            buf += character
+
+    append_string(tree, buf)
+
+    return tree
+
+def reference_standoff_to_lbj(sa, TYPE_name_mapping=TYPE_lbj_name_mapping):
+    """The original implementation of standoff_to_lbj."""
+    def start_of_phi(sa, position):
+        for phi in sa.get_phi():
+            if phi.get_start() == position:
+                return phi
+
+    def end_of_phi(sa, position):
+        for phi in sa.get_phi():
+            if phi.get_end() == position:
+                return phi
+
+    text = ""
+
+    for (i, character) in enumerate(sa.text):
+        start = start_of_phi(sa, i)
+        end = end_of_phi(sa, i)
+
+        if start:
+            lbj_type = TYPE_name_mapping.get(start.TYPE, "MISC")
+
+        if start and end:
+            text += "  ][%s %s" % (lbj_type, character)
+        elif start:
+            text += "[%s %s" % (lbj_type, character)
+        elif end:
+            text += "  ]%s" % character
+        else:
+            text += character
+
+    return text
+
+def timed(func, *args):
+    began = time.time()
+    result = func(*args)
+
+    return (time.time() - began, result)
+
+if __name__ == "__main__":
+    text_length = int(sys.argv[1]) if len(sys.argv) > 1 else TEXT_LENGTH
+    num_tags = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_TAGS
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        filename = os.path.join(tmpdir, "synthetic.xml")
+
+        with open(filename, "w") as outfile:
+            outfile.write(synthetic_standoff(text_length, num_tags))
+
+        sa = StandoffAnnotation(filename)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "%d characters, %d PHI" % (len(sa.text), len(sa.get_phi()))
+
+    for (name, func, reference, serialize) in [
+            ("standoff_to_inline", standoff_to_inline,
+             reference_standoff_to_inline, etree.tostring),
+            ("standoff_to_lbj", standoff_to_lbj,
+             reference_standoff_to_lbj, lambda text: text)]:
+        reference_time, expected = timed(reference, sa)
+        sweep_time, result = timed(func, sa)
+
+        assert serialize(result) == serialize(expected), \
+            "%s output differs from the reference" % name
+
+        print "%-20s %8.3fs -> %8.3fs (%.0fx)" % (name, reference_time,
+                                                  sweep_time,
+                                                  reference_time / sweep_time)
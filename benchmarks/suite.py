@@ -0,0 +1,262 @@
+"""Times the tokenizer, helpers, converters, rules and PostProcessor on a
+reproducible synthetic corpus, writing throughput and peak memory as a
+JSON baseline which a later run can be compared against:
+
+    cd benchmarks
+    python suite.py --output baseline.json
+    ... change something ...
+    python suite.py --compare baseline.json
+
+Each benchmark runs in its own process, so its peak memory is its own.
+Benchmarks which don't support overlapping PHI only run on the
+documents without any.
+"""
+import sys, argparse, json, multiprocessing, platform, resource, shutil, tempfile, time
+sys.path.insert(0, "../")
+
+from i2b2tools.lib.standoff_annotations.tags import NameTag
+from i2b2tools.lib.document_token import Document, TokenSequence
+from i2b2tools.lib.rules.rules import RegexRule, RemoveRegexRule, MergeRule, GazetteerRule
+from i2b2tools.lib.rules.gazetteer import Gazetteer
+from i2b2tools.lib.rules.postprocessors import PostProcessor
+from i2b2tools.lib.evaluation import SpanEvaluator
+from i2b2tools.lib.standoff_annotations import EvaluatePHI
+from i2b2tools.helpers.utils import has_overlapping_phi, phi_within_range
+from i2b2tools.helpers.tokens import get_sa_tagged_tokens
+from i2b2tools.converters.inline import standoff_to_inline, inline_to_standoff
+from i2b2tools.converters.lbj import standoff_to_lbj
+
+from synthetic import write_synthetic_corpus
+
+from lxml import etree
+import numpy as np
+
+def name_trigram(target, rule):
+    """Merges NAME, something, NAME into one NAME."""
+    first, middle, last = [phi_within_range(rule.sa, token.start, token.end)
+                           for token in target]
+
+    return bool(first and last and not middle and
+                first[0].name == last[0].name == rule.name)
+
+# a few real terms among thousands which never match
+GAZETTEER = Gazetteer(["John Smith", "New York"] +
+                      ["Saint Hospital %d" % i for i in range(5000)], "HOSPITAL")
+
+RULES = [(RegexRule, ["(John Smith)", "NAME", "PATIENT", NameTag]),
+         (RemoveRegexRule, ["^Friday$"]),
+         (MergeRule, [3, "NAME", "PATIENT", NameTag, name_trigram])]
+
+def load(filenames, document_class=Document):
+    return [document_class(filename) for filename in filenames]
+
+def without_overlaps(sas):
+    return [sa for sa in sas if not has_overlapping_phi(sa)]
+
+# Each benchmark is setup(filenames) -> (inputs, sas), and
+# run(inputs). The sas are what the throughput is counted over.
+
+def setup_documents(filenames):
+    sas = load(filenames)
+    return (sas, sas)
+
+def setup_documents_without_overlaps(filenames):
+    sas = without_overlaps(load(filenames))
+    return (sas, sas)
+
+def setup_inline(filenames):
+    sas = without_overlaps(load(filenames))
+    return ([etree.tostring(standoff_to_inline(sa)) for sa in sas], sas)
+
+def setup_postprocessor(filenames):
+    sas = load(filenames)
+    gold_sas = load(filenames)
+
+    return ((dict((sa.id, sa) for sa in sas),
+             dict((sa.id, sa) for sa in gold_sas)), sas)
+
+def run_tokenizer(sas):
+    for sa in sas:
+        TokenSequence.tokenizer(sa.text)
+
+def run_bulk_tokenize(sas):
+    TokenSequence.bulk_tokenize(sa.text for sa in sas)
+
+def run_tagged_tokens(sas):
+    for sa in sas:
+        get_sa_tagged_tokens(sa)
+
+def run_standoff_to_inline(sas):
+    for sa in sas:
+        etree.tostring(standoff_to_inline(sa))
+
+def run_standoff_to_lbj(sas):
+    for sa in sas:
+        standoff_to_lbj(sa)
+
+def run_inline_to_standoff(inlines):
+    for inline in inlines:
+        inline_to_standoff(inline)
+
+def run_rule(rule, args):
+    def run(sas):
+        for sa in sas:
+            rule(*([sa] + args)).apply()
+
+    return run
+
+def run_evaluator(evaluator):
+    def run((system_sas, gold_sas)):
+        evaluator(system_sas, gold_sas)
+
+    return run
+
+def run_postprocessor((system_sas, gold_sas)):
+    PostProcessor(system_sas, gold_sas, RULES).process()
+
+BENCHMARKS = [
+    ("tokenizer", setup_documents, run_tokenizer),
+    ("bulk_tokenize", setup_documents, run_bulk_tokenize),
+    ("get_sa_tagged_tokens", setup_documents_without_overlaps, run_tagged_tokens),
+    ("standoff_to_inline", setup_documents_without_overlaps, run_standoff_to_inline),
+    ("standoff_to_lbj", setup_documents_without_overlaps, run_standoff_to_lbj),
+    ("inline_to_standoff", setup_inline, run_inline_to_standoff),
+    ("RegexRule", setup_documents, run_rule(*RULES[0])),
+    ("MergeRule", setup_documents, run_rule(*RULES[2])),
+    ("GazetteerRule", setup_documents, run_rule(GazetteerRule, [GAZETTEER])),
+    ("EvaluatePHI", setup_postprocessor, run_evaluator(EvaluatePHI)),
+    ("SpanEvaluator", setup_postprocessor, run_evaluator(SpanEvaluator)),
+    ("PostProcessor", setup_postprocessor, run_postprocessor),
+]
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # bytes on OS X, kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def measure(setup, run, filenames, results):
+    inputs, sas = setup(filenames)
+    before = peak_rss_kb()
+
+    began = time.time()
+    run(inputs)
+    seconds = time.time() - began
+
+    docs = len(sas)
+    chars = sum(len(sa.text) for sa in sas)
+
+    results.put({"seconds": seconds,
+                 "docs": docs,
+                 "chars": chars,
+                 "docs_per_sec": docs / seconds if seconds else None,
+                 "chars_per_sec": chars / seconds if seconds else None,
+                 "peak_rss_kb": peak_rss_kb(),
+                 "peak_rss_growth_kb": peak_rss_kb() - before})
+
+def benchmark(setup, run, filenames, repeat):
+    """Runs a benchmark repeat times, each in a new process, returning
+    the fastest run."""
+    runs = []
+
+    for _ in range(repeat):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure,
+                                          args=(setup, run, filenames, results))
+        process.start()
+        runs.append(results.get())
+        process.join()
+
+    return min(runs, key=lambda result: result["seconds"])
+
+def compare(report, baseline, threshold):
+    """Prints each benchmark's throughput against the baseline's, and
+    returns the names of those which are more than threshold slower."""
+    regressions = []
+
+    for (name, result) in sorted(report["benchmarks"].items()):
+        if name not in baseline["benchmarks"]:
+            continue
+
+        before = baseline["benchmarks"][name]["chars_per_sec"]
+        after = result["chars_per_sec"]
+
+        if not before or not after:
+            continue
+
+        ratio = after / before
+        flag = ""
+
+        if ratio < 1 - threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+
+        print "%-22s %14.0f -> %14.0f chars/sec (%.2fx)%s" % (name, before, after,
+                                                              ratio, flag)
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--length", type=int, default=5000,
+                        help="characters per document")
+    parser.add_argument("--density", type=float, default=5,
+                        help="PHI per 1000 characters")
+    parser.add_argument("--overlap", type=float, default=0.0,
+                        help="probability of a PHI being overlapped by another")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each benchmark, keeping the fastest")
+    parser.add_argument("--only", action="append",
+                        help="only run this benchmark, may be given more than once")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--compare", help="a JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="how much slower than --compare counts as a regression")
+    args = parser.parse_args()
+
+    report = {"config": {"docs": args.docs, "length": args.length,
+                         "density": args.density, "overlap": args.overlap,
+                         "seed": args.seed, "repeat": args.repeat},
+              "environment": {"python": platform.python_version(),
+                              "lxml": etree.__version__,
+                              "numpy": np.__version__,
+                              "platform": platform.platform()},
+              "benchmarks": {}}
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        filenames = write_synthetic_corpus(directory, args.docs, args.length,
+                                           args.density, args.overlap, args.seed)
+
+        for (name, setup, run) in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+
+            result = benchmark(setup, run, filenames, args.repeat)
+            report["benchmarks"][name] = result
+
+            print "%-22s %8.3fs %10.1f docs/sec %12.0f chars/sec %8d KB peak" % (
+                name, result["seconds"], result["docs_per_sec"] or 0,
+                result["chars_per_sec"] or 0, result["peak_rss_kb"])
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+
+        if baseline["config"] != report["config"]:
+            print "warning: the baseline was run with %r" % baseline["config"]
+
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
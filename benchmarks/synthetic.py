@@ -0,0 +1,84 @@
+"""Synthetic deIdi2b2 documents for the benchmarks, with PHI of every
+TYPE in TYPE_name_mapping.
+"""
+import sys, os, random
+sys.path.insert(0, "../")
+
+from i2b2tools.converters.common import TYPE_name_mapping, deidi2b2_etree
+
+from lxml import etree
+
+WORDS = ["patient", "presented", "with", "chest", "pains", "on",
+         "Friday", "John", "Smith", "New", "York", "2/20/2015"]
+
+def synthetic_standoff(text_length, num_tags, seed=0, overlap=0.0):
+    """Returns deIdi2b2 XML with num_tags PHI spread over text_length
+    characters of words.
+
+    The PHI don't overlap, except that with overlap, each PHI has that
+    probability of being followed by an extra PHI which starts within
+    it and ends after it. Each PHI is given at least one character, so
+    there can't be more PHI than characters.
+    """
+    if num_tags > text_length:
+        raise ValueError("%d PHI don't fit in %d characters" % (num_tags, text_length))
+
+    rng = random.Random(seed)
+
+    text = []
+    length = 0
+
+    while length < text_length:
+        word = rng.choice(WORDS) + rng.choice([" ", " ", ", ", ".\n"])
+        text.append(word)
+        length += len(word)
+
+    text = "".join(text)[:text_length]
+    standoff_etree = deidi2b2_etree(text)
+
+    stride = text_length // num_tags if num_tags else text_length
+    TYPEs = sorted(TYPE_name_mapping.keys())
+    spans = []
+
+    # the longest a PHI can be and still end within its stride
+    longest = max(1, stride // 2)
+
+    for i in range(num_tags):
+        start = i * stride + rng.randint(0, stride // 2)
+        end = start + rng.randint(1, longest)
+        spans.append((start, end, rng.choice(TYPEs)))
+
+        if overlap and rng.random() < overlap:
+            spans.append((rng.randint(start, end - 1),
+                          min(end + rng.randint(1, longest), text_length),
+                          rng.choice(TYPEs)))
+
+    for (i, (start, end, TYPE)) in enumerate(spans):
+        etree.SubElement(standoff_etree.find("TAGS"),
+                         TYPE_name_mapping[TYPE],
+                         id="P%d" % i,
+                         start=str(start),
+                         end=str(end),
+                         text=text[start:end],
+                         TYPE=TYPE,
+                         comment="")
+
+    return etree.tostring(standoff_etree)
+
+def write_synthetic_corpus(directory, num_docs, text_length, density,
+                           overlap=0.0, seed=0):
+    """Writes num_docs synthetic documents to directory, each with
+    density PHI per 1000 characters, returning their file names."""
+    num_tags = max(1, int(text_length * density / 1000.0))
+    filenames = []
+
+    for i in range(num_docs):
+        filename = os.path.join(directory, "synthetic%05d.xml" % i)
+
+        with open(filename, "w") as outfile:
+            outfile.write(synthetic_standoff(text_length, num_tags,
+                                             seed=seed + i, overlap=overlap))
+
+        filenames.append(filename)
+
+    return filenames
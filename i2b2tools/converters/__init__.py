@@ -1,2 +1,2 @@
-from inline import standoff_to_inline, inline_to_standoff
+from inline import standoff_to_inline, inline_to_standoff, stream_inline_to_standoff
 from common import *
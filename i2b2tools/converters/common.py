@@ -1,4 +1,7 @@
 from lxml import etree
+import codecs
+import marshal
+import tempfile
 
 TYPE_name_mapping = {
     "NAME": "NAME",
@@ -47,3 +50,126 @@ def deidi2b2_etree(text=None, cdata=True):
             standoff_etree.find("TEXT").text = text
 
     return standoff_etree
+
+def tag_element(i, name, TYPE, start, end, text):
+    """Returns the i-th PHI tag of a deIdi2b2 document, spanning
+    [start, end) of its text."""
+    return etree.Element(name,
+                         id="P%d" % i,
+                         start=str(start),
+                         end=str(end),
+                         text=text,
+                         TYPE=TYPE,
+                         comment="")
+
+def standoff_xml(text, tags, pretty_print=True):
+    """Returns a deIdi2b2 document of text and tags, each a (name, TYPE,
+    start, end, text), which the converters all build their output
+    with. pretty_print=False writes it on one line, which is smaller
+    and quicker to write."""
+    standoff_etree = deidi2b2_etree(text)
+    tags_el = standoff_etree.find("TAGS")
+
+    for (i, tag) in enumerate(tags):
+        tags_el.append(tag_element(i, *tag))
+
+    return etree.tostring(standoff_etree, pretty_print=pretty_print)
+
+def read_chunks(infile, chunk_size=2 ** 20, encoding="utf-8"):
+    """Yields the contents of a file-like object chunk_size at a time,
+    decoding str chunks with encoding so a character is never split
+    between chunks. infile may also be a file name."""
+    if isinstance(infile, basestring):
+        with open(infile, "rb") as f:
+            for chunk in read_chunks(f, chunk_size, encoding):
+                yield chunk
+        return
+
+    decoder = codecs.getincrementaldecoder(encoding)() if encoding else None
+
+    for chunk in iter(lambda: infile.read(chunk_size), ""):
+        if decoder is not None and isinstance(chunk, str):
+            chunk = decoder.decode(chunk)
+
+        if chunk:
+            yield chunk
+
+    if decoder is not None:
+        chunk = decoder.decode("", final=True)
+
+        if chunk:
+            yield chunk
+
+class StandoffWriter(object):
+    """Writes a deIdi2b2 document to output, a file name or file-like
+    object, as its text comes in, so neither its text nor its tags are
+    ever all in memory:
+
+    with StandoffWriter(outfile) as writer:
+        writer.write_text("Patient ")
+        writer.write_tag("NAME", "PATIENT", "John Smith")
+        writer.write_text(" presented on Friday.")
+
+    The tags have to come after the text, so they're kept in a
+    temporary file until the text is done. etree.xmlfile can't write
+    CDATA, so the text is written escaped instead, which parses to the
+    same text.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.offset = 0
+        self.tags = 0
+
+    def __enter__(self):
+        self._xmlfile = etree.xmlfile(self.output, encoding="UTF-8")
+        self._xf = self._xmlfile.__enter__()
+        self._root = self._xf.element("deIdi2b2")
+        self._root.__enter__()
+        self._text = self._xf.element("TEXT")
+        self._text.__enter__()
+        self._spool = tempfile.TemporaryFile()
+
+        return self
+
+    def write_text(self, text):
+        if text:
+            self._xf.write(text)
+            self.offset += len(text)
+
+    def add_tag(self, name, TYPE, start, end, text):
+        """Adds a tag over [start, end) of the text, which may already
+        have been written or not."""
+        marshal.dump((name, TYPE, start, end, text), self._spool)
+
+    def write_tag(self, name, TYPE, text):
+        """Writes text, tagging it with name and TYPE."""
+        self.add_tag(name, TYPE, self.offset, self.offset + len(text), text)
+        self.write_text(text)
+
+    def _write_tags(self):
+        self._spool.seek(0)
+        i = 0
+
+        with self._xf.element("TAGS"):
+            while True:
+                try:
+                    tag = marshal.load(self._spool)
+                except EOFError:
+                    break
+
+                self._xf.write(tag_element(i, *tag))
+                i += 1
+
+        self.tags = i
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._text.__exit__(exc_type, exc_value, traceback)
+
+            if exc_type is None:
+                self._write_tags()
+
+            self._root.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._spool.close()
+            self._xmlfile.__exit__(exc_type, exc_value, traceback)
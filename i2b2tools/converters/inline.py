@@ -10,79 +10,87 @@ potentially be abstracted.
 - LBJ output format is inconsistent, once it changes this could be enhanced.
 """
 
+def phi_boundaries(sa):
+    """Returns the PHI starting at and ending at each boundary offset
+    within the text, as two dictionaries, along with the sorted list of
+    those offsets. When several PHI share an offset the first in
+    sa.get_phi() is kept.
+    """
+    starts, ends = {}, {}
+
+    for phi in sa.get_phi():
+        starts.setdefault(phi.get_start(), phi)
+        ends.setdefault(phi.get_end(), phi)
+
+    boundaries = sorted(position for position in set(starts) | set(ends)
+                        if 0 <= position < len(sa.text))
+
+    return (starts, ends, boundaries)
+
 def standoff_to_inline(sa):
     """This takes a StandoffAnnotation and returns an etree element,
     which can be converted to a string with etree.tostring.
 
     This doesn't currently working with overlapping PHI.
     """
-    def start_of_phi(sa, position):
-        for phi in sa.get_phi():
-            if phi.get_start() == position:
-                return phi
+    assert isinstance(sa, StandoffAnnotation)
 
-    def end_of_phi(sa, position):
-        for phi in sa.get_phi():
-            if phi.get_end() == position:
-                return phi
+    if has_overlapping_phi(sa):
+        raise Exception("Conversion behavior is undefined with overlapping PHI")
+
+    tree = etree.Element("ROOT")
+    last_tag = None
+
+    def create_tag(tag, text):
+        new_tag = etree.SubElement(tree, tag)
+        new_tag.text = text
 
-    def create_tag(tree, tag, text):
-        etree.SubElement(tree, tag).text = text
+        return new_tag
 
-    def append_string(tree, s):
+    def append_string(s):
         """To properly append a string to an XML document, the string
         has to be appended to the last tags tail, or if there isn't a tag
         yet - the trees text property."""
-        tags = tree.getchildren()
-
-        if tags:
-            tags[-1].tail = s
+        if last_tag is not None:
+            last_tag.tail = s
         else:
             tree.text = s
 
-    assert isinstance(sa, StandoffAnnotation)
-
-    if has_overlapping_phi(sa):
-        raise Exception("Conversion behavior is undefined with overlapping PHI")
-
-    tree = etree.Element("ROOT")
-    buf = ""
+    starts, ends, boundaries = phi_boundaries(sa)
+    buf_start = 0
 
-    for (i, character) in enumerate(sa.text):
+    for i in boundaries:
         """
+        The buffer is the text between the previous boundary and this one.
+
         If we're at the start of a PHI tag, AND the end of a PHI tag:
         - Create the tag that we're at the end of
-        - Set the new buffer to be the current character
         Otherwise if it's just the start of a PHI tag:
         - Append the buffer to the end of the document
-        - Set the new buffer to be the current character
         Otherwise if it's just the end of a PHI tag:
         - Create the tag that we're at the end of
-        - Set the new buffer to the current character
 
-        For any other case, just add the character to the buffer.
+        The new buffer then starts at the current character.
         """
-        start = start_of_phi(sa, i)
-        end = end_of_phi(sa, i)
+        start = starts.get(i)
+        end = ends.get(i)
+        buf = sa.text[buf_start:i]
 
         if start and end:
-            create_tag(tree, end.TYPE, buf)
+            last_tag = create_tag(end.TYPE, buf)
         elif start:
-            append_string(tree, buf)
+            append_string(buf)
         elif end:
-            create_tag(tree, end.TYPE, buf)
+            last_tag = create_tag(end.TYPE, buf)
 
-        if start or end:
-            buf = character
-        else:
-            buf += character
+        buf_start = i
 
     # Spit out the final characters
-    append_string(tree, buf)
+    append_string(sa.text[buf_start:])
 
     return tree
 
-def inline_to_standoff(inline_xml, mapping=TYPE_name_mapping):
+def inline_to_standoff(inline_xml, mapping=TYPE_name_mapping, pretty_print=True):
     """This takes and returns a string. It's up to the user to write the
     string to a file and call StandoffAnnotation on it.
 
@@ -100,28 +108,60 @@ def inline_to_standoff(inline_xml, mapping=TYPE_name_mapping):
     """
     inline = etree.fromstring(inline_xml)
 
-    standoff_etree = etree.Element("deIdi2b2")
-    etree.SubElement(standoff_etree, "TEXT")
-    etree.SubElement(standoff_etree, "TAGS")
-
     standoff_text, offset = inline.text, len(inline.text)
+    tags = []
 
-    for (i, inline_tag) in enumerate(inline.getchildren()):
+    for inline_tag in inline.getchildren():
         append = inline_tag.text + (inline_tag.tail if inline_tag.tail else "")
         standoff_text += append
 
-        etree.SubElement(standoff_etree.find("TAGS"),
-                         mapping.get(inline_tag.tag, inline_tag.tag),
-                         id="P%d" % i,
-                         start=str(offset),
-                         end=str(offset + len(inline_tag.text)),
-                         text=str(inline_tag.text),
-                         TYPE=inline_tag.tag,
-                         comment="")
-
+        tags.append((mapping.get(inline_tag.tag, inline_tag.tag),
+                     inline_tag.tag,
+                     offset,
+                     offset + len(inline_tag.text),
+                     inline_tag.text))
 
         offset += len(append)
 
-    standoff_etree.find("TEXT").text = etree.CDATA(standoff_text)
+    return standoff_xml(standoff_text, tags, pretty_print)
+
+def stream_inline_to_standoff(inline_input, output, mapping=TYPE_name_mapping):
+    """Converts inline XML read from inline_input, a file-like object or
+    a file name, to a deIdi2b2 document written to output, a file-like
+    object or a file name, the same as inline_to_standoff but as the
+    input is parsed, so its memory use doesn't grow with the input.
 
-    return etree.tostring(standoff_etree, pretty_print=True)
+    Each tag is written once its tail has been read, and then dropped
+    from the tree. Returns the number of tags written.
+    """
+    with StandoffWriter(output) as writer:
+        root = None
+        previous = None
+
+        for (event, el) in etree.iterparse(inline_input, events=("start", "end"),
+                                           huge_tree=True):
+            if event == "start":
+                if root is None:
+                    root = el
+                elif el.getparent() is root:
+                    # the text before the first tag, or the tail of
+                    # the one before this one, is known now
+                    if previous is None:
+                        writer.write_text(root.text)
+                    else:
+                        writer.write_text(previous.tail)
+                        root.remove(previous)
+            elif el.getparent() is root:
+                text = el.text or ""
+                writer.write_tag(mapping.get(el.tag, el.tag), el.tag, text)
+
+                previous = el
+            elif el is root:
+                if previous is None:
+                    writer.write_text(root.text)
+                else:
+                    writer.write_text(previous.tail)
+
+                root.clear()
+
+    return writer.tags
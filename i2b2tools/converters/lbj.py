@@ -1,8 +1,10 @@
 from i2b2tools.helpers.utils import has_overlapping_phi
 from i2b2tools.lib.standoff_annotations import StandoffAnnotation
-from i2b2tools.converters import TYPE_name_mapping
+from i2b2tools.converters import TYPE_name_mapping, StandoffWriter, read_chunks, standoff_xml
+from i2b2tools.converters.inline import phi_boundaries
 
 from lxml import etree
+import itertools
 import re
 
 lbj_type_mapping = {
@@ -29,9 +31,71 @@ TYPE_lbj_name_mapping = {
     "ORGANIZATION": "ORG"
 }
 
+# The longest text of a tag which is matched, so that a stray bracket
+# doesn't leave lbj_segments holding on to the rest of its line.
+MAX_TAG_TEXT = 2 ** 12
+
+def lbj_tags_regex(lbj_type_mapping=lbj_type_mapping, max_tag_text=MAX_TAG_TEXT):
+    return re.compile(r"\[(%s)\s(.{1,%d}?)\s{2}\]" %
+                      ("|".join(lbj_type_mapping.keys()), max_tag_text))
+
+def _unresolved(buf, end, longest_type, longest_tag):
+    """Where the text of buf which a tag could still be matched across
+    once more input comes starts, given that the last tag matched in
+    buf ended at end.
+
+    Only the whitespace after the LBJ type and before the closing
+    bracket of a tag can be newlines, so a tag which runs past the end
+    of buf can't start more than a few characters before its last
+    newline, nor more than longest_tag characters before its end, and
+    it starts with a bracket.
+    """
+    newline = buf.rfind("\n", 0, max(len(buf) - 2, 0))
+    start = buf.find("[", max(end, newline - longest_type - 1,
+                              len(buf) - longest_tag + 1))
+
+    return len(buf) if start == -1 else start
+
+def lbj_segments(chunks, lbj_type_mapping=lbj_type_mapping, max_tag_text=MAX_TAG_TEXT):
+    """Yields (text, tag) for LBJ input given as chunks of text, where
+    text is the text before the next tag and tag is that tag's (LBJ
+    type, text), or None when more text follows. Only the text a tag
+    could still be matched across is kept between chunks, at most a
+    tag's length, and the tags are the same as matching over the whole
+    input at once. Tags with more than max_tag_text characters of text
+    aren't matched either way.
+    """
+    lbj_tags_re = lbj_tags_regex(lbj_type_mapping, max_tag_text)
+    longest_type = max(len(lbj_type) for lbj_type in lbj_type_mapping)
+
+    # "[", the type, whitespace, the text, two whitespace and "]"
+    longest_tag = longest_type + max_tag_text + 5
+    buf = ""
+
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            buf += chunk
+
+        position = 0
+
+        for match in lbj_tags_re.finditer(buf):
+            yield (buf[position:match.start()], match.groups())
+            position = match.end()
+
+        if chunk is None:
+            end = len(buf)
+        else:
+            end = _unresolved(buf, position, longest_type, longest_tag)
+
+        if end > position:
+            yield (buf[position:end], None)
+
+        buf = buf[end:]
+
 def lbj_to_standoff_annotation(lbj_input,
                                lbj_type_mapping=lbj_type_mapping,
-                               mapping=TYPE_name_mapping):
+                               mapping=TYPE_name_mapping,
+                               pretty_print=True):
     """
     Note: The format in which LBJ outputs documents is not uniform in
     repsect to whitespace and punctuation, so if lbj_input was
@@ -40,70 +104,83 @@ def lbj_to_standoff_annotation(lbj_input,
     This was addressed on the mailing list here:
     http://lists.cs.uiuc.edu/pipermail/illinois-ml-nlp-users/2014-June/000307.html
     """
-    lbj_tags_re = re.compile(r"\[(%s)\s(.+?)\s{2}\]" %
-                             "|".join(lbj_type_mapping.keys()))
-
-    standoff_etree = etree.Element("deIdi2b2")
-    etree.SubElement(standoff_etree, "TEXT")
-    etree.SubElement(standoff_etree, "TAGS")
-
-    tags = re.findall(lbj_tags_re, lbj_input)
-    sa_text = re.sub(lbj_tags_re, "\\2 ", lbj_input)
-
-    search_offset = 0
-
-    standoff_etree.find("TEXT").text = etree.CDATA(sa_text)
+    pieces = []
+    tags = []
+    offset = 0
+
+    # each tag is replaced by its text and a space, so the offsets of
+    # tags come straight from where they're matched
+    for (text, tag) in lbj_segments([lbj_input], lbj_type_mapping):
+        pieces.append(text)
+        offset += len(text)
+
+        if tag is not None:
+            tag_type, tag_text = tag
+            TYPE = lbj_type_mapping[tag_type]
+
+            tags.append((mapping.get(TYPE, TYPE), TYPE, offset,
+                         offset + len(tag_text), tag_text))
+
+            pieces.append(tag_text + " ")
+            offset += len(tag_text) + 1
+
+    return standoff_xml("".join(pieces), tags, pretty_print)
+
+def stream_lbj_to_standoff(lbj_input, output,
+                           lbj_type_mapping=lbj_type_mapping,
+                           mapping=TYPE_name_mapping,
+                           chunk_size=2 ** 20, encoding="utf-8"):
+    """Converts LBJ read from lbj_input, a file-like object or a file
+    name, to a deIdi2b2 document written to output, a file-like object
+    or a file name, the same as lbj_to_standoff_annotation but a chunk
+    at a time, so its memory use doesn't grow with the input.
+
+    Returns the number of tags written.
+    """
+    chunks = read_chunks(lbj_input, chunk_size, encoding)
 
-    for (i, tag) in enumerate(tags):
-        tag_type, tag_text = tag
-        TYPE = lbj_type_mapping[tag_type]
-        name = mapping.get(TYPE, TYPE)
+    with StandoffWriter(output) as writer:
+        for (text, tag) in lbj_segments(chunks, lbj_type_mapping):
+            writer.write_text(text)
 
-        search_offset = sa_text.find(tag_text, search_offset)
+            if tag is not None:
+                tag_type, tag_text = tag
+                TYPE = lbj_type_mapping[tag_type]
 
-        etree.SubElement(standoff_etree.find("TAGS"),
-                         name,
-                         id="P%d" % i,
-                         start=str(search_offset),
-                         end=str(search_offset + len(tag_text)),
-                         text=str(tag_text),
-                         TYPE=TYPE,
-                         comment="")
+                writer.write_tag(mapping.get(TYPE, TYPE), TYPE, tag_text)
+                writer.write_text(" ")
 
-    return etree.tostring(standoff_etree, pretty_print=True)
+    return writer.tags
 
 def standoff_to_lbj(sa, TYPE_name_mapping=TYPE_lbj_name_mapping):
-    def start_of_phi(sa, position):
-        for phi in sa.get_phi():
-            if phi.get_start() == position:
-                return phi
-
-    def end_of_phi(sa, position):
-        for phi in sa.get_phi():
-            if phi.get_end() == position:
-                return phi
-
     assert isinstance(sa, StandoffAnnotation)
 
     if has_overlapping_phi(sa):
         raise Exception("Conversion behavior is undefined with overlapping PHI")
 
-    text = ""
+    starts, ends, boundaries = phi_boundaries(sa)
+    pieces = []
+    text_start = 0
+
+    for i in boundaries:
+        start = starts.get(i)
+        end = ends.get(i)
+        character = sa.text[i]
 
-    for (i, character) in enumerate(sa.text):
-        start = start_of_phi(sa, i)
-        end = end_of_phi(sa, i)
+        pieces.append(sa.text[text_start:i])
 
         if start:
             lbj_type = TYPE_name_mapping.get(start.TYPE, "MISC")
 
         if start and end:
-            text += "  ][%s %s" % (lbj_type, character)
+            pieces.append("  ][%s %s" % (lbj_type, character))
         elif start:
-            text += "[%s %s" % (lbj_type, character)
+            pieces.append("[%s %s" % (lbj_type, character))
         elif end:
-            text += "  ]%s" % character
-        else:
-            text += character
+            pieces.append("  ]%s" % character)
+
+        text_start = i + 1
+
+    pieces.append(sa.text[text_start:])
 
-    return text
+    return "".join(pieces)
@@ -1,27 +1,32 @@
-from i2b2tools.converters import TYPE_name_mapping, deidi2b2_etree
+from i2b2tools.converters import TYPE_name_mapping, standoff_xml
 
-from lxml import etree
+import glob
+import itertools
+import json
+import multiprocessing
+import os
 
-def mat_json_to_standoff(mat_json, mapping=TYPE_name_mapping):
-    def v2_annotations():
-        annotations = []
+# annotations standoff/inline doesn't support
+internal_types = ("SEGMENT",
+                  "zone",
+                  "lex")
 
-        # get rid of annotations standoff/inline doesn't support
-        mat_json["asets"] = [x for x in mat_json["asets"] \
-                             if x["type"] not in internal_types]
+def mat_annotations(mat_json):
+    """Returns the (TYPE, start, end) of every annotation of a MAT
+    version 2 document, leaving out internal_types, without altering
+    mat_json."""
+    annotations = []
 
-        # setup annotations in a sane format
-        # (TYPE, start, end)
-        for aset in mat_json["asets"]:
-            for annot in aset["annots"]:
-                annotations.append((aset["type"], annot[0], annot[1]))
+    for aset in mat_json["asets"]:
+        if aset["type"] in internal_types:
+            continue
 
-        return annotations
+        for annot in aset["annots"]:
+            annotations.append((aset["type"], annot[0], annot[1]))
 
-    internal_types = ("SEGMENT",
-                      "zone",
-                      "lex")
+    return annotations
 
+def mat_json_to_standoff(mat_json, mapping=TYPE_name_mapping, pretty_print=True):
     assert isinstance(mat_json, dict)
     assert ("version" in mat_json and \
             "signal" in mat_json and \
@@ -30,20 +35,92 @@ def mat_json_to_standoff(mat_json, mapping=TYPE_name_mapping):
     # only supporting version 2 right now
     assert mat_json["version"] == 2
 
-    # create the initial etree
-    standoff_etree = deidi2b2_etree(mat_json["signal"])
+    signal = mat_json["signal"]
+    tags = [(mapping.get(TYPE, TYPE), TYPE, start, end, signal[start:end])
+            for (TYPE, start, end) in mat_annotations(mat_json)]
 
-    # setup annotations
-    for (i, annot) in enumerate(v2_annotations()):
-        TYPE, start, end = annot
+    return standoff_xml(signal, tags, pretty_print)
 
-        etree.SubElement(standoff_etree.find("TAGS"),
-                         mapping.get(TYPE, TYPE),
-                         id="P%d" % i,
-                         start=str(start),
-                         end=str(end),
-                         text=mat_json["signal"][start:end],
-                         TYPE=TYPE,
-                         comment="")
+def convert_mat_document(job):
+    """Converts a single MAT document, given as (filename, raw, output,
+    mapping, pretty_print), where either filename is the file holding
+    the JSON or raw is the JSON itself, and output is the file to write
+    the deIdi2b2 document to. This runs in convert_mat_batch's worker
+    processes, so the JSON is read and parsed there too. Returns
+    output."""
+    (filename, raw, output, mapping, pretty_print) = job
 
-    return etree.tostring(standoff_etree, pretty_print=True)
+    if filename is not None:
+        with open(filename, "rb") as infile:
+            raw = infile.read()
+
+    standoff = mat_json_to_standoff(json.loads(raw), mapping, pretty_print)
+
+    with open(output, "wb") as outfile:
+        outfile.write(standoff)
+
+    return output
+
+def _mat_jobs(source, output_dir, mapping, pretty_print):
+    """Yields a job for convert_mat_document for each MAT document in
+    source, a directory of .json files, or a JSONL file name or
+    file-like object with a document on each line. Documents from a
+    directory keep their file name, and those from JSONL are named for
+    their line number."""
+    def job(filename, raw, name):
+        return (filename, raw, os.path.join(output_dir, name + ".xml"),
+                mapping, pretty_print)
+
+    if isinstance(source, basestring) and os.path.isdir(source):
+        for filename in sorted(glob.glob(os.path.join(source, "*.json"))):
+            name = os.path.splitext(os.path.basename(filename))[0]
+            yield job(filename, None, name)
+        return
+
+    if isinstance(source, basestring):
+        with open(source, "rb") as infile:
+            for j in _mat_jobs(infile, output_dir, mapping, pretty_print):
+                yield j
+        return
+
+    for (i, line) in enumerate(source):
+        if line.strip():
+            yield job(None, line, "%08d" % i)
+
+def convert_mat_batch(source, output_dir, mapping=TYPE_name_mapping,
+                      pretty_print=True, workers=None):
+    """Converts every MAT version 2 document in source, a directory of
+    .json files or a JSONL file (or file-like object) of one document
+    per line, writing a deIdi2b2 document for each to output_dir.
+    Returns the names of the files written, in the order of source.
+
+    Documents are converted by a pool of worker processes (None
+    meaning one per CPU), or in this process with workers=1. Each
+    worker reads and parses its own documents, and only a window of
+    documents is handed out at a time, so a JSONL file is never read
+    all at once. pretty_print=False writes each document on one line.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    jobs = _mat_jobs(source, output_dir, mapping, pretty_print)
+
+    if workers == 1:
+        return list(itertools.imap(convert_mat_document, jobs))
+
+    pool = multiprocessing.Pool(workers)
+    window = 64 * (workers or multiprocessing.cpu_count())
+    written = []
+
+    try:
+        while True:
+            batch = list(itertools.islice(jobs, window))
+
+            if not batch:
+                break
+
+            written.extend(pool.imap(convert_mat_document, batch, chunksize=16))
+    finally:
+        pool.terminate()
+
+    return written
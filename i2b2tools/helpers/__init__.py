@@ -1,3 +1,3 @@
-from utils import is_valid_sa_file, get_sa_from_dir, has_overlapping_phi
-from tokens import get_sa_tagged_tokens
+from utils import is_valid_sa_file, get_sa_from_dir, iter_sa_from_dir, has_overlapping_phi
+from tokens import get_sa_tagged_tokens, get_sa_tagged_token_arrays
 from mutable import sa_filter_by_phi_attrs, remap_sa_attributes
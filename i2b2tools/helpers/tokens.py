@@ -1,8 +1,11 @@
 from i2b2tools.lib.standoff_annotations import StandoffAnnotation
 from i2b2tools.lib.document_token import Document, TokenSequence
-from i2b2tools.helpers.utils import has_overlapping_phi
 
-from itertools import islice
+from i2b2tools.lib.phi_index import phi_list, phi_version
+
+from bisect import bisect_left, bisect_right
+from itertools import islice, izip
+import numpy as np
 
 def n_tokens(seq, n):
     """Provides a "sliding window" of n tokens from a token sequence."""
@@ -10,30 +13,153 @@ def n_tokens(seq, n):
 
     return zip(*(islice(seq, i, None) for i in range(n)))
 
+def iter_n_tokens(seq, n):
+    """The same windows as n_tokens, created one at a time as they're
+    iterated over rather than all at once."""
+    assert isinstance(seq, TokenSequence)
+
+    return izip(*(islice(seq, i, None) for i in range(n)))
+
+def anchored_n_tokens(sa, n, name):
+    """Yields the windows of n tokens of sa's token_sequence whose first
+    or last token overlaps a PHI named name, in the order n_tokens
+    gives them, skipping the rest without creating them.
+
+    Whether a window is anchored is looked up as it's reached, so PHI
+    added or removed while iterating, such as by a MergeRule merging
+    the windows before, are taken into account. For a predicate which
+    only accepts windows whose first or last token is such a PHI, this
+    gives the same results as going through every window.
+    """
+    seq = sa.token_sequence
+    starts, ends = [bounds.tolist() for bounds in seq.bounds()]
+
+    version = None
+    anchors = []
+    i = 0
+
+    while i + n <= len(seq):
+        if phi_version(sa) != version:
+            version = phi_version(sa)
+            anchored = set()
+
+            for phi in phi_list(sa):
+                if phi.name == name:
+                    anchored.update(xrange(bisect_left(ends, phi.get_start()),
+                                           bisect_right(starts, phi.get_end())))
+
+            anchors = sorted(anchored)
+
+        # the next window from i starting or ending on an anchor
+        candidates = []
+        first = bisect_left(anchors, i)
+        last = bisect_left(anchors, i + n - 1)
+
+        if first < len(anchors):
+            candidates.append(anchors[first])
+        if last < len(anchors):
+            candidates.append(anchors[last] - (n - 1))
+
+        if not candidates or min(candidates) + n > len(seq):
+            return
+
+        i = min(candidates)
+
+        yield tuple(seq[i:i + n])
+
+        i += 1
+
+def _tagged_tokens(sa):
+    """Yields each token of sa's text along with the PHI containing it,
+    if any, walking the tokens and the PHI sorted by start offset side
+    by side, so each is looked at a constant number of times.
+    """
+    if not isinstance(sa, StandoffAnnotation):
+        raise Exception("Argument passed is not a StandoffAnnotation.")
+
+    # (start, end, position in the list, tag); sorting by position too
+    # keeps ties in list order
+    phi = sorted((tag.get_start(), tag.get_end(), i, tag)
+                 for (i, tag) in enumerate(sa.get_phi()))
+
+    # same test as has_overlapping_phi, on PHI sorted the same way
+    if any(phi[i][1] > phi[i + 1][0] for i in range(len(phi) - 1)):
+        raise Exception("StandoffAnnotation has overlapping PHI.")
+
+    if isinstance(sa, Document):
+        tokens = sa.token_sequence
+    else:
+        tokens = TokenSequence(sa.text)
+
+    # Tokens are in order and don't overlap, so their ends only grow,
+    # and a PHI ending before a token can't contain any later token.
+    j = 0
+
+    for token in tokens:
+        while j < len(phi) and phi[j][1] < token.end:
+            j += 1
+
+        # The last PHI in list order containing the token, as checking
+        # the token against every PHI would find. Only PHI touching at
+        # an offset can both contain it.
+        associated_phi = None
+        k = j
+
+        while k < len(phi) and phi[k][0] <= token.start:
+            if phi[k][1] >= token.end:
+                if associated_phi is None or phi[k][2] > associated_phi[2]:
+                    associated_phi = phi[k]
+            k += 1
+
+        yield (token, associated_phi[3] if associated_phi else None)
+
 def get_sa_tagged_tokens(sa):
     """Returns a list of tuples containing each token in a token
     sequence of the document, and the PHI tag associated with that
     token, if any.
     This does not support StandoffAnnotation's with overlapping PHI.
     """
-    def token_in_phi(token, phi):
-        return token.start >= phi.get_start() and token.end <= phi.get_end()
+    return list(_tagged_tokens(sa))
 
-    if not isinstance(sa, StandoffAnnotation):
-        raise Exception("Argument passed is not a StandoffAnnotation.")
-    elif has_overlapping_phi(sa):
-        raise Exception("StandoffAnnotation has overlapping PHI.")
+def get_sa_tagged_token_arrays(sas, token_ids=None, label_ids=None):
+    """Tags the tokens of many StandoffAnnotations at once, returning
+    three numpy arrays (token ids, label ids, boundaries).
 
-    doc = Document(sa.file_name)
-    tagged_tokens = []
+    token ids and label ids have an entry for each token of each
+    document in turn, and the tokens of the i-th document are
+    [boundaries[i], boundaries[i + 1]). Labels are BIO-style, "B-" or
+    "I-" followed by the TYPE of the PHI containing the token, or "O"
+    for no PHI.
 
-    for token in doc.token_sequence:
-        associated_phi = None
+    token_ids and label_ids are dictionaries from each token and label
+    to its id, which new tokens and labels are added to, so they can be
+    shared across calls. label_ids starts out as {"O": 0}.
+    """
+    token_ids = {} if token_ids is None else token_ids
+    label_ids = {"O": 0} if label_ids is None else label_ids
+
+    tokens = []
+    labels = []
+    boundaries = [0]
+
+    for sa in sas:
+        previous_phi = None
+
+        for (token, phi) in _tagged_tokens(sa):
+            if phi is None:
+                label = "O"
+            elif phi is previous_phi:
+                label = "I-" + phi.TYPE
+            else:
+                label = "B-" + phi.TYPE
+
+            previous_phi = phi
 
-        for phi in doc.get_phi():
-            if token_in_phi(token, phi):
-                associated_phi = phi
+            tokens.append(token_ids.setdefault(token.token, len(token_ids)))
+            labels.append(label_ids.setdefault(label, len(label_ids)))
 
-        tagged_tokens.append((token, associated_phi))
+        boundaries.append(len(tokens))
 
-    return tagged_tokens
+    return (np.array(tokens, dtype=np.int32),
+            np.array(labels, dtype=np.int32),
+            np.array(boundaries, dtype=np.int64))
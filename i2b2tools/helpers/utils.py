@@ -1,77 +1,214 @@
 from i2b2tools.lib.standoff_annotations import StandoffAnnotation
+from i2b2tools.lib.phi_index import phi_index
 
+from io import BytesIO
 from lxml import etree
+from multiprocessing.pool import ThreadPool
+import functools
+import itertools
+import multiprocessing
 import os
+import time
+
+def _is_valid_sa_stream(source):
+    """Pulls elements from source only until the root is known to be a
+    deIdi2b2 element with TEXT and TAGS children, or known not to be,
+    without building the rest of the tree."""
+    depth = 0
+    children = set()
+
+    for (event, el) in etree.iterparse(source, events=("start", "end"),
+                                       huge_tree=True):
+        if event == "start":
+            if depth == 0 and el.tag != "deIdi2b2":
+                return False
+
+            if depth == 1:
+                children.add(el.tag)
+
+                if "TEXT" in children and "TAGS" in children:
+                    return True
+
+            depth += 1
+        else:
+            depth -= 1
+
+            # nothing is kept once it's been checked
+            el.clear()
+
+    return False
 
 def is_valid_sa_file(filename):
     """Determines if a given file would constitute a valid StandoffAnnotation.
     It will return false if the file doesn't exist, or if it contains invalid
     XML.
+
+    Only as much of the file is read as it takes to find the TEXT and
+    TAGS elements, so XML errors after the start of the later of the
+    two aren't noticed until the file is loaded.
     """
     try:
-        with open(filename, "r") as infile:
-            root = etree.fromstring(infile.read())
-            children = [el.tag for el in root.getchildren()]
-
-        return (root.tag == "deIdi2b2" and
-                "TEXT" in children and
-                "TAGS" in children)
+        with open(filename, "rb") as infile:
+            return _is_valid_sa_stream(infile)
 
     # handles the cases of a non-readable file, or an invalid xml file
     except (IOError, etree.XMLSyntaxError):
         return False
 
-def get_sa_from_dir(dirname):
-    """Returns a dictionary in the format of:
-    {"id": <StandoffAnnotation>}
+def is_valid_sa_xml(raw):
+    """Determines if the contents of a file would constitute a valid
+    StandoffAnnotation, the same way as is_valid_sa_file."""
+    try:
+        return _is_valid_sa_stream(BytesIO(raw))
+    except etree.XMLSyntaxError:
+        return False
 
-    This is determined by finding all filenames within dirname that pass
-    is_valid_sa_file.
+def iter_phi_records(filename):
+    """Yields a (name, start, end, TYPE, attributes) record for each tag
+    within the TAGS element of a deIdi2b2 file, without building its
+    tree or creating any PHI. start and end are ints, or None when the
+    tag doesn't have them, and attributes is a dictionary of all of the
+    tag's attributes.
+
+    Each element is thrown away once it's been read, so this takes the
+    same memory however large the file is.
     """
-    sas = []
+    def offset(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
 
-    for filename in os.listdir(dirname):
-        filename = os.path.join(dirname, filename)
+    with open(filename, "rb") as infile:
+        depth = 0
 
-        if is_valid_sa_file(filename):
-            sas.append(StandoffAnnotation(filename))
+        for (event, el) in etree.iterparse(infile, events=("start", "end"),
+                                           huge_tree=True):
+            if event == "start":
+                depth += 1
+                continue
 
-    return dict(zip([sa.id for sa in sas], sas))
+            depth -= 1
 
-def has_overlapping_phi(sa):
-    """Determines if a given StandoffAnnotation has any PHI that overlap."""
-    if not isinstance(sa, StandoffAnnotation):
-        raise Exception("Argument passed is not a StandoffAnnotation.")
+            # el is a child of TAGS, which is a child of the root
+            if depth == 2 and el.getparent().tag == "TAGS":
+                yield (el.tag, offset(el.get("start")), offset(el.get("end")),
+                       el.get("TYPE"), dict(el.attrib))
 
-    phi = sorted(sa.get_phi(), key=lambda tag: tag.get_start())
+            if depth >= 1:
+                el.clear()
 
-    # no phi -> no overlapping phi
-    if not phi:
-        return False
+                # drop the elements already read from their parent too
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+
+def load_sa_file(filename, cache=None):
+    """Reads a file once, returning a StandoffAnnotation if it passes
+    is_valid_sa_file and None otherwise.
+
+    With a DocumentCache, the file is loaded through the cache instead.
+    """
+    if cache is not None:
+        return cache.load(filename)
+
+    try:
+        with open(filename, "r") as infile:
+            raw = infile.read()
+    except IOError:
+        return None
+
+    if not is_valid_sa_xml(raw):
+        return None
+
+    sa = StandoffAnnotation()
+    sa.file_name = filename
+
+    # is_valid_sa_xml stops reading early, so errors further on only
+    # turn up here
+    try:
+        sa.parse_text_and_tags(raw)
+    except etree.XMLSyntaxError:
+        return None
+
+    return sa
+
+def iter_sa_from_dir(dirname, workers=1, pool="process", chunksize=8,
+                     progress=None, cache=None):
+    """Yields (id, <StandoffAnnotation>) pairs for every file within
+    dirname that passes is_valid_sa_file, in the order they finish
+    loading.
 
-    prev = phi[0]
+    With workers other than 1 the files are loaded by a pool of that
+    many workers (None meaning one per CPU), either a "process" pool
+    or a "thread" pool. A process pool sends each StandoffAnnotation
+    back by pickling it.
 
-    for tag in phi[1:]:
-        if prev.get_end() > tag.get_start():
-            return True
+    progress, if given, is called after each file with the number of
+    files loaded so far, the total number of files, and the files per
+    second so far.
+
+    cache, if given, is a DocumentCache to load the files through.
+    """
+    filenames = [os.path.join(dirname, filename)
+                 for filename in os.listdir(dirname)]
+    load = functools.partial(load_sa_file, cache=cache)
+
+    if workers == 1:
+        workers_pool = None
+        loaded = itertools.imap(load, filenames)
+    else:
+        if pool == "process":
+            workers_pool = multiprocessing.Pool(workers)
+        elif pool == "thread":
+            workers_pool = ThreadPool(workers)
         else:
-            prev = tag
+            raise ValueError("pool must be either 'process' or 'thread'.")
 
-    return False
+        loaded = workers_pool.imap_unordered(load, filenames, chunksize)
+
+    began = time.time()
+
+    try:
+        for (done, sa) in enumerate(loaded, 1):
+            if progress is not None:
+                elapsed = time.time() - began
+                progress(done, len(filenames),
+                         done / elapsed if elapsed else 0.0)
+
+            if sa is not None:
+                yield (sa.id, sa)
+
+    finally:
+        if workers_pool is not None:
+            workers_pool.terminate()
+
+def get_sa_from_dir(dirname, workers=1, pool="process", progress=None,
+                    cache=None):
+    """Returns a dictionary in the format of:
+    {"id": <StandoffAnnotation>}
+
+    This is determined by finding all filenames within dirname that pass
+    is_valid_sa_file. See iter_sa_from_dir for workers, pool, progress
+    and cache.
+    """
+    return dict(iter_sa_from_dir(dirname, workers=workers, pool=pool,
+                                 progress=progress, cache=cache))
+
+def has_overlapping_phi(sa):
+    """Determines if a given StandoffAnnotation has any PHI that overlap."""
+    if not isinstance(sa, StandoffAnnotation):
+        raise Exception("Argument passed is not a StandoffAnnotation.")
+
+    return phi_index(sa).has_overlap()
 
 def phi_at_offset(sa, offset):
     """Returns a list of PHI that are present at a given offset in a
     StandoffAnnotation.
     """
-    return [phi for phi in sa.get_phi() \
-            if offset >= phi.get_start() and offset <= phi.get_end()]
+    return phi_index(sa).at_offset(offset)
 
 def phi_within_range(sa, start, end):
     """Finds all PHI within a given range of offsets in the
     StandoffAnnotation.
     """
-    def point_in_range(point):
-        return point >= start and point <= end
-
-    return [phi for phi in sa.get_phi() \
-            if point_in_range(phi.get_start()) or point_in_range(phi.get_end())]
+    return phi_index(sa).within_range(start, end)
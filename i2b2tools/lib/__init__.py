@@ -1,3 +1,8 @@
 from document_token import *
+from phi_index import *
+from corpus import *
+from cache import *
+from packed import *
+from evaluation import *
 from rules import *
 from standoff_annotations import *
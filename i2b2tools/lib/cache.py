@@ -0,0 +1,323 @@
+from i2b2tools.lib.document_token import Document, TokenSequence
+from i2b2tools.lib.standoff_annotations import tags
+from i2b2tools.helpers.utils import is_valid_sa_xml
+
+from lxml import etree
+import errno
+import hashlib
+import marshal
+import numpy as np
+import os
+import stat
+import tempfile
+
+# Bumped whenever what's stored for a document changes
+CACHE_FORMAT = "1"
+
+# The attributes of a deIdi2b2 PHI tag, for tags without an attributes list
+PHI_ATTRIBUTES = ("id", "start", "end", "text", "TYPE", "comment")
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+
+    return value
+
+def _plain(value):
+    """marshal only writes str and unicode themselves, not the subclasses
+    lxml sometimes gives back."""
+    if isinstance(value, unicode):
+        return unicode(value)
+    elif isinstance(value, str):
+        return str(value)
+
+    return value
+
+def tag_class_name(cls):
+    """The name a tag class is stored under, as "module:class"."""
+    return "{}:{}".format(cls.__module__, cls.__name__)
+
+def tag_class(name):
+    """The tag class stored under name, which has to be one of the
+    classes of standoff_annotations.tags, so a cache entry or packed
+    corpus can't make this import anything else."""
+    module, class_name = name.rsplit(":", 1)
+    cls = getattr(tags, class_name, None)
+
+    if module != tags.__name__ or not isinstance(cls, type) or not issubclass(cls, tags.Tag):
+        raise ValueError("{} isn't a tag class of {}".format(name, tags.__name__))
+
+    return cls
+
+class DocumentCache(object):
+    """An opt-in cache directory of parsed and tokenized documents,
+    so a corpus which hasn't changed doesn't need to be parsed and
+    tokenized on every run:
+
+    cache = DocumentCache(os.path.expanduser("~/.cache/i2b2tools"))
+    sas = get_sa_from_dir("gold/", cache=cache)
+
+    Each document is stored in a file named for a hash of the file's
+    contents and of the tokenizer regex, holding its text, a table of
+    its PHI and a numpy array of the offsets of its tokens. Loading a
+    document from the cache only reads and hashes the file, with no
+    XML parsing or tokenizing, and Token objects are only created if
+    its token_sequence is used.
+
+    Entries are written with marshal, which is much quicker to read
+    than the XML or an .npz file, but which is only safe to read from
+    a directory no one else can write to. So the directory is created
+    readable only by its owner, and one which belongs to someone else
+    or which others can write to is refused with a ValueError. PHI are
+    only restored as the tag classes of standoff_annotations.tags, and
+    documents with others aren't cached.
+
+    Once the entries add up to more than max_bytes, the least recently
+    used are removed. Entries are written to a temporary file which is
+    then renamed into place, so several processes can share the cache
+    directory, and an entry which another process evicts is simply
+    parsed again.
+    """
+    extension = ".entry"
+
+    def __init__(self, directory, max_bytes=2 ** 30, document_class=Document):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.document_class = document_class
+        self._size = None
+
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        status = os.stat(directory)
+
+        if hasattr(os, "getuid") and status.st_uid != os.getuid():
+            raise ValueError("{} belongs to someone else, so can't be a cache "
+                             "directory".format(directory))
+
+        if status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise ValueError("{} can be written to by others, so can't be a cache "
+                             "directory".format(directory))
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__, self.directory)
+
+    @staticmethod
+    def _token_class(sa):
+        return getattr(sa, "token_sequence_class", TokenSequence)
+
+    def path(self, raw, token_class=TokenSequence):
+        """The cache file for a document with the contents raw."""
+        key = hashlib.sha1()
+        key.update(CACHE_FORMAT + "\0")
+        key.update(_encode(token_class.tokenizer_re.pattern) + "\0")
+        key.update(_encode(raw))
+
+        return os.path.join(self.directory, key.hexdigest() + self.extension)
+
+    def load(self, filename):
+        """Returns a document_class for filename, or None if it isn't a
+        valid StandoffAnnotation, the same as load_sa_file."""
+        try:
+            with open(filename, "r") as infile:
+                raw = infile.read()
+        except IOError:
+            return None
+
+        sa = self.document_class()
+        sa.file_name = filename
+
+        if not self._restore(sa, raw):
+            if not is_valid_sa_xml(raw):
+                return None
+
+            try:
+                sa.parse_text_and_tags(raw)
+            except etree.XMLSyntaxError:
+                return None
+
+            self._store(sa, raw)
+
+        return sa
+
+    def fill(self, sa):
+        """Loads sa.file_name into a new StandoffAnnotation sa, from the
+        cache if it's there, and otherwise by parsing it and adding it
+        to the cache."""
+        with open(sa.file_name, "r") as infile:
+            raw = infile.read()
+
+        if not self._restore(sa, raw):
+            sa.parse_text_and_tags(raw)
+            self._store(sa, raw)
+
+        return sa
+
+    def _restore(self, sa, raw):
+        token_class = self._token_class(sa)
+        path = self.path(raw, token_class)
+
+        try:
+            with open(path, "rb") as infile:
+                entry = marshal.load(infile)
+
+            # marks it as recently used
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            # not cached, or evicted by another process
+            return False
+
+        try:
+            phi = self._restore_phi(entry)
+        except ValueError:
+            # not a tag class this will restore
+            return False
+
+        sa.raw = raw
+        sa.root = entry["root"]
+        sa.text = entry["text"]
+        sa.phi = phi
+
+        # tokens are only created if the token sequence is used
+        if sa.text is not None and hasattr(sa, "token_sequence_class"):
+            tokens = np.frombuffer(entry["tokens"], dtype=entry["token_dtype"])
+            sa._token_offsets = (tokens[0::2], tokens[1::2])
+
+        return True
+
+    @staticmethod
+    def _restore_phi(entry):
+        classes = [tag_class(name) for name in entry["classes"]]
+
+        attributes = entry["attributes"]
+        phi = []
+
+        for (name, cls, values) in entry["phi"]:
+            attrib = dict((attribute, value) for (attribute, value)
+                          in zip(attributes, values) if value is not None)
+
+            phi.append(classes[cls](etree.Element(name, attrib=attrib)))
+
+        return phi
+
+    def _store(self, sa, raw):
+        phi = list(sa.get_phi())
+        tag_classes = [tag_class_name(tag.__class__) for tag in phi]
+
+        try:
+            for name in set(tag_classes):
+                tag_class(name)
+        except ValueError:
+            # it couldn't be restored
+            return
+
+        classes = []
+        attributes = []
+
+        for (tag, cls) in zip(phi, tag_classes):
+            if cls not in classes:
+                classes.append(cls)
+
+            for name in getattr(tag, "attributes", PHI_ATTRIBUTES):
+                if name not in attributes:
+                    attributes.append(name)
+
+        token_class = self._token_class(sa)
+
+        if sa.text is not None:
+            dtype = np.int32 if len(sa.text) < 2 ** 31 else np.int64
+            tokens = token_class.token_offsets(sa.text, dtype=dtype)
+        else:
+            tokens = np.zeros((0, 2), dtype=np.int32)
+
+        # The PHI table has a row for each PHI of its name, the index of
+        # its class, and the value of each attribute, or None.
+        entry = {
+            "root": _plain(sa.root),
+            "text": _plain(sa.text),
+            "classes": classes,
+            "attributes": [_plain(name) for name in attributes],
+            "phi": [(_plain(tag.name), classes.index(cls),
+                     tuple(_plain(getattr(tag, name, None)) for name in attributes))
+                    for (tag, cls) in zip(phi, tag_classes)],
+            "tokens": tokens.tostring(),
+            "token_dtype": tokens.dtype.name,
+        }
+
+        path = self.path(raw, token_class)
+        fd, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                marshal.dump(entry, outfile)
+
+            # atomic, so readers never see half of an entry
+            os.rename(temporary, path)
+        except (OSError, ValueError):
+            # another process renamed its entry into place first, or
+            # something in the entry can't be marshalled
+            os.remove(temporary)
+            return
+
+        self._evict(os.path.getsize(path))
+
+    def _entries(self):
+        entries = []
+
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(self.extension):
+                continue
+
+            path = os.path.join(self.directory, filename)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def _evict(self, written):
+        """Removes the least recently used entries once the cache is over
+        max_bytes, down to 90% of it so it isn't done on every write.
+
+        The size of the cache is only counted again when this process's
+        running total goes over max_bytes, since other processes write
+        to it too."""
+        if self._size is None:
+            self._size = sum(size for (_, size, _) in self._entries())
+        else:
+            self._size += written
+
+        if self._size <= self.max_bytes:
+            return
+
+        entries = sorted(self._entries())
+        self._size = sum(size for (_, size, _) in entries)
+
+        for (_, size, path) in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                # another process removed it first
+                pass
+
+            self._size -= size
+
+    def clear(self):
+        """Removes every entry from the cache."""
+        for (_, _, path) in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        self._size = 0
@@ -0,0 +1,122 @@
+from i2b2tools.lib.standoff_annotations import StandoffAnnotation
+from i2b2tools.helpers.utils import is_valid_sa_file, load_sa_file
+
+from collections import OrderedDict
+import os
+
+def sa_id(filename):
+    """Returns the id a StandoffAnnotation loaded from filename would
+    have, without reading the file."""
+    sa = StandoffAnnotation()
+    sa.file_name = filename
+
+    return sa.id
+
+class Corpus(object):
+    """A dictionary-like collection of the StandoffAnnotations within a
+    directory, in the format of:
+    {"id": <StandoffAnnotation>}
+
+    Only an index of ids to file paths is kept up front, annotations
+    are loaded when they are looked up, and at most cache_size of them
+    are kept in memory, evicting the least recently used. An evicted
+    annotation is loaded from disk again the next time it is looked up,
+    so any changes that weren't saved are lost.
+
+    values(), items() and their iter* forms are lazy, so iterating over
+    a Corpus only holds cache_size annotations at a time.
+
+    A file which looked valid when the directory was indexed but can't
+    be loaded is dropped from the Corpus the first time it's looked up,
+    which raises a KeyError naming the file.
+    """
+    def __init__(self, dirname, cache_size=128, loader=load_sa_file):
+        self.dirname = dirname
+        self.cache_size = cache_size
+        self.loader = loader
+        self.paths = {}
+        self._cache = OrderedDict()
+
+        for filename in os.listdir(dirname):
+            filename = os.path.join(dirname, filename)
+
+            if is_valid_sa_file(filename):
+                self.paths[sa_id(filename)] = filename
+
+    def __repr__(self):
+        return "<{}: {}, {} documents, {} loaded>".format(self.__class__.__name__,
+                                                          self.dirname,
+                                                          len(self.paths),
+                                                          len(self._cache))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.paths
+
+    def __iter__(self):
+        return iter(sorted(self.paths))
+
+    def __getitem__(self, doc_id):
+        try:
+            sa = self._cache.pop(doc_id)
+        except KeyError:
+            sa = self.loader(self.paths[doc_id])
+
+            # is_valid_sa_file only reads as far as the TAGS element, so
+            # a file can be indexed and still fail to load
+            if sa is None:
+                filename = self.paths.pop(doc_id)
+                raise KeyError("{} couldn't be loaded from {}".format(doc_id, filename))
+
+        self._cache[doc_id] = sa
+
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return sa
+
+    def get(self, doc_id, default=None):
+        if doc_id in self:
+            return self[doc_id]
+
+        return default
+
+    def keys(self):
+        return sorted(self.paths)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for (doc_id, sa) in self.iteritems():
+            yield sa
+
+    def iteritems(self):
+        """Skips documents which can't be loaded, as get_sa_from_dir
+        does."""
+        for doc_id in self:
+            try:
+                sa = self[doc_id]
+            except KeyError:
+                continue
+
+            yield (doc_id, sa)
+
+    values = itervalues
+    items = iteritems
+
+def paired_documents(system_sas, gold_sas):
+    """Yields (id, system <StandoffAnnotation>, gold <StandoffAnnotation>)
+    for every id in both system_sas and gold_sas, which may be
+    dictionaries or Corpus objects, one document at a time, skipping
+    those a Corpus can't load."""
+    for doc_id in sorted(system_sas.keys()):
+        if doc_id in gold_sas:
+            try:
+                pair = (system_sas[doc_id], gold_sas[doc_id])
+            except KeyError:
+                continue
+
+            yield (doc_id,) + pair
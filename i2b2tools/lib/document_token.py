@@ -15,11 +15,13 @@
 """
 
 from standoff_annotations import StandoffAnnotation, get_predicate_function
+from i2b2tools.lib.phi_index import phi_list
 from collections import defaultdict
+from itertools import chain
+import numpy as np
 import os
 import types
 import re
-import copy
 
 class Token(object):
     """ Class designed to encapsulate the idea of a token.  This includes
@@ -28,6 +30,8 @@ class Token(object):
     out of.  It also includes an 'index' attribute that can be set by external
     functions and classes (see TokenSequence).
     """
+    __slots__ = ("token", "start", "end", "index", "pre_ws", "post_ws")
+
     def __init__(self, token, pre_ws, post_ws, index, start, end):
         self.token = token
         self.start = int(start)
@@ -39,6 +43,13 @@ class Token(object):
         # post whitespace
         self.post_ws = post_ws
 
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for (attr, value) in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
 
     def __repr__(self):
         return "<{}: {}, {}, {}, i:{}, s:{}, e:{}>".format(self.__class__.__name__,
@@ -71,6 +82,8 @@ class TokenSequence(object):
     method as long as it returns a list of Token() objects.
     """
     tokenizer_re = re.compile(r'(\w+)')
+    _index_map = None
+    _bounds = None
 
     @classmethod
     def tokenizer(cls, text, start=0):
@@ -169,44 +182,356 @@ class TokenSequence(object):
         return self.tokens.next()
 
 
+    @classmethod
+    def token_offsets(cls, text, start=0, token_ids=None, ids=None, dtype=np.int64):
+        """The (start, end) offsets of each token tokenizer would find in
+        text, relative to text, as an (n, 2) numpy array.  Only the
+        offsets are created,  rather than a Token for each.
+
+        With token_ids,  a dictionary from each token to an id,  the id
+        of each token is appended to the list ids,  new tokens being
+        added to token_ids.
+        """
+        # The dummy token which accounts for leading whitespace,  only
+        # when parsing a whole document (see TokenSequence.tokenizer)
+        dummy = [0, 0] if start == 0 else []
+
+        if token_ids is None:
+            spans = chain.from_iterable(m.span() for m in cls.tokenizer_re.finditer(text)
+                                        if m.end() > m.start())
+        else:
+            if dummy:
+                ids.append(token_ids.setdefault("", len(token_ids)))
+
+            spans = cls._interned_spans(text, token_ids, ids)
+
+        return np.fromiter(chain(dummy, spans), dtype=dtype).reshape(-1, 2)
+
+
+    @classmethod
+    def _interned_spans(cls, text, token_ids, ids):
+        for m in cls.tokenizer_re.finditer(text):
+            start, end = m.span()
+
+            if end > start:
+                ids.append(token_ids.setdefault(text[start:end], len(token_ids)))
+                yield start
+                yield end
+
+
+    @classmethod
+    def from_offsets(cls, text, starts, ends):
+        """Creates the token sequence of a whole document from the start
+        and end offsets of its tokens,  as token_offsets returns,  without
+        tokenizing the text again."""
+        starts = [int(start) for start in starts]
+        ends = [int(end) for end in ends]
+        pre_starts = [0] + ends[:-1]
+        post_ends = starts[1:] + [len(text)]
+
+        seq = cls.__new__(cls)
+        seq.text = text
+        seq.tokens = [Token(text[start:end], text[pre_start:start], text[end:post_end],
+                            index, start, end)
+                      for (index, (start, end, pre_start, post_end))
+                      in enumerate(zip(starts, ends, pre_starts, post_ends))]
+
+        return seq
+
+
+    @classmethod
+    def bulk_tokenize(cls, texts, token_ids=None):
+        """Tokenizes many texts at once,  returning numpy arrays
+        (starts, ends, boundaries),  or (starts, ends, boundaries, ids)
+        when token_ids is given.
+
+        starts and ends hold the offsets of every token of every text in
+        turn,  the same tokens TokenSequence(text) would have,  including
+        the dummy token for leading whitespace.  Offsets are relative to
+        each text,  and the tokens of the i-th text are
+        [boundaries[i],  boundaries[i + 1]).
+
+        token_ids is a dictionary from each token to its id,  which new
+        tokens are added to,  so it can be shared across calls.
+        """
+        chunks = []
+        ids = []
+        boundaries = [0]
+
+        for text in texts:
+            offsets = cls.token_offsets(text, token_ids=token_ids, ids=ids)
+            chunks.append(offsets)
+            boundaries.append(boundaries[-1] + len(offsets))
+
+        offsets = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.int64)
+        arrays = (offsets[:, 0].copy(), offsets[:, 1].copy(),
+                  np.array(boundaries, dtype=np.int64))
+
+        if token_ids is None:
+            return arrays
+
+        return arrays + (np.array(ids, dtype=np.int64),)
+
+
+    def bounds(self):
+        """The start and end offsets of every token,  as two numpy
+        arrays,  worked out the first time this is called."""
+        if self._bounds is None:
+            self._bounds = (np.array([t.start for t in self.tokens], dtype=np.int64),
+                            np.array([t.end for t in self.tokens], dtype=np.int64))
+
+        return self._bounds
+
+
     def subseq(self, other):
         """Test if we are a subsequence of other"""
         return all([t in other.tokens for t in self.tokens])
 
 
+    def index_of(self, token):
+        """Returns the index of the first token with the same start and
+        end as token (the same token as self.tokens.index would find),
+        raising ValueError if there isn't one.  The offsets are mapped
+        to indices the first time this is called."""
+        if self._index_map is None:
+            self._index_map = {}
+
+            for (index, t) in enumerate(self.tokens):
+                self._index_map.setdefault((t.start, t.end), index)
+
+        try:
+            return self._index_map[(token.start, token.end)]
+        except KeyError:
+            raise ValueError("{!r} is not in the token sequence".format(token))
+
+
     def tokens_before(self, token, N):
+        """The N tokens before token,  which are shared with this sequence
+        rather than copied."""
         try:
-            start_index = self.tokens.index(token)
-            return TokenSequence([copy.deepcopy(t) for t in self.tokens[start_index-N:start_index]])
+            start_index = self.index_of(token)
+            return TokenSequence(self[start_index-N:start_index])
         except ValueError:
             return None
 
     def tokens_after(self, token, N):
+        """The N tokens after token,  which are shared with this sequence
+        rather than copied."""
         try:
-            end_index = self.tokens.index(token)
-            return TokenSequence([copy.deepcopy(t) for t in self.tokens[end_index + 1:end_index + N + 1]])
+            end_index = self.index_of(token)
+            return TokenSequence(self[end_index + 1:end_index + N + 1])
         except ValueError:
             return None
 
 
+class CompactTokenSequence(TokenSequence):
+    """ A TokenSequence which splits text with the same tokenizer_re, but
+    only stores the start and end offsets of each token in two arrays
+    over the text.  Token objects are created as they are accessed,
+    so a document's tokens cost a few bytes each rather than a few
+    hundred.
+
+    It can be used anywhere a TokenSequence can be, such as by
+    setting Document.token_sequence_class.  Accessing .tokens creates
+    every Token at once, so prefer indexing and iterating.
+
+    It only ever splits text with tokenizer_re,  so it takes text rather
+    than a list of tokens,  and no tokenizer other than the default.
+    """
+    def __init__(self, text, tokenizer=None, start=0):
+        if hasattr(text, "__iter__"):
+            raise ValueError("CompactTokenSequence only tokenizes text, "
+                             "use a TokenSequence for a list of tokens")
+
+        if tokenizer is not None and \
+           getattr(tokenizer, "__func__", None) is not TokenSequence.tokenizer.__func__:
+            raise ValueError("CompactTokenSequence only splits text with tokenizer_re, "
+                             "use a TokenSequence for the tokenizer %r" % (tokenizer,))
+
+        self.text = text
+        self.offset = start
+
+        dtype = np.int32 if len(text) < 2 ** 31 else np.int64
+        offsets = self.token_offsets(text, start=start, dtype=dtype)
+
+        self._starts = offsets[:, 0].copy()
+        self._ends = offsets[:, 1].copy()
+
+
+    def _token(self, index):
+        start, end = int(self._starts[index]), int(self._ends[index])
+        pre_start = int(self._ends[index - 1]) if index > 0 else 0
+        post_end = int(self._starts[index + 1]) if index + 1 < len(self) else len(self.text)
+
+        return Token(self.text[start:end],
+                     self.text[pre_start:start],
+                     self.text[end:post_end],
+                     index,
+                     self.offset + start,
+                     self.offset + end)
+
+
+    @classmethod
+    def from_offsets(cls, text, starts, ends):
+        dtype = np.int32 if len(text) < 2 ** 31 else np.int64
+
+        seq = cls.__new__(cls)
+        seq.text = text
+        seq.offset = 0
+        seq._starts = np.asarray(starts, dtype=dtype)
+        seq._ends = np.asarray(ends, dtype=dtype)
+
+        return seq
+
+
+    @property
+    def tokens(self):
+        return list(self)
+
+
+    def bounds(self):
+        return (self._starts + self.offset, self._ends + self.offset)
+
+
+    def __str__(self):
+        covered = self.text[int(self._starts[0]):] if len(self) else ""
+        return covered.encode("string_escape")
+
+
+    def __len__(self):
+        return len(self._starts)
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._token(i) for i in xrange(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("token index out of range")
+
+        return self._token(index)
+
+
+    def __iter__(self):
+        return (self._token(i) for i in xrange(len(self)))
+
+
+    def index_of(self, token):
+        """Returns the index of the first token with the same start and
+        end as token,  raising ValueError if there isn't one."""
+        start, end = token.start - self.offset, token.end - self.offset
+        index = int(np.searchsorted(self._starts, start, side="left"))
+
+        while index < len(self) and self._starts[index] == start:
+            if self._ends[index] == end:
+                return index
+            index += 1
+
+        raise ValueError("{!r} is not in the token sequence".format(token))
+
+
+
 class Document(StandoffAnnotation):
+    token_sequence_class = TokenSequence
+
+    # A DocumentCache to load files through,  see i2b2tools.lib.cache
+    cache = None
+
+    # (starts,  ends) of the tokens,  when restored from a DocumentCache
+    _token_offsets = None
+
+    # attribute -> (PHI version,  labels,  values),  see token_labels
+    _token_labels = None
+
     def __init__(self, file_name=None, root="root"):
-        super(Document, self).__init__(file_name=file_name, root=root)
+        if file_name is None or self.cache is None:
+            super(Document, self).__init__(file_name=file_name, root=root)
+        else:
+            super(Document, self).__init__(root=root)
+            self.file_name = file_name
+            self.cache.fill(self)
 
     @property
     def token_sequence(self):
         if self._tokens == None:
-            self._tokens = TokenSequence(self.text, TokenSequence.tokenizer)
+            if self._token_offsets is not None:
+                self._tokens = self.token_sequence_class.from_offsets(self.text,
+                                                                      *self._token_offsets)
+            else:
+                self._tokens = self.token_sequence_class(self.text)
 
         return self._tokens
 
 
+    def token_labels(self, attribute="name"):
+        """Returns (labels,  values),  where labels is a numpy array with
+        an entry for each token of token_sequence: the index in values
+        of the attribute of the first PHI phi_within_range finds for
+        that token,  or -1 if there isn't one.  So a token is labelled
+        the same as phi_within_range(sa,  token.start,  token.end)[0]
+        would be.
+
+        The labels are kept until the PHI change,  as far as their
+        PHIList can tell (see phi_version).
+        """
+        phi_tags = phi_list(self)
+
+        if self._token_labels is None:
+            self._token_labels = {}
+
+        cached = self._token_labels.get(attribute)
+
+        if cached is not None and cached[0] == phi_tags.version:
+            return cached[1:]
+
+        starts, ends = self.token_sequence.bounds()
+
+        values = []
+        value_ids = {}
+        phi = []
+
+        for tag in phi_tags:
+            value = getattr(tag, attribute)
+            phi.append((tag.get_start(), tag.get_end(),
+                        value_ids.setdefault(value, len(value_ids))))
+
+            if len(values) < len(value_ids):
+                values.append(value)
+
+        phi = np.array(phi, dtype=np.int64).reshape(-1, 3)
+
+        # the tokens each PHI's start and end fall within,  as
+        # [lo,  hi) ranges of tokens,  usually just the one
+        lo = np.searchsorted(ends, phi[:, :2], side="left").ravel()
+        hi = np.searchsorted(starts, phi[:, :2], side="right").ravel()
+        lengths = np.maximum(hi - lo, 0)
+
+        # each (token,  position of a PHI in the list) pair
+        positions = np.repeat(np.arange(len(lo)) // 2, lengths)
+        tokens = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + \
+            np.arange(lengths.sum())
+
+        # the first PHI in the list wins
+        first = np.empty(len(starts), dtype=np.int64)
+        first.fill(len(phi))
+        np.minimum.at(first, tokens, positions)
+
+        labels = np.append(phi[:, 2], -1).astype(np.int32)[first]
+
+        self._token_labels[attribute] = (phi_tags.version, labels, values)
+
+        return (labels, values)
+
+
     def tag_to_token_sequence(self, tag):
         try:
             seq = TokenSequence(tag.text, start=int(tag.start))
             for token in seq:
                 try:
-                    token.index = self.token_sequence.tokens.index(token)
+                    token.index = self.token_sequence.index_of(token)
                 except ValueError:
                     token.index = None
             return seq
@@ -0,0 +1,285 @@
+from i2b2tools.lib.document_token import TokenSequence
+
+from bisect import bisect_left, bisect_right
+import collections
+
+# A PHI, or with token matching the part of one within a token, as
+# the evaluators report it. end is exclusive, as in sa.text[start:end].
+Span = collections.namedtuple("Span", ["start", "end", "TYPE", "name"])
+
+def phi_spans(sa):
+    """The Span of each of sa's PHI."""
+    return [Span(phi.get_start(), phi.get_end(), phi.TYPE, phi.name)
+            for phi in sa.get_phi()]
+
+def token_bounds(sa):
+    """The (starts, ends) of sa's tokens, as lists, leaving out empty
+    tokens."""
+    if hasattr(sa, "token_sequence"):
+        starts, ends = [bounds.tolist() for bounds in sa.token_sequence.bounds()]
+    else:
+        tokens = TokenSequence.tokenizer(sa.text)
+        starts = [token.start for token in tokens]
+        ends = [token.end for token in tokens]
+
+    kept = [i for i in range(len(starts)) if starts[i] < ends[i]]
+
+    return ([starts[i] for i in kept], [ends[i] for i in kept])
+
+def token_spans(sa, spans):
+    """Splits spans into a Span for each token they overlap, spanning
+    that token, keeping one of any which are the same."""
+    starts, ends = token_bounds(sa)
+    split = collections.OrderedDict()
+
+    for span in spans:
+        for i in xrange(bisect_right(ends, span.start), bisect_left(starts, span.end)):
+            token = Span(starts[i], ends[i], span.TYPE, span.name)
+            split.setdefault(token, token)
+
+    return split.keys()
+
+def span_label(span, attributes):
+    return tuple(getattr(span, attribute) for attribute in attributes)
+
+def align_strict(system, gold, attributes):
+    """Pairs up system and gold Spans with the same offsets and
+    attributes, each at most once, by merging them in sorted order.
+    Returns (tp, fp, fn), where tp holds the matched system Spans."""
+    def key(span):
+        return (span.start, span.end, span_label(span, attributes))
+
+    system = sorted(system, key=key)
+    gold = sorted(gold, key=key)
+    tp, fp, fn = [], [], []
+    i = j = 0
+
+    while i < len(system) and j < len(gold):
+        system_key, gold_key = key(system[i]), key(gold[j])
+
+        if system_key == gold_key:
+            tp.append(system[i])
+            i += 1
+            j += 1
+        elif system_key < gold_key:
+            fp.append(system[i])
+            i += 1
+        else:
+            fn.append(gold[j])
+            j += 1
+
+    fp.extend(system[i:])
+    fn.extend(gold[j:])
+
+    return (tp, fp, fn)
+
+class _ActiveEnds(object):
+    """A Fenwick tree over a fixed, sorted list of (end, position) keys,
+    some of which are active, answering the first active key whose end
+    is after some offset in O(log n)."""
+    def __init__(self, keys):
+        self.keys = keys
+        self.ends = [end for (end, _) in keys]
+        self.tree = [0] * (len(keys) + 1)
+        self.active = 0
+
+        # the largest power of two within the tree, to descend from
+        self.top = 1
+
+        while self.top * 2 <= len(keys):
+            self.top *= 2
+
+    def _add(self, rank, delta):
+        i = rank + 1
+        self.active += delta
+
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, rank):
+        """The number of active keys before rank."""
+        count = 0
+
+        while rank > 0:
+            count += self.tree[rank]
+            rank -= rank & -rank
+
+        return count
+
+    def add(self, rank):
+        self._add(rank, 1)
+
+    def pop_after(self, offset):
+        """Deactivates and returns the rank of the first active key whose
+        end is after offset, or returns None if there isn't one."""
+        wanted = self._prefix(bisect_right(self.ends, offset)) + 1
+
+        if wanted > self.active:
+            return None
+
+        # the smallest rank with wanted active keys up to it
+        i = 0
+        step = self.top
+
+        while step:
+            if i + step < len(self.tree) and self.tree[i + step] < wanted:
+                i += step
+                wanted -= self.tree[i]
+
+            step //= 2
+
+        self._add(i, -1)
+
+        return i
+
+def align_overlap(system, gold, attributes):
+    """Pairs up system and gold Spans with the same attributes which
+    overlap, each at most once, pairing as many as can be. System Spans
+    are taken in order of end, each paired with the overlapping gold
+    Span which ends first, in O(n log n). Returns (tp, fp, fn), where
+    tp holds the matched system Spans."""
+    by_label = collections.defaultdict(lambda: ([], []))
+
+    for span in system:
+        by_label[span_label(span, attributes)][0].append(span)
+
+    for span in gold:
+        by_label[span_label(span, attributes)][1].append(span)
+
+    tp, fp, fn = [], [], []
+
+    for (label, (system_spans, gold_spans)) in sorted(by_label.items()):
+        system_spans.sort(key=lambda span: (span.end, span.start))
+        gold_spans.sort()
+
+        # the unmatched gold Spans starting before the current system
+        # Span ends, by end
+        keys = sorted((span.end, j) for (j, span) in enumerate(gold_spans))
+        active = _ActiveEnds(keys)
+        rank = dict((j, r) for (r, (_, j)) in enumerate(keys))
+        matched = [False] * len(gold_spans)
+        j = 0
+
+        for span in system_spans:
+            while j < len(gold_spans) and gold_spans[j].start < span.end:
+                active.add(rank[j])
+                j += 1
+
+            # every active gold Span starts before this one ends, so the
+            # first ending after it starts overlaps it
+            found = active.pop_after(span.start)
+
+            if found is None:
+                fp.append(span)
+            else:
+                matched[keys[found][1]] = True
+                tp.append(span)
+
+        fn.extend(span for (k, span) in enumerate(gold_spans) if not matched[k])
+
+    return (tp, fp, fn)
+
+class SpanEvaluator(object):
+    """Scores system StandoffAnnotations against gold ones, given as
+    dictionaries (or Corpus objects) of id to StandoffAnnotation, by
+    aligning each document's PHI as (start, end, TYPE, name) Spans
+    sorted by offset, rather than comparing every pair:
+
+    e = SpanEvaluator(system_sas, gold_sas, match="overlap")
+    e.F_beta(e.micro_precision(), e.micro_recall())
+
+    match is "strict", where a system PHI has to have the same offsets
+    as a gold one, "overlap", where they only have to overlap, or
+    "token", where every token a PHI covers is scored on its own.
+    attributes are those of a Span which have to be the same as well,
+    such as ("name",) or () for none.
+
+    tp, fp and fn hold a list of Spans for each of doc_ids, so the
+    false positives and negatives of a document can be looked at
+    without evaluating it again. It can be passed as a PostProcessor's
+    evaluator, as can the OverlapEvaluator and TokenEvaluator classes,
+    which only change the default match.
+    """
+    match = "strict"
+    attributes = ("TYPE",)
+
+    aligners = {"strict": align_strict,
+                "overlap": align_overlap,
+                "token": align_strict}
+
+    def __init__(self, system_sas, gold_sas, match=None, attributes=None):
+        if match is not None:
+            self.match = match
+
+        if attributes is not None:
+            self.attributes = tuple(attributes)
+
+        if self.match not in self.aligners:
+            raise Exception("unknown match %r, not one of %s" % (
+                self.match, ", ".join(sorted(self.aligners))))
+
+        self.doc_ids = []
+        self.tp = []
+        self.fp = []
+        self.fn = []
+
+        for doc_id in sorted(set(system_sas.keys()) & set(gold_sas.keys())):
+            tp, fp, fn = self.align(system_sas[doc_id], gold_sas[doc_id])
+
+            self.doc_ids.append(doc_id)
+            self.tp.append(tp)
+            self.fp.append(fp)
+            self.fn.append(fn)
+
+    def align(self, sa, gold_sa):
+        """Returns the (tp, fp, fn) Spans of a single document."""
+        system, gold = phi_spans(sa), phi_spans(gold_sa)
+
+        if self.match == "token":
+            system, gold = token_spans(sa, system), token_spans(gold_sa, gold)
+
+        return self.aligners[self.match](system, gold, self.attributes)
+
+    def counts(self):
+        """The (tp, fp, fn) counts over every document."""
+        return (sum(len(tp) for tp in self.tp),
+                sum(len(fp) for fp in self.fp),
+                sum(len(fn) for fn in self.fn))
+
+    def micro_precision(self):
+        tp, fp, fn = self.counts()
+        return tp / float(tp + fp) if tp + fp else 0.0
+
+    def micro_recall(self):
+        tp, fp, fn = self.counts()
+        return tp / float(tp + fn) if tp + fn else 0.0
+
+    def F_beta(self, p, r, beta=1):
+        if not p and not r:
+            return 0.0
+
+        return (1 + beta ** 2) * p * r / (beta ** 2 * p + r)
+
+    def breakdown(self, attribute="TYPE"):
+        """Returns a dictionary of each value of a Span attribute, such as
+        TYPE or name, to the (tp, fp, fn) counts of the Spans with it."""
+        counts = collections.defaultdict(lambda: [0, 0, 0])
+
+        for (i, spans) in enumerate((self.tp, self.fp, self.fn)):
+            for document in spans:
+                for span in document:
+                    counts[getattr(span, attribute)][i] += 1
+
+        return dict((value, tuple(c)) for (value, c) in counts.items())
+
+    def errors(self, doc_id):
+        """The (fp, fn) Spans of a single document."""
+        i = self.doc_ids.index(doc_id)
+        return (self.fp[i], self.fn[i])
+
+class OverlapEvaluator(SpanEvaluator):
+    match = "overlap"
+
+class TokenEvaluator(SpanEvaluator):
+    match = "token"
@@ -0,0 +1,277 @@
+from i2b2tools.lib.document_token import Document
+from i2b2tools.lib.cache import tag_class, tag_class_name
+
+from lxml import etree
+import json
+import numpy as np
+import os
+
+PACKED_FORMAT = 1
+
+# columns of the PHI table
+DOC, START, END, TYPE, NAME, CLASS = range(6)
+
+def _decode(value):
+    """lxml gives back str for ASCII text and unicode otherwise, so do
+    the same."""
+    try:
+        value.decode("ascii")
+        return value
+    except UnicodeDecodeError:
+        return value.decode("utf-8")
+
+def _intern(table, value):
+    try:
+        return table.index(value)
+    except ValueError:
+        table.append(value)
+        return len(table) - 1
+
+def write_packed_corpus(sas, directory):
+    """Writes StandoffAnnotations, such as get_sa_from_dir or a Corpus
+    returns, to a packed corpus in directory, which PackedCorpus reads:
+
+    text.bin         the UTF-8 text of every document, one after another
+    text_offsets.npy where each document's text starts and ends in
+                     text.bin, len(documents) + 1 of them
+    phi.npy          a row for each PHI of (document, start, end,
+                     TYPE id, name id, tag class id), by document
+    phi_offsets.npy  where each document's rows start and end in phi.npy
+    meta.json        ids, file names, TYPEs, names and tag classes
+
+    Only the text and the start, end, TYPE, name and class of each PHI
+    are kept.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    doc_ids = sorted(sas.keys())
+    meta = {"format": PACKED_FORMAT, "doc_ids": doc_ids, "file_names": [],
+            "TYPEs": [], "names": [], "classes": []}
+
+    text_offsets = [0]
+    phi_offsets = [0]
+    phi = []
+
+    with open(os.path.join(directory, "text.bin"), "wb") as text_file:
+        for (i, doc_id) in enumerate(doc_ids):
+            sa = sas[doc_id]
+            text = (sa.text or "").encode("utf-8")
+
+            text_file.write(text)
+            text_offsets.append(text_offsets[-1] + len(text))
+            meta["file_names"].append(sa.file_name)
+
+            for tag in sa.get_phi():
+                cls = tag_class_name(tag.__class__)
+
+                # raises ValueError for a class PackedCorpus won't restore
+                tag_class(cls)
+
+                phi.append((i, tag.get_start(), tag.get_end(),
+                            _intern(meta["TYPEs"], tag.TYPE),
+                            _intern(meta["names"], tag.name),
+                            _intern(meta["classes"], cls)))
+
+            phi_offsets.append(len(phi))
+
+    np.save(os.path.join(directory, "text_offsets.npy"),
+            np.array(text_offsets, dtype=np.int64))
+    np.save(os.path.join(directory, "phi.npy"),
+            np.array(phi, dtype=np.int64).reshape(-1, 6))
+    np.save(os.path.join(directory, "phi_offsets.npy"),
+            np.array(phi_offsets, dtype=np.int64))
+
+    with open(os.path.join(directory, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+
+# packed corpora already opened by this process, by directory
+_opened = {}
+
+class PackedCorpus(object):
+    """A dictionary-like, read only view of a corpus written by
+    write_packed_corpus, in the format of:
+    {"id": <PackedDocument>}
+
+    Every array is memory-mapped rather than read, so opening even a
+    large corpus is quick, and worker processes reading the same corpus
+    share its pages. Documents are views which slice the arrays as
+    they're used.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(os.path.join(directory, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+
+        if meta["format"] != PACKED_FORMAT:
+            raise Exception("{} isn't a packed corpus this version can read.".format(directory))
+
+        # json gives back unicode, where lxml would give back str
+        self.doc_ids = [_decode(doc_id.encode("utf-8")) for doc_id in meta["doc_ids"]]
+        self.file_names = meta["file_names"]
+        self.TYPEs = [_decode(TYPE.encode("utf-8")) for TYPE in meta["TYPEs"]]
+        self.names = [_decode(name.encode("utf-8")) for name in meta["names"]]
+        self.class_names = meta["classes"]
+        self._classes = None
+
+        self.index = dict((doc_id, i) for (i, doc_id) in enumerate(self.doc_ids))
+
+        def load(name):
+            return np.load(os.path.join(directory, name), mmap_mode="r")
+
+        self.text_offsets = load("text_offsets.npy")
+        self.phi = load("phi.npy")
+        self.phi_offsets = load("phi_offsets.npy")
+
+        if self.text_offsets[-1]:
+            self.text_blob = np.memmap(os.path.join(directory, "text.bin"),
+                                       dtype=np.uint8, mode="r")
+        else:
+            # an empty file can't be mapped
+            self.text_blob = np.zeros(0, dtype=np.uint8)
+
+    @classmethod
+    def open(cls, directory):
+        """Returns the PackedCorpus for directory, opening it only once
+        in each process."""
+        key = os.path.abspath(directory)
+
+        if key not in _opened:
+            _opened[key] = cls(directory)
+
+        return _opened[key]
+
+    def __repr__(self):
+        return "<{}: {}, {} documents>".format(self.__class__.__name__,
+                                               self.directory,
+                                               len(self.doc_ids))
+
+    @property
+    def classes(self):
+        """The tag classes, looked up the first time PHI are created. Only
+        those of standoff_annotations.tags are, see tag_class."""
+        if self._classes is None:
+            self._classes = [tag_class(name) for name in self.class_names]
+
+        return self._classes
+
+    def text(self, i):
+        start, end = self.text_offsets[i], self.text_offsets[i + 1]
+
+        return _decode(self.text_blob[start:end].tostring())
+
+    def spans(self, i):
+        """The rows of the PHI table for the i-th document, a view rather
+        than a copy."""
+        return self.phi[self.phi_offsets[i]:self.phi_offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def __getitem__(self, doc_id):
+        return PackedDocument(self, self.index[doc_id])
+
+    def get(self, doc_id, default=None):
+        if doc_id in self:
+            return self[doc_id]
+
+        return default
+
+    def keys(self):
+        return list(self.doc_ids)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for doc_id in self:
+            yield self[doc_id]
+
+    def iteritems(self):
+        for doc_id in self:
+            yield (doc_id, self[doc_id])
+
+    values = itervalues
+    items = iteritems
+
+def _packed_document(directory, i, phi):
+    sa = PackedDocument(PackedCorpus.open(directory), i)
+
+    if phi is not None:
+        sa.phi = phi
+
+    return sa
+
+class PackedDocument(Document):
+    """A Document backed by a PackedCorpus. Its text and PHI are only
+    created from the corpus the first time they're used, after which
+    they can be changed like any other Document's.
+
+    spans is the document's rows of the PHI table, as written, without
+    creating any PHI.
+
+    Pickling a PackedDocument only sends the corpus directory and the
+    document's index, and its PHI if they were created, and it's opened
+    again on the other side, which is much cheaper when sending
+    documents to worker processes.
+    """
+    def __init__(self, corpus, i):
+        self.corpus = corpus
+        self.i = i
+
+        self.file_name = corpus.file_names[i]
+        self.raw = None
+        self.root = "deIdi2b2"
+        self._tokens = None
+
+    @property
+    def id(self):
+        return self.corpus.doc_ids[self.i]
+
+    @property
+    def spans(self):
+        return self.corpus.spans(self.i)
+
+    def __getattr__(self, name):
+        # only called when name hasn't been set yet
+        if name == "text":
+            self.text = self.corpus.text(self.i)
+            return self.text
+
+        if name == "phi":
+            self.phi = self._create_phi()
+            return self.phi
+
+        raise AttributeError(name)
+
+    def _create_phi(self):
+        corpus = self.corpus
+        text = self.text
+        phi = []
+
+        for (n, (_, start, end, TYPE, name, cls)) in enumerate(self.spans.tolist()):
+            el = etree.Element(corpus.names[name],
+                               attrib={"id": "P{}".format(n),
+                                       "start": str(start),
+                                       "end": str(end),
+                                       "text": text[start:end],
+                                       "TYPE": corpus.TYPEs[TYPE],
+                                       "comment": ""})
+
+            phi.append(corpus.classes[cls](el))
+
+        return phi
+
+    def get_phi(self):
+        return self.phi
+
+    def __reduce__(self):
+        return (_packed_document, (self.corpus.directory, self.i,
+                                   self.__dict__.get("phi")))
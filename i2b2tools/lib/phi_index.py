@@ -0,0 +1,315 @@
+from bisect import bisect_left, bisect_right
+import itertools
+
+class PHIIndex(object):
+    """A static index over the spans of a list of PHI, answering offset
+    and range queries in O(log n + k) rather than scanning every PHI.
+
+    PHI are ordered by start offset, and an implicit balanced tree over
+    that ordering records the largest end offset in each subtree so that
+    stabbing queries can skip whole subtrees. A second ordering by end
+    offset answers range queries on either endpoint.
+
+    Results are always returned in the order the PHI appear in the list
+    the index was built from, so they match a linear scan exactly.
+    """
+    def __init__(self, phi):
+        self.phi = list(phi)
+
+        spans = [(tag.get_start(), tag.get_end()) for tag in self.phi]
+
+        # sorted() is stable, so ties keep their list order
+        self._start_order = sorted(range(len(spans)), key=lambda i: spans[i][0])
+        self._starts = [spans[i][0] for i in self._start_order]
+        self._ends = [spans[i][1] for i in self._start_order]
+
+        self._end_order = sorted(range(len(spans)), key=lambda i: spans[i][1])
+        self._sorted_ends = [spans[i][1] for i in self._end_order]
+
+        self._max_end = [None] * len(spans)
+        self._build_max_end(0, len(spans))
+
+        self._has_overlap = None
+
+    def __len__(self):
+        return len(self.phi)
+
+    def _build_max_end(self, lo, hi):
+        """The subtree covering [lo, hi) is rooted at its midpoint, which
+        stores the largest end offset found in that subtree."""
+        if lo >= hi:
+            return float("-inf")
+
+        mid = (lo + hi) // 2
+        self._max_end[mid] = max(self._ends[mid],
+                                 self._build_max_end(lo, mid),
+                                 self._build_max_end(mid + 1, hi))
+
+        return self._max_end[mid]
+
+    def _tags(self, positions):
+        return [self.phi[i] for i in sorted(positions)]
+
+    def at_offset(self, offset):
+        """Returns the PHI where start <= offset <= end."""
+        found = []
+        stack = [(0, len(self._starts))]
+
+        while stack:
+            lo, hi = stack.pop()
+
+            if lo >= hi:
+                continue
+
+            mid = (lo + hi) // 2
+
+            # nothing in this subtree reaches the offset
+            if self._max_end[mid] < offset:
+                continue
+
+            stack.append((lo, mid))
+
+            # everything right of mid starts at or after mid
+            if self._starts[mid] <= offset:
+                if self._ends[mid] >= offset:
+                    found.append(self._start_order[mid])
+
+                stack.append((mid + 1, hi))
+
+        return self._tags(found)
+
+    def within_range(self, start, end):
+        """Returns the PHI with a start or an end offset within
+        [start, end]."""
+        found = set(self._start_order[bisect_left(self._starts, start):
+                                      bisect_right(self._starts, end)])
+        found.update(self._end_order[bisect_left(self._sorted_ends, start):
+                                     bisect_right(self._sorted_ends, end)])
+
+        return self._tags(found)
+
+    def contained_in(self, start, end):
+        """Returns the PHI where start <= PHI start and PHI end <= end."""
+        lo = bisect_left(self._starts, start)
+        hi = bisect_right(self._starts, end)
+
+        return self._tags(self._start_order[i] for i in range(lo, hi)
+                          if self._ends[i] <= end)
+
+    def has_overlap(self):
+        """Determines if any two PHI overlap."""
+        if self._has_overlap is None:
+            self._has_overlap = any(self._ends[i] > self._starts[i + 1]
+                                    for i in range(len(self._starts) - 1))
+
+        return self._has_overlap
+
+class _PrefixMax(object):
+    """A Fenwick tree over a fixed, sorted list of keys, answering the
+    largest value stored at a key <= some key in O(log n)."""
+    def __init__(self, keys):
+        self.keys = keys
+        self.tree = [float("-inf")] * (len(keys) + 1)
+
+    def update(self, key, value):
+        i = bisect_left(self.keys, key) + 1
+
+        while i < len(self.tree):
+            self.tree[i] = max(self.tree[i], value)
+            i += i & -i
+
+    def query(self, key):
+        i = bisect_right(self.keys, key)
+        best = float("-inf")
+
+        while i > 0:
+            best = max(best, self.tree[i])
+            i -= i & -i
+
+        return best
+
+# versions of PHIList, unique across every list
+_versions = itertools.count(1)
+
+def _invalidating(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        self.invalidate()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+
+    return wrapper
+
+class PHIList(list):
+    """A list of PHI which keeps a PHIIndex of itself, dropping it
+    whenever the list is altered so it is rebuilt on the next query.
+
+    Altering the start or end of a PHI already in the list can't be
+    observed, so whatever does so should call invalidate().
+
+    version changes whenever the index is dropped, and is never the
+    same for two lists, so anything else worked out from the PHI can
+    be kept until it changes (see phi_version).
+    """
+    _index = None
+
+    def __init__(self, *args):
+        super(PHIList, self).__init__(*args)
+        self.version = next(_versions)
+
+    def get_index(self):
+        if self._index is None:
+            self._index = PHIIndex(self)
+
+        return self._index
+
+    def invalidate(self):
+        self._index = None
+        self.version = next(_versions)
+
+    def __reduce__(self):
+        # the index is cheap to rebuild, don't pickle it
+        return (PHIList, (list(self),))
+
+for _name in ("append", "extend", "insert", "remove", "pop", "sort",
+              "reverse", "__setitem__", "__delitem__", "__setslice__",
+              "__delslice__", "__iadd__", "__imul__"):
+    if hasattr(list, _name):
+        setattr(PHIList, _name, _invalidating(_name))
+
+# Counts calls to phi_index while a rule is being profiled, see
+# lib.rules.profiling, and is None otherwise.
+lookup_count = None
+
+def count_lookups():
+    """Starts counting calls to phi_index."""
+    global lookup_count
+    lookup_count = 0
+
+def counted_lookups():
+    """Stops counting calls to phi_index, returning how many there were."""
+    global lookup_count
+    count, lookup_count = lookup_count, None
+
+    return count
+
+def phi_index(sa):
+    """Returns the PHIIndex of a StandoffAnnotation, swapping its phi
+    list for a PHIList the first time so later appends and removals
+    are tracked.
+    """
+    global lookup_count
+
+    if lookup_count is not None:
+        lookup_count += 1
+
+    return phi_list(sa).get_index()
+
+def phi_list(sa):
+    """Returns sa.phi, swapped for a PHIList the first time so later
+    appends and removals are tracked."""
+    if not isinstance(sa.phi, PHIList):
+        sa.phi = PHIList(sa.phi)
+
+    return sa.phi
+
+def phi_version(sa):
+    """A number which changes whenever the PHI of a StandoffAnnotation
+    do, as far as its PHIList can tell."""
+    return phi_list(sa).version
+
+class PHIBatch(object):
+    """Collects additions, removals and trims to the PHI of a
+    StandoffAnnotation, and commits them all at once in O(n log n),
+    rather than altering sa.phi an element at a time:
+
+    with PHIBatch(sa) as batch:
+        batch.remove(phi)
+        batch.add(tag, replace_contained=True)
+        batch.trim(other_phi, end=10)
+
+    On commit, whatever the order they were recorded in:
+    - removed PHI are dropped, including PHI added in the same batch.
+    - each added PHI is appended in the order added. An addition with
+      replace_contained first removes every PHI lying within it,
+      including earlier additions, as if they'd been appended one at
+      a time.
+    - trims are applied, in the order recorded, to the PHI that remain.
+
+    Entering a batch which is already open doesn't commit it on exit,
+    so a rule's actions can share the batch its apply opened.
+    """
+    def __init__(self, sa):
+        self.sa = sa
+        self.additions = []
+        self.removals = []
+        self.trims = []
+        self._depth = 0
+
+    def __enter__(self):
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+
+        if exc_type is None and self._depth == 0:
+            self.commit()
+
+    def add(self, tag, replace_contained=False):
+        self.additions.append((tag, replace_contained))
+
+    def remove(self, tag):
+        """Removes this very tag, rather than the first one equal to it."""
+        self.removals.append(tag)
+
+    def trim(self, tag, start=None, end=None):
+        """Sets new start and/or end offsets on tag."""
+        self.trims.append((tag, start, end))
+
+    def commit(self):
+        removed = set(id(tag) for tag in self.removals)
+        additions = [(tag, replaces) for (tag, replaces) in self.additions
+                     if id(tag) not in removed]
+
+        # An addition survives if no later replacing addition contains
+        # it, and an existing PHI if no replacing addition does.
+        covering = _PrefixMax(sorted(set(tag.get_start()
+                                         for (tag, replaces) in additions
+                                         if replaces)))
+
+        def covered(tag):
+            return bool(covering.keys) and \
+                covering.query(tag.get_start()) >= tag.get_end()
+
+        kept = []
+
+        for (tag, replaces) in reversed(additions):
+            if not covered(tag):
+                kept.append(tag)
+
+            if replaces:
+                covering.update(tag.get_start(), tag.get_end())
+
+        kept.reverse()
+
+        phi = [tag for tag in self.sa.phi
+               if id(tag) not in removed and not covered(tag)] + kept
+        remaining = set(id(tag) for tag in phi)
+
+        for (tag, start, end) in self.trims:
+            if id(tag) in remaining:
+                if start is not None:
+                    tag.start = str(start)
+                if end is not None:
+                    tag.end = str(end)
+
+        self.sa.phi[:] = phi
+
+        if self.trims and isinstance(self.sa.phi, PHIList):
+            self.sa.phi.invalidate()
+
+        self.additions, self.removals, self.trims = [], [], []
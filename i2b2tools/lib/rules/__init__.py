@@ -1,3 +1,7 @@
+from gazetteer import *
 from postprocessors import *
+from ablation import *
+from profiling import *
+from significance import *
 from predicates import *
 from rules import *
@@ -0,0 +1,319 @@
+from i2b2tools.lib.standoff_annotations import EvaluatePHI
+from i2b2tools.lib.rules import postprocessors
+from i2b2tools.lib.rules.postprocessors import phi_key, document_counts, micro_score
+
+from collections import OrderedDict
+import copy
+import itertools
+import multiprocessing
+
+def with_phi(sa, phi):
+    """A shallow copy of sa with phi as its PHI, leaving sa as it is."""
+    sa = copy.copy(sa)
+    sa.phi = list(phi)
+
+    return sa
+
+def copied_phi(sa):
+    """A copy of sa with copies of its PHI, as rules may trim PHI in
+    place."""
+    return with_phi(sa, [copy.copy(phi) for phi in sa.get_phi()])
+
+def apply_rules(sa, processors, subset):
+    """The PHI left once the rules in subset, a sorted sequence of their
+    positions in processors, are applied in turn to a copy of sa, as a
+    PostProcessor with only those rules would."""
+    sa = copied_phi(sa)
+
+    for i in subset:
+        rule, args = processors[i]
+        rule(*([sa] + args)).apply()
+
+    return sa.get_phi()
+
+def rule_deltas(job):
+    """Applies each (rule, args) on its own to a fresh copy of a single
+    document, returning (doc_id, deltas, interacting), where each delta
+    is the (removed, added) of a rule: the phi_key of each of the
+    document's PHI it removed or changed, and the (phi_key, PHI) of
+    those it added or changed them to.
+
+    The rules are then applied in turn, as a PostProcessor would, and
+    interacting is whether any rule did something other than its delta
+    there, having seen what the rules before it did.
+
+    job is (doc_id, sa, processors), with processors None in a worker
+    process which was handed them already (see
+    postprocessors._init_worker). sa isn't changed.
+    """
+    (doc_id, sa, processors) = job
+
+    if processors is None:
+        processors = postprocessors._worker_processors
+
+    before = dict((phi_key(phi), phi) for phi in sa.get_phi())
+    deltas = []
+
+    for (rule, args) in processors:
+        candidate = copied_phi(sa)
+        rule(*([candidate] + args)).apply()
+
+        after = OrderedDict((phi_key(phi), phi) for phi in candidate.get_phi())
+
+        deltas.append((frozenset(key for key in before if key not in after),
+                       [(key, phi) for (key, phi) in after.iteritems() if key not in before]))
+
+    candidate = copied_phi(sa)
+    current = set(before)
+    interacting = False
+
+    for ((rule, args), (removed, added)) in zip(processors, deltas):
+        rule(*([candidate] + args)).apply()
+
+        expected = (current - removed) | set(key for (key, phi) in added)
+        current = set(phi_key(phi) for phi in candidate.get_phi())
+
+        if current != expected:
+            interacting = True
+            break
+
+    return (doc_id, deltas, interacting)
+
+def compose_deltas(keyed_phi, deltas, subset):
+    """The PHI left once the deltas of the rules in subset, a sorted
+    sequence of their positions, are applied in turn to keyed_phi, a
+    list of (phi_key, PHI)."""
+    current = OrderedDict(keyed_phi)
+
+    for i in subset:
+        removed, added = deltas[i]
+
+        for key in removed:
+            current.pop(key, None)
+
+        current.update(added)
+
+    return current.values()
+
+def subset_counts(job):
+    """Evaluates a single document with the rules of each of subsets
+    applied, returning (doc_id, counts) with the evaluation_counts of
+    each subset. The rules are applied from its cached deltas, or, if
+    deltas is None as its rules interact, in turn.
+
+    job is (doc_id, sa, gold_sa, deltas, subsets, evaluator, cache,
+    processors), where cache is passed on to document_counts, so
+    subsets which leave a document's PHI the same are only evaluated
+    once, and processors is as for rule_deltas.
+    """
+    (doc_id, sa, gold_sa, deltas, subsets, evaluator, cache, processors) = job
+
+    if cache is None:
+        cache = {}
+
+    if processors is None:
+        processors = postprocessors._worker_processors
+
+    keyed_phi = [(phi_key(phi), phi) for phi in sa.get_phi()]
+    counts = []
+
+    for subset in subsets:
+        if deltas is None:
+            composed = with_phi(sa, apply_rules(sa, processors, subset))
+        else:
+            composed = with_phi(sa, compose_deltas(keyed_phi, deltas, subset))
+
+        counts.append(document_counts(evaluator, doc_id, composed, gold_sa, cache))
+
+    return (doc_id, counts)
+
+class RuleAblation(object):
+    """Works out how much each (rule, args) of a list of processors adds
+    to the score, without running a PostProcessor for every rule set:
+
+    a = RuleAblation(system_sas, gold_sas, processors, workers=None)
+    a.leave_one_out()       # the score without each rule
+    a.add_one_in()          # the score with only each rule
+    a.forward_selection()   # rules picked greedily, best first
+    a.summary()
+
+    Each rule is applied once to each document on its own, and what it
+    removed and added is kept. The score of any set of the rules is
+    then worked out by applying those changes in the order of
+    processors, and evaluating the result. This only holds while no
+    rule depends on the changes of the rules before it, which even
+    regex rules do once they tag or remove the same text: a RegexRule
+    skips text an earlier one tagged, and a RemoveRegexRule removes
+    what an earlier RegexRule added. So every rule is also applied in
+    turn to each document, and on the documents in interacting, where
+    a rule did anything other than it did on its own, each set of
+    rules is applied in turn as a PostProcessor would. full_score is
+    then always that of a PostProcessor, as is the score of any other
+    set of rules unless its rules interact on a document where every
+    rule together doesn't show it.
+
+    Documents are spread over a pool of worker processes (None
+    meaning one per CPU), or processed in this process with workers=1,
+    when count_cache is used as in PostProcessor. Scores are the micro
+    F1 over the documents with a gold document, of the counts evaluator
+    finds as in PostProcessor, and are kept, so later calls only score
+    new rule sets.
+    """
+    def __init__(self, system_sas, gold_sas, processors, evaluator=EvaluatePHI,
+                 count_cache=None, workers=1):
+        self.system_sas = system_sas
+        self.gold_sas = gold_sas
+        self.processors = list(processors)
+        self.evaluator = evaluator
+        self.count_cache = count_cache
+        self.workers = workers
+
+        self.doc_ids = [doc_id for doc_id in system_sas.keys() if doc_id in gold_sas]
+        self.deltas = None
+        self.interacting = None
+        self.scores = {}
+
+    def _map(self, function, jobs):
+        """Yields function of each job, in no particular order."""
+        if self.workers == 1:
+            for result in itertools.imap(function, jobs(self.processors, self.count_cache)):
+                yield result
+            return
+
+        pool = multiprocessing.Pool(self.workers, postprocessors._init_worker,
+                                    (self.processors,))
+        window = 8 * (self.workers or multiprocessing.cpu_count())
+        jobs = jobs(None, None)
+
+        try:
+            while True:
+                batch = list(itertools.islice(jobs, window))
+
+                if not batch:
+                    break
+
+                for result in pool.imap_unordered(function, batch):
+                    yield result
+        finally:
+            pool.terminate()
+
+    def compute_deltas(self):
+        """Applies each rule to each document on its own, once."""
+        if self.deltas is not None:
+            return
+
+        def jobs(processors, cache):
+            for doc_id in self.doc_ids:
+                yield (doc_id, self.system_sas[doc_id], processors)
+
+        self.deltas = {}
+        self.interacting = set()
+
+        for (doc_id, deltas, interacting) in self._map(rule_deltas, jobs):
+            self.deltas[doc_id] = None if interacting else deltas
+
+            if interacting:
+                self.interacting.add(doc_id)
+
+    def score_subsets(self, subsets):
+        """Returns the score of each of subsets, each a sequence of the
+        positions in processors of the rules to apply."""
+        subsets = [tuple(sorted(subset)) for subset in subsets]
+        new = sorted(set(subset for subset in subsets if subset not in self.scores))
+
+        if new:
+            self.compute_deltas()
+
+            def jobs(processors, cache):
+                for doc_id in self.doc_ids:
+                    yield (doc_id, self.system_sas[doc_id], self.gold_sas[doc_id],
+                           self.deltas[doc_id], new, self.evaluator, cache, processors)
+
+            counts = [[] for _ in new]
+
+            for (doc_id, doc_counts) in self._map(subset_counts, jobs):
+                for (i, c) in enumerate(doc_counts):
+                    counts[i].append(c)
+
+            for (subset, c) in zip(new, counts):
+                self.scores[subset] = micro_score(c)
+
+        return [self.scores[subset] for subset in subsets]
+
+    def _every(self):
+        return range(len(self.processors))
+
+    def baseline_score(self):
+        """The score without any of the rules."""
+        return self.score_subsets([()])[0]
+
+    def full_score(self):
+        """The score with every rule."""
+        return self.score_subsets([self._every()])[0]
+
+    def leave_one_out(self):
+        """Returns (rule, args, score, contribution) for each of the
+        processors, where score is that of every other rule, and
+        contribution how much lower it is than with every rule."""
+        every = self._every()
+        scores = self.score_subsets([every] +
+                                    [[j for j in every if j != i] for i in every])
+
+        return [(rule, args, score, scores[0] - score)
+                for ((rule, args), score) in zip(self.processors, scores[1:])]
+
+    def add_one_in(self):
+        """Returns (rule, args, score, contribution) for each of the
+        processors, where score is that of the rule on its own, and
+        contribution how much higher it is than without any rules."""
+        scores = self.score_subsets([()] + [[i] for i in self._every()])
+
+        return [(rule, args, score, score - scores[0])
+                for ((rule, args), score) in zip(self.processors, scores[1:])]
+
+    def forward_selection(self, max_rules=None, min_gain=0.0):
+        """Picks rules greedily: each step adds the rule which raises the
+        score of those picked so far the most, until none raises it by
+        more than min_gain, or max_rules are picked. Returns (rule,
+        args, score, gain) for each rule picked, in the order picked.
+        The picked rules are still applied in the order of
+        processors."""
+        picked = []
+        score = self.baseline_score()
+        selection = []
+
+        while max_rules is None or len(picked) < max_rules:
+            remaining = [i for i in self._every() if i not in picked]
+
+            if not remaining:
+                break
+
+            scores = self.score_subsets([picked + [i] for i in remaining])
+            best_score, best = max(zip(scores, remaining),
+                                   key=lambda (s, i): (s, -i))
+
+            if best_score - score <= min_gain:
+                break
+
+            rule, args = self.processors[best]
+            selection.append((rule, args, best_score, best_score - score))
+            picked.append(best)
+            score = best_score
+
+        return selection
+
+    def summary(self):
+        print "%.4f without any rules, %.4f with every rule" % (self.baseline_score(),
+                                                                self.full_score())
+
+        print "leave one out:"
+        for (rule, args, score, contribution) in self.leave_one_out():
+            print "  %+.4f  %.4f  %s %r" % (contribution, score, rule.__name__, args)
+
+        print "add one in:"
+        for (rule, args, score, contribution) in self.add_one_in():
+            print "  %+.4f  %.4f  %s %r" % (contribution, score, rule.__name__, args)
+
+        print "forward selection:"
+        for (rule, args, score, gain) in self.forward_selection():
+            print "  %+.4f  %.4f  %s %r" % (gain, score, rule.__name__, args)
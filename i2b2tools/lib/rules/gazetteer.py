@@ -0,0 +1,145 @@
+import re
+
+# the tokenizer's word characters, see TokenSequence.tokenizer_re
+_word_char = re.compile(r"\w")
+
+class Gazetteer(object):
+    """An Aho-Corasick automaton over a list of terms, which finds every
+    occurrence of every term in a text in one pass over it, however
+    many terms there are:
+
+    hospitals = Gazetteer(["Brigham and Women's", "Mass General"], "HOSPITAL")
+    list(hospitals.find(text))   # (start, end, TYPE) of each occurrence
+
+    terms may also be a dictionary of term to TYPE, for terms of
+    several TYPEs. With ignore_case the terms and text are compared
+    lower cased. A term listed twice keeps the TYPE it was given last.
+    Every term needs a TYPE, so a list of terms needs TYPE to be given.
+
+    The automaton is built once, and is only lists, dictionaries and
+    strings, so it pickles and can be handed to worker processes along
+    with the rules using it.
+    """
+    def __init__(self, terms, TYPE=None, ignore_case=False):
+        if isinstance(terms, dict):
+            terms = terms.items()
+        else:
+            terms = [(term, TYPE) for term in terms]
+
+        for (term, TYPE) in terms:
+            if TYPE is None:
+                raise ValueError("the term %r has no TYPE, pass one for a list of terms" % term)
+
+        self.ignore_case = ignore_case
+
+        # per state: the next state for each character, the state to
+        # fall back to, the term ending there (or -1), and the nearest
+        # fallback state a term ends at (or 0)
+        self.goto = [{}]
+        self.fail = [0]
+        self.term = [-1]
+        self.output = [0]
+
+        # per term
+        self.lengths = []
+        self.types = []
+
+        for (term, TYPE) in terms:
+            self.add(term, TYPE)
+
+        self._link()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _fold(self, text):
+        return text.lower() if self.ignore_case else text
+
+    def add(self, term, TYPE):
+        if not term:
+            return
+
+        state = 0
+
+        for c in self._fold(term):
+            following = self.goto[state].get(c)
+
+            if following is None:
+                following = self.goto[state][c] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.term.append(-1)
+                self.output.append(0)
+
+            state = following
+
+        if self.term[state] < 0:
+            self.term[state] = len(self.lengths)
+            self.lengths.append(len(term))
+            self.types.append(TYPE)
+        else:
+            self.types[self.term[state]] = TYPE
+
+    def _link(self):
+        """Works out the fallback states breadth first, so a state's
+        fallback is always linked before its own."""
+        queue = list(self.goto[0].values())
+        i = 0
+
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+
+            for (c, following) in self.goto[state].iteritems():
+                queue.append(following)
+
+                fallback = self.fail[state]
+
+                while fallback and c not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+
+                fallback = self.goto[fallback].get(c, 0)
+                self.fail[following] = fallback
+                self.output[following] = fallback if self.term[fallback] >= 0 \
+                    else self.output[fallback]
+
+    def find(self, text):
+        """Yields (start, end, TYPE) for every occurrence of every term in
+        text, including those overlapping one another, in order of end
+        then of length, longest first."""
+        goto, fail, term, output = self.goto, self.fail, self.term, self.output
+        lengths, types = self.lengths, self.types
+        state = 0
+
+        for (i, c) in enumerate(self._fold(text)):
+            while state and c not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(c, 0)
+            found = state if term[state] >= 0 else output[state]
+
+            while found:
+                t = term[found]
+                yield (i + 1 - lengths[t], i + 1, types[t])
+                found = output[found]
+
+def on_token_boundaries(text, start, end):
+    """Whether text[start:end] neither starts nor ends partway through a
+    word, so it begins and ends where tokens do."""
+    return not ((start > 0 and _word_char.match(text[start - 1]) and
+                 _word_char.match(text[start])) or
+                (end < len(text) and _word_char.match(text[end]) and
+                 _word_char.match(text[end - 1])))
+
+def longest_matches(matches):
+    """Of (start, end, ...) matches, keeps the leftmost, then longest,
+    of those overlapping one another, in order of start."""
+    kept = []
+    last_end = None
+
+    for match in sorted(matches, key=lambda match: (match[0], -match[1])):
+        if last_end is None or match[0] >= last_end:
+            kept.append(match)
+            last_end = match[1]
+
+    return kept
@@ -1,6 +1,139 @@
 from i2b2tools.lib.standoff_annotations import EvaluatePHI
+from i2b2tools.lib.rules.profiling import profile_apply
+from i2b2tools.lib.rules.significance import paired_bootstrap, f_beta
+
+import itertools
+import multiprocessing
+
+def evaluation_counts(e):
+    """Returns the (true positive, false positive, false negative) counts
+    of an evaluator, summed over its documents."""
+    return (sum(len(tp) for tp in e.tp),
+            sum(len(fp) for fp in e.fp),
+            sum(len(fn) for fn in e.fn))
+
+def phi_key(phi):
+    """Everything about a single PHI."""
+    return (phi.__class__, tuple(sorted(vars(phi).items())))
+
+def phi_state(sa):
+    """Everything about a StandoffAnnotation's PHI, to tell if a rule
+    changed them."""
+    return tuple(phi_key(phi) for phi in sa.get_phi())
+
+def micro_score(counts, beta=1):
+    """Returns the micro F-beta of a list of per-document (tp, fp, fn)
+    counts."""
+    return float(f_beta([sum(c) for c in zip(*counts)] or (0, 0, 0), beta))
+
+def document_counts(evaluator, doc_id, sa, gold_sa, cache=None):
+    """Evaluates a single system document against its gold document,
+    returning its evaluation_counts.
+
+    cache, if given, is a dictionary of (doc_id, phi_state) to counts,
+    so a document whose PHI were evaluated before isn't evaluated again.
+    """
+    if cache is None:
+        return evaluation_counts(evaluator({doc_id: sa}, {doc_id: gold_sa}))
+
+    key = (doc_id, phi_state(sa))
+
+    try:
+        return cache[key]
+    except KeyError:
+        counts = cache[key] = evaluation_counts(evaluator({doc_id: sa},
+                                                          {doc_id: gold_sa}))
+        return counts
+    except TypeError:
+        # some PHI attribute isn't hashable
+        return evaluation_counts(evaluator({doc_id: sa}, {doc_id: gold_sa}))
+
+# the processors of a PostProcessor's worker process, see _init_worker
+_worker_processors = None
+
+def _init_worker(processors):
+    """Hands a worker process the processors once, so large rule
+    arguments such as a Gazetteer aren't pickled with every document."""
+    global _worker_processors
+    _worker_processors = processors
+
+def process_document(job):
+    """Applies every (rule, args) to a single document, keeping track of
+    its evaluation counts after each rule.
+
+    job is (doc_id, sa, gold_sa, processors, evaluator, counts, cache,
+    profile), where counts are the document's counts before processing
+    (None without a gold document), cache is passed on to
+    document_counts, and profile is whether to profile each rule. The
+    document is only evaluated again after a rule which changed its
+    PHI. processors is None in a worker process the PostProcessor
+    handed its processors to already.
+
+    Returns (doc_id, phi, rule_counts, profiles, cache): phi is the
+    document's new PHI, or None if the rules didn't change them,
+    rule_counts holds the counts after each rule, and profiles the
+    RuleProfile of each rule if profiling, or None. This runs in
+    PostProcessor's worker processes, so only the PHI which changed are
+    sent back, along with cache, which the PostProcessor hands a worker
+    empty so it holds only the counts worked out there.
+    """
+    (doc_id, sa, gold_sa, processors, evaluator, counts, cache, profile) = job
+    changed = False
+
+    if processors is None:
+        processors = _worker_processors
+
+    rule_counts = []
+    profiles = [] if profile else None
+
+    for (position, (rule, args)) in enumerate(processors):
+        before = phi_state(sa)
+
+        args_with_sa = [sa] + args
+
+        if profile:
+            profiles.append(profile_apply(rule(*args_with_sa), position, doc_id))
+        else:
+            rule(*args_with_sa).apply()
+
+        if phi_state(sa) != before:
+            changed = True
+
+            if gold_sa is not None:
+                counts = document_counts(evaluator, doc_id, sa, gold_sa, cache)
+
+        rule_counts.append(counts)
+
+    return (doc_id, list(sa.get_phi()) if changed else None, rule_counts,
+            profiles, cache)
 
 class PostProcessor(object):
+    """Applies each (rule, args) in processors to every system document,
+    scoring the system documents against the gold documents before and
+    after.
+
+    system_sas and gold_sas may be dictionaries or Corpus objects. Each
+    document is evaluated on its own and the counts are summed, so only
+    one document needs to be in memory at a time. Note that with a
+    Corpus the changes the rules make are lost once a document is
+    evicted, unless a rule saves it. Documents a Corpus can't load are
+    skipped, as get_sa_from_dir skips them.
+
+    Documents are only evaluated again when a rule changes their PHI.
+    Passing the same count_cache dictionary to several PostProcessors
+    over the same gold documents, such as when trying out rule sets,
+    also skips evaluating PHI any of them has evaluated before.
+
+    With a profiler, see lib.rules.profiling, every rule applied to
+    every document is timed and recorded in it.
+
+    evaluator is a class such as EvaluatePHI, or one of those in
+    lib.evaluation, which is only ever constructed as
+    evaluator({doc_id: sa}, {doc_id: gold_sa}) for a single document,
+    and then has tp, fp and fn attributes holding a list of true
+    positives, false positives and false negatives for each document.
+    Scores are the micro F1 of those counts summed over the documents.
+    """
     processors = []
     evaluator = EvaluatePHI
     system_sas = []
@@ -8,26 +141,157 @@ class PostProcessor(object):
     pre_evaluation_score = 0.0
     post_evaluation_score = 0.0
 
-    def __init__(self, system_sas, gold_sas, processors=[], evaluator=EvaluatePHI):
+    def __init__(self, system_sas, gold_sas, processors=[], evaluator=EvaluatePHI,
+                 count_cache=None, profiler=None):
         self.system_sas = system_sas
         self.gold_sas = gold_sas
-        self.processors += processors
+        # don't extend the class attribute in place, it's shared
+        self.processors = self.processors + processors
         self.evaluator = evaluator
+        self.count_cache = count_cache
+        self.profiler = profiler
 
-        e = self.evaluator(self.system_sas, self.gold_sas)
-        self.pre_evaluation_score = e.F_beta(e.micro_precision(),
-                                             e.micro_recall())
+        self.pre_counts = {}
+        self.post_counts = {}
+        self.rule_counts = []
 
-    def process(self):
-        for (rule, args) in self.processors:
-            for sa in self.system_sas.values():
-                args_with_sa = [sa] + args
-                rule(*args_with_sa).apply()
+        for doc_id in self.system_sas.keys():
+            if doc_id in self.gold_sas:
+                try:
+                    self.pre_counts[doc_id] = self.document_counts(doc_id,
+                                                                   self.system_sas[doc_id])
+                except KeyError:
+                    # a Corpus couldn't load it, and has dropped it
+                    continue
 
-        e = self.evaluator(self.system_sas, self.gold_sas)
-        self.post_evaluation_score = e.F_beta(e.micro_precision(),
-                                              e.micro_recall())
+        self.pre_evaluation_score = self.score(self.pre_counts.values())
+
+        # the counts of the documents as they are now, after any earlier
+        # process(), and the score they started the last one at
+        self.current_counts = dict(self.pre_counts)
+        self.start_evaluation_score = self.pre_evaluation_score
+
+    def document_counts(self, doc_id, sa):
+        """Evaluates a single system document against its gold document."""
+        return document_counts(self.evaluator, doc_id, sa,
+                               self.gold_sas[doc_id], self.count_cache)
+
+    def score(self, counts):
+        """Returns the micro F1 of a list of per-document
+        (tp, fp, fn) counts."""
+        return micro_score(counts)
+
+    def _jobs(self, doc_ids, cache, processors):
+        for doc_id in doc_ids:
+            try:
+                sa = self.system_sas[doc_id]
+                gold_sa = self.gold_sas[doc_id] if doc_id in self.current_counts else None
+            except KeyError:
+                # a Corpus couldn't load it
+                continue
+
+            yield (doc_id, sa, gold_sa,
+                   processors, self.evaluator,
+                   self.current_counts.get(doc_id), cache,
+                   self.profiler is not None)
+
+    def process(self, workers=1):
+        """Applies every rule to a document before moving on to the next
+        one. Rules only ever look at the document they're given, so this
+        is the same as applying each rule to every document in turn.
+
+        With workers other than 1, documents are sent to a pool of that
+        many processes (None meaning one per CPU) a few at a time, and
+        each document's changed PHI are copied back into system_sas.
+        Each document is scored on its own either way, so the scores
+        are the same. The rules and their arguments have to be
+        picklable, so module level functions and classes, and are sent
+        to each worker once. The workers don't see count_cache, but the
+        counts they work out are added to it, for later runs.
+
+        Processing again applies the rules to the documents as the last
+        run left them, so post_evaluation_score and rule_report() start
+        from there, while pre_evaluation_score stays the score before
+        any processing.
+        """
+        doc_ids = self.system_sas.keys()
+
+        self.start_evaluation_score = self.score(self.current_counts.values())
+        self.post_counts = dict(self.current_counts)
+        self.rule_counts = [(0, 0, 0) for _ in self.processors]
+
+        if self.profiler is not None:
+            self.profiler.start(self.processors)
+
+        if workers == 1:
+            jobs = self._jobs(doc_ids, self.count_cache, self.processors)
+            self._merge(itertools.imap(process_document, jobs))
+        else:
+            pool = multiprocessing.Pool(workers, _init_worker, (self.processors,))
+            # bounds how many documents are out of system_sas at once
+            window = 8 * (workers or multiprocessing.cpu_count())
+
+            try:
+                for i in range(0, len(doc_ids), window):
+                    jobs = self._jobs(doc_ids[i:i + window], self._worker_cache(), None)
+                    self._merge(pool.imap_unordered(process_document, jobs))
+            finally:
+                pool.terminate()
+
+        self.post_evaluation_score = self.score(self.post_counts.values())
+
+    def _worker_cache(self):
+        # pickled with each job, so every worker gets its own
+        return {} if self.count_cache is not None else None
+
+    def _merge(self, results):
+        for (doc_id, phi, rule_counts, profiles, cache) in results:
+            if phi is not None:
+                self.system_sas[doc_id].phi[:] = phi
+
+            if cache and cache is not self.count_cache:
+                self.count_cache.update(cache)
+
+            for profile in profiles or []:
+                self.profiler.record(profile)
+
+            if doc_id not in self.pre_counts:
+                continue
+
+            if rule_counts:
+                self.post_counts[doc_id] = self.current_counts[doc_id] = rule_counts[-1]
+
+            self.rule_counts = [tuple(map(sum, zip(total, counts)))
+                                for (total, counts) in zip(self.rule_counts, rule_counts)]
+
+    def rule_report(self):
+        """Returns (rule, args, score, change in score) for each of the
+        processors, where score is the micro F-beta once that rule and
+        the ones before it have been applied to every document in the
+        last process()."""
+        report = []
+        previous = self.start_evaluation_score
+
+        for ((rule, args), counts) in zip(self.processors, self.rule_counts):
+            score = self.score([counts])
+            report.append((rule, args, score, score - previous))
+            previous = score
+
+        return report
+
+    def significance(self, test=paired_bootstrap, **kwargs):
+        """Tests whether the change in score from processing is more than
+        chance, with a test from lib.rules.significance given the
+        per-document counts before and after, returning its
+        Significance:
+
+        p.significance(resamples=10000).p_value
+        """
+        return test(self.pre_counts, self.post_counts, **kwargs)
 
     def summary(self):
         print "%.2f -> %.2f" % (self.pre_evaluation_score,
                                 self.post_evaluation_score)
+
+        for (rule, args, score, delta) in self.rule_report():
+            print "  %+.4f  %.4f  %s %r" % (delta, score, rule.__name__, args)
@@ -1,4 +1,7 @@
 from i2b2tools.helpers.utils import phi_within_range
+from i2b2tools.lib.phi_index import phi_version
+
+import numpy as np
 
 # this is mostly to be used as an example predicate
 # it works with a MergeRule to say:
@@ -15,7 +18,110 @@ def _trigram_name_predicate(target, rule):
     token3 = phi_within_range(rule.sa, token3.start, token3.end)
 
     if token1 and not token2 and token3:
-        if token1.name == token3.name == rule.name:
+        if token1[0].name == token3[0].name == rule.name:
             return True
 
     return False
+
+# what each position of a PHIPattern can be, besides a PHI's attribute
+UNTAGGED = None
+ANY = "*"
+
+class PHIPattern(object):
+    """A merge predicate written as what each token of a window has to
+    be, rather than as a function. Each position is the attribute
+    (name by default) of the PHI the token has to be tagged with,
+    UNTAGGED, or ANY, with a token counting as tagged with the first
+    PHI phi_within_range finds for it, as in _trigram_name_predicate.
+    The same predicate as _trigram_name_predicate for NAME is:
+
+    MergeRule, [3, "NAME", "POET", NameTag, PHIPattern(["NAME", UNTAGGED, "NAME"])]
+
+    A pattern can be called like any other predicate, but a MergeRule
+    also uses it to find where it matches with numpy, comparing
+    Document.token_labels shifted once for each position, rather than
+    calling it on every window. The matches are worked out again after
+    each merge, so the merges are the same as calling it on every
+    window. MergeRule's n should be the length of the pattern.
+    """
+    def __init__(self, pattern, attribute="name"):
+        self.pattern = list(pattern)
+        self.attribute = attribute
+
+    def __repr__(self):
+        return "{}({!r}, {!r})".format(self.__class__.__name__, self.pattern,
+                                       self.attribute)
+
+    def __len__(self):
+        return len(self.pattern)
+
+    def _wanted(self, values):
+        """The label each position has to have, or None for ANY, or
+        returns None if the pattern can't match."""
+        value_ids = dict((value, i) for (i, value) in enumerate(values))
+        wanted = []
+
+        for value in self.pattern:
+            if value == ANY:
+                wanted.append(None)
+            elif value is UNTAGGED:
+                wanted.append(-1)
+            elif value in value_ids:
+                wanted.append(value_ids[value])
+            else:
+                return None
+
+        return wanted
+
+    def sites(self, sa):
+        """The index of the first token of every window of sa's tokens
+        the pattern matches, as a numpy array."""
+        labels, values = sa.token_labels(self.attribute)
+        n = len(self.pattern)
+        count = len(labels) - n + 1
+        wanted = self._wanted(values)
+
+        if count <= 0 or wanted is None:
+            return np.zeros(0, dtype=np.int64)
+
+        mask = np.ones(count, dtype=bool)
+
+        for (k, label) in enumerate(wanted):
+            if label is not None:
+                mask &= labels[k:k + count] == label
+
+        return np.flatnonzero(mask)
+
+    def windows(self, sa):
+        """Yields the windows of sa's tokens the pattern matches, in
+        order, finding them again whenever the PHI change."""
+        seq = sa.token_sequence
+        n = len(self.pattern)
+        version = None
+        i = 0
+
+        while True:
+            if phi_version(sa) != version:
+                version = phi_version(sa)
+                sites = self.sites(sa)
+
+            j = np.searchsorted(sites, i)
+
+            if j == len(sites):
+                return
+
+            i = int(sites[j])
+
+            yield tuple(seq[i:i + n])
+
+            i += 1
+
+    def __call__(self, target, rule):
+        labels, values = rule.sa.token_labels(self.attribute)
+        wanted = self._wanted(values)
+
+        if wanted is None or len(target) != len(wanted):
+            return False
+
+        return all(label is None or labels[token.index] == label
+                   for (token, label) in zip(target, wanted))
@@ -0,0 +1,171 @@
+from i2b2tools.lib.phi_index import count_lookups, counted_lookups
+
+import collections
+import timeit
+
+# One rule applied to one document. rule is the rule's position in the
+# PostProcessor's processors, and the times are in seconds: targets_time
+# includes consuming the targets if they're generated lazily, and
+# apply_time is the whole of apply, including committing a batch.
+RuleProfile = collections.namedtuple("RuleProfile", [
+    "rule", "name", "doc_id", "targets", "targets_time", "action_time",
+    "apply_time", "added", "removed", "lookups"])
+
+REPORT_FIELDS = ("targets", "targets_time", "action_time", "apply_time",
+                 "added", "removed", "lookups")
+
+def _timed_targets(targets, times):
+    """Wraps a rule's targets method, adding the time spent producing
+    targets to times["targets_time"] and counting them."""
+    def wrapper():
+        began = timeit.default_timer()
+        result = targets()
+        times["targets_time"] += timeit.default_timer() - began
+
+        if isinstance(result, (list, tuple)):
+            times["targets"] = len(result)
+            return result
+
+        return _timed_iter(result, times)
+
+    return wrapper
+
+def _timed_iter(targets, times):
+    iterator = iter(targets)
+
+    while True:
+        began = timeit.default_timer()
+
+        try:
+            target = next(iterator)
+        except StopIteration:
+            times["targets_time"] += timeit.default_timer() - began
+            return
+
+        times["targets_time"] += timeit.default_timer() - began
+        times["targets"] += 1
+
+        yield target
+
+def _timed_action(action, times):
+    def wrapper(target):
+        began = timeit.default_timer()
+
+        try:
+            return action(target)
+        finally:
+            times["action_time"] += timeit.default_timer() - began
+
+    return wrapper
+
+def profile_apply(rule, position=None, doc_id=None):
+    """Applies an instantiated rule to its document, the same as
+    rule.apply(), returning a RuleProfile of it.
+
+    The rule's targets and action are timed by wrapping them on this
+    instance only, so rules don't need to do anything to be profiled.
+    Index lookups are calls to phi_index, which every PHI query in
+    helpers.utils goes through.
+    """
+    times = {"targets": 0, "targets_time": 0.0, "action_time": 0.0}
+
+    # kept so no removed PHI's id is reused by an added one
+    before_phi = list(rule.sa.get_phi())
+    before = set(id(tag) for tag in before_phi)
+
+    rule.targets = _timed_targets(rule.targets, times)
+    rule.action = _timed_action(rule.action, times)
+
+    # profiles can't nest, rules don't apply other rules
+    count_lookups()
+    began = timeit.default_timer()
+
+    try:
+        rule.apply()
+    finally:
+        apply_time = timeit.default_timer() - began
+        lookups = counted_lookups()
+
+        del rule.targets, rule.action
+
+    after = set(id(tag) for tag in rule.sa.get_phi())
+
+    return RuleProfile(position, rule.__class__.__name__, doc_id,
+                       times["targets"], times["targets_time"],
+                       times["action_time"], apply_time,
+                       len(after - before), len(before - after), lookups)
+
+class Profiler(object):
+    """Collects the RuleProfile of every rule applied to every document
+    by a PostProcessor, when passed as its profiler:
+
+    profiler = Profiler()
+    profiler.subscribe(lambda profile: statsd.timing(profile.name, profile.apply_time))
+    PostProcessor(system_sas, gold_sas, processors, profiler=profiler).process()
+    profiler.summary()
+
+    Subscribers are called with each RuleProfile as it's recorded, in
+    this process, so they see the profiles of documents processed by
+    worker processes too. Without a profiler, PostProcessor applies
+    rules as usual, so profiling costs nothing when it's off.
+    """
+    def __init__(self, keep=True):
+        # keep=False only passes profiles on to subscribers
+        self.keep = keep
+        self.profiles = []
+        self.subscribers = []
+        self.processors = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def start(self, processors):
+        """Called by a PostProcessor before it processes any document."""
+        self.processors = list(processors)
+
+    def record(self, profile):
+        if self.keep:
+            self.profiles.append(profile)
+
+        for callback in self.subscribers:
+            callback(profile)
+
+    def report(self):
+        """Returns a dictionary for each of the processors, in order, of
+        its rule, args and the number of documents it was applied to,
+        along with each of REPORT_FIELDS summed over those documents."""
+        report = []
+
+        for (rule, args) in self.processors:
+            row = {"rule": rule, "args": args, "documents": 0}
+            row.update((field, 0) for field in REPORT_FIELDS)
+            report.append(row)
+
+        for profile in self.profiles:
+            row = report[profile.rule]
+            row["documents"] += 1
+
+            for field in REPORT_FIELDS:
+                row[field] += getattr(profile, field)
+
+        return report
+
+    def document_report(self, doc_id):
+        """Returns the RuleProfiles of a single document, in the order
+        its rules were applied."""
+        return [profile for profile in self.profiles if profile.doc_id == doc_id]
+
+    def summary(self):
+        print "%9s %9s %9s %8s %7s %7s %8s" % ("apply", "targets", "action",
+                                               "#targets", "added", "removed",
+                                               "lookups")
+
+        for row in self.report():
+            print "%8.3fs %8.3fs %8.3fs %8d %7d %7d %8d  %s %r" % (
+                row["apply_time"], row["targets_time"], row["action_time"],
+                row["targets"], row["added"], row["removed"], row["lookups"],
+                row["rule"].__name__, row["args"])
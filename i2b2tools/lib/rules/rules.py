@@ -1,15 +1,59 @@
-from i2b2tools.helpers.tokens import n_tokens
+from i2b2tools.helpers.tokens import iter_n_tokens, anchored_n_tokens
 from i2b2tools.helpers.utils import phi_within_range
+from i2b2tools.lib.phi_index import PHIBatch, phi_index
+from i2b2tools.lib.rules.gazetteer import on_token_boundaries, longest_matches
+from i2b2tools.lib.standoff_annotations.tags import NameTag, ProfessionTag, LocationTag, AgeTag, DateTag, ContactTag, IDTag, OtherTag
+from i2b2tools.converters.common import TYPE_name_mapping
 
 from lxml import etree
 import re
 
+# re's own cache only holds 100 patterns, fewer than a large rule set
+_compiled_regexes = {}
+
+def compile_regex(regex, flags=0):
+    """Compiles regex once, no matter how many documents it's used on."""
+    try:
+        return _compiled_regexes[(regex, flags)]
+    except KeyError:
+        compiled = _compiled_regexes[(regex, flags)] = re.compile(regex, flags)
+        return compiled
+
+# the tag class of each name in TYPE_name_mapping
+name_tag_classes = {
+    "NAME": NameTag,
+    "PROFESSION": ProfessionTag,
+    "LOCATION": LocationTag,
+    "AGE": AgeTag,
+    "DATE": DateTag,
+    "CONTACT": ContactTag,
+    "ID": IDTag,
+    "OTHER": OtherTag
+}
+
+def new_phi(sa, name, TYPE, tag_class, start, end):
+    """Creates a PHI tag of tag_class spanning [start, end] of sa.text."""
+    el = etree.Element(name,
+                       attrib={"start": str(start),
+                               "end": str(end),
+                               "TYPE": TYPE,
+                               "comment": "",
+                               "text": sa.text[int(start):int(end)]})
+
+    return tag_class(el)
+
 class Rule(object):
     """Each instance of a rule has a specific StandoffAnnotation
     which it references.
     """
     sa = None
 
+    # Whether apply should collect every action's changes in one
+    # PHIBatch, which only works if targets and actions don't look at
+    # the PHI the rule has already changed.
+    batched = False
+    batch = None
+
     def __init__(self, sa):
         self.sa = sa
 
@@ -23,10 +67,27 @@ class Rule(object):
         """
         pass
 
+    def changes(self):
+        """The PHIBatch an action should record its changes in, either the
+        one apply opened or a new one, committed once the action is done:
+
+        with self.changes() as batch:
+            batch.remove(phi)
+        """
+        return self.batch if self.batch is not None else PHIBatch(self.sa)
+
     def apply(self):
         """How a rule should act on a target."""
-        for target in self.targets():
-            self.action(target)
+        if not self.batched:
+            for target in self.targets():
+                self.action(target)
+            return
+
+        with PHIBatch(self.sa) as self.batch:
+            for target in self.targets():
+                self.action(target)
+
+        self.batch = None
 
 class RegexRule(Rule):
     """This takes a regular expression and what it should be deemed in
@@ -38,6 +99,8 @@ class RegexRule(Rule):
     regex that needs to be marked corresponds to a matching group in the
     regex.
     """
+    batched = True
+
     regex = None
     to_name = None
     to_type = None
@@ -57,33 +120,218 @@ class RegexRule(Rule):
         self.match_group = match_group
 
     def targets(self):
-        return re.findall(self.regex, self.sa.text, self.ignore_case)
+        """The (start, end) of the part of each match to mark as PHI, see
+        match_span."""
+        compiled = compile_regex(self.regex, self.ignore_case)
+
+        return [match_span(match, self.match_group)
+                for match in compiled.finditer(self.sa.text)]
 
     def action(self, target):
-        whole_match = target[0]
-        to_mark_as_phi = target[self.match_group]
+        start, end = target
+
+        # the match group didn't take part in this match
+        if start < 0:
+            return
+
+        with self.changes() as batch:
+            batch.add(new_phi(self.sa, self.to_name, self.to_type,
+                              self.tag_class, start, end),
+                      replace_contained=True)
+
+def match_span(match, match_group):
+    """Returns the (start, end) of the part of a match to mark as PHI.
+
+    match_group counts groups the way re.findall's tuples do, from 0
+    for the first group, so the default of 0 marks the first group. A
+    regex without groups marks the whole match.
+    """
+    return match.span(match_group + 1 if match.re.groups else 0)
+
+class RegexRuleSet(Rule):
+    """Applies many RegexRules to a StandoffAnnotation at once, each given
+    as the arguments a RegexRule takes after the StandoffAnnotation:
+    RegexRuleSet, [[("([Jj]ohn)", "NAME", "PERSON", NameTag),
+                    ("(\d{3}-\d{4})", "CONTACT", "PHONE", ContactTag)]]
+
+    The result is the same as applying each RegexRule in turn, but the
+    regexes are compiled once for every document, matches are located
+    by their offsets, and the PHI they replace are worked out and
+    removed in one pass over the PHI.
+
+    With combine, the regexes sharing the same flags are joined into
+    one alternation and the text is scanned once for all of them.
+    Matches then can't overlap one another, even across rules, where
+    the earliest (then the first listed) rule wins, so this is only the
+    same as applying each rule in turn when the rules don't match over
+    one another. Regexes with back references are still scanned alone.
+    """
+    batched = True
 
-        start = str(self.sa.text.index(whole_match) +
-                    whole_match.index(to_mark_as_phi))
-        end = str(int(start) + len(to_mark_as_phi))
+    rules = []
+    combine = False
 
-        to_delete = []
+    # (rules, combine) -> [(compiled regex, rule index or {group: rule index})]
+    _scans = {}
+
+    def __init__(self, sa, rules, combine=False):
+        super(RegexRuleSet, self).__init__(sa)
+
+        self.rules = [self._rule_args(*rule) for rule in rules]
+        self.combine = combine
+
+    @staticmethod
+    def _rule_args(regex, to_name, to_type, tag_class, ignore_case=0,
+                   match_group=0):
+        return (regex, to_name, to_type, tag_class,
+                re.IGNORECASE if ignore_case else 0, match_group)
+
+    def _scans_for_rules(self):
+        """Returns the regexes to scan the text with, each along with the
+        index of its rule, or for a combined regex a dictionary from the
+        outer group wrapping each rule's regex to that rule's index.
+        These are worked out once for every document."""
+        key = (tuple(self.rules), self.combine)
+
+        if key in RegexRuleSet._scans:
+            return RegexRuleSet._scans[key]
+
+        scans = []
+        by_flags = {}
+
+        for (i, (regex, _, _, _, flags, _)) in enumerate(self.rules):
+            if self.combine and not re.search(r"\\\d|\(\?P=", regex):
+                by_flags.setdefault(flags, []).append(i)
+            else:
+                scans.append((compile_regex(regex, flags), i))
+
+        for (flags, indices) in sorted(by_flags.items()):
+            alternatives = []
+            outer_groups = {}
+            group = 1
+
+            for i in indices:
+                alternatives.append("(%s)" % self.rules[i][0])
+                outer_groups[group] = i
+                group += 1 + compile_regex(self.rules[i][0], flags).groups
+
+            try:
+                scans.append((re.compile("|".join(alternatives), flags),
+                              outer_groups))
+            except re.error:
+                # e.g. the same group name in two regexes
+                scans.extend((compile_regex(self.rules[i][0], flags), i)
+                             for i in indices)
+
+        RegexRuleSet._scans[key] = scans
+
+        return scans
+
+    def targets(self):
+        """(start, end, rule index) for every match, in the order applying
+        each rule in turn would mark them."""
+        targets = []
 
-        for phi in self.sa.get_phi():
-            if int(phi.start) >= int(start) and int(phi.end) <= int(end):
-                to_delete.append(phi)
+        for (compiled, rule) in self._scans_for_rules():
+            for match in compiled.finditer(self.sa.text):
+                if isinstance(rule, dict):
+                    # the outer group of the matching alternative closes last
+                    outer = match.lastindex
+                    i = rule[outer]
+                    (regex, _, _, _, flags, match_group) = self.rules[i]
 
-        for phi in to_delete:
-            self.sa.phi.remove(phi)
+                    if compile_regex(regex, flags).groups:
+                        start, end = match.span(outer + match_group + 1)
+                    else:
+                        start, end = match.span(outer)
+                else:
+                    i = rule
+                    start, end = match_span(match, self.rules[i][5])
 
-        el = etree.Element(self.to_name,
-                           attrib={"start": start,
-                                   "end": end,
-                                   "TYPE": self.to_type,
-                                   "comment": "",
-                                   "text": self.sa.text[int(start):int(end)]})
+                if start >= 0:
+                    targets.append((i, start, end))
 
-        self.sa.phi.append(self.tag_class(el))
+        targets.sort()
+
+        return [(start, end, i) for (i, start, end) in targets]
+
+    def _new_phi(self, target):
+        start, end, i = target
+        (_, to_name, to_type, tag_class, _, _) = self.rules[i]
+
+        return new_phi(self.sa, to_name, to_type, tag_class, start, end)
+
+    def action(self, target):
+        with self.changes() as batch:
+            batch.add(self._new_phi(target), replace_contained=True)
+
+class GazetteerRule(Rule):
+    """Marks every occurrence of the terms of a gazetteer.Gazetteer, such
+    as a list of hospitals or a staff roster, as PHI of the TYPE the
+    term was given, named after its TYPE in mapping and of that name's
+    class in name_tag_classes (or tag_class):
+
+    hospitals = Gazetteer(["Brigham and Women's", "Mass General"], "HOSPITAL", True)
+    GazetteerRule, [hospitals]
+
+    The text is scanned once for all of the terms, rather than once for
+    each as with RegexRules. Build the Gazetteer once and pass it in
+    the rule's arguments, it isn't rebuilt for each document.
+
+    With token_boundaries, only occurrences which begin and end where
+    tokens do are marked. Of occurrences overlapping one another, the
+    leftmost, then longest, is marked, unless longest is False, when
+    they all are, including those within others. As with RegexRule,
+    the document's PHI within a term are replaced.
+    """
+    batched = True
+
+    gazetteer = None
+    token_boundaries = True
+    longest = True
+    mapping = TYPE_name_mapping
+    tag_class = None
+
+    def __init__(self, sa, gazetteer, token_boundaries=True, longest=True,
+                 mapping=TYPE_name_mapping, tag_class=None):
+        super(GazetteerRule, self).__init__(sa)
+
+        self.gazetteer = gazetteer
+        self.token_boundaries = token_boundaries
+        self.longest = longest
+        self.mapping = mapping
+        self.tag_class = tag_class
+
+    def targets(self):
+        """(start, end, TYPE) of each occurrence to mark, in order."""
+        text = self.sa.text
+        targets = self.gazetteer.find(text)
+
+        if self.token_boundaries:
+            targets = [(start, end, TYPE) for (start, end, TYPE) in targets
+                       if on_token_boundaries(text, start, end)]
+
+        if self.longest:
+            return longest_matches(targets)
+
+        return sorted(targets)
+
+    def action(self, target):
+        start, end, TYPE = target
+        name = self.mapping.get(TYPE, TYPE)
+        tag_class = self.tag_class or name_tag_classes.get(name, OtherTag)
+
+        tag = new_phi(self.sa, name, TYPE, tag_class, start, end)
+
+        with self.changes() as batch:
+            if self.longest:
+                batch.add(tag, replace_contained=True)
+            else:
+                # only the document's PHI, not the other occurrences
+                for phi in phi_index(self.sa).contained_in(start, end):
+                    batch.remove(phi)
+
+                batch.add(tag)
 
 class RemoveRegexRule(Rule):
     """
@@ -94,6 +342,8 @@ class RemoveRegexRule(Rule):
     trim it using a RemoveRegexRule as follows:
     RemoveRegexRule, ["\d{1,2}\/\d{1,2}(/\d{2,4})"], 0
     """
+    batched = True
+
     def __init__(self, sa, regex, trim_group=None, ignore_case=0):
         self.sa = sa
         self.regex = regex
@@ -120,16 +370,17 @@ class RemoveRegexRule(Rule):
         If there is no trim group however, just get rid of the PHI
         entirely.
         """
-        if self.trim_group is None:
-            self.sa.phi.remove(target)
-        else:
-            trim_group_text = re.match(self.regex, target.text).groups()
-            trim_group_text = trim_group_text[self.trim_group]
-
-            if target.text.startswith(trim_group_text):
-                target.start = str(int(target.start) + len(trim_group_text))
-            elif target.text.endswith(trim_group_text):
-                target.end = str(int(target.end) - len(trim_group_text))
+        with self.changes() as batch:
+            if self.trim_group is None:
+                batch.remove(target)
+            else:
+                trim_group_text = re.match(self.regex, target.text).groups()
+                trim_group_text = trim_group_text[self.trim_group]
+
+                if target.text.startswith(trim_group_text):
+                    batch.trim(target, start=int(target.start) + len(trim_group_text))
+                elif target.text.endswith(trim_group_text):
+                    batch.trim(target, end=int(target.end) - len(trim_group_text))
 
 class MergeRule(Rule):
     """This merges multiple PHI into one based on a predicate function.
@@ -142,14 +393,27 @@ class MergeRule(Rule):
 
     Using a merge rule such as:
     MergeRule, [3, "NAME", "POET", NameTag, _trigram_name_predicate]
+
+    Windows of n tokens are created as they're reached. With anchored,
+    only windows whose first or last token overlaps a PHI named name
+    are passed to the predicate, which is much quicker and gives the
+    same merges as long as the predicate never accepts any other
+    window, as _trigram_name_predicate doesn't:
+    MergeRule, [3, "NAME", "POET", NameTag, _trigram_name_predicate, True]
+
+    A predicate can also be a predicates.PHIPattern, whose matches are
+    found with numpy rather than by calling it on each window:
+    MergeRule, [3, "NAME", "POET", NameTag, PHIPattern(["NAME", UNTAGGED, "NAME"])]
     """
     n = 1
     name = None
     TYPE = None
     name_tag = None
     merge_predicate = None
+    anchored = False
 
-    def __init__(self, sa, n, name, TYPE, name_tag, merge_predicate):
+    def __init__(self, sa, n, name, TYPE, name_tag, merge_predicate,
+                 anchored=False):
         super(MergeRule, self).__init__(sa)
 
         self.n = n
@@ -157,9 +421,16 @@ class MergeRule(Rule):
         self.TYPE = TYPE
         self.name_tag = name_tag
         self.merge_predicate = merge_predicate
+        self.anchored = anchored
 
     def targets(self):
-        return n_tokens(self.sa.token_sequence, self.n)
+        if hasattr(self.merge_predicate, "windows"):
+            return self.merge_predicate.windows(self.sa)
+
+        if self.anchored:
+            return anchored_n_tokens(self.sa, self.n, self.name)
+
+        return iter_n_tokens(self.sa.token_sequence, self.n)
 
     def action(self, target):
         """This acts on a tuple of n tokens, and does nothing if it
@@ -172,14 +443,11 @@ class MergeRule(Rule):
 
         start, end = target[0].start, target[-1].end
 
-        for phi in phi_within_range(self.sa, start, end):
-            self.sa.phi.remove(phi)
-
-        el = etree.Element(self.name,
-                           attrib={"start": str(start),
-                                   "end": str(end),
-                                   "TYPE": self.TYPE,
-                                   "comment": "",
-                                   "text": self.sa.text[int(start):int(end)]})
+        # The predicate looks at the PHI as the earlier merges left them,
+        # so each merge is committed straight away, in one pass.
+        with self.changes() as batch:
+            for phi in phi_within_range(self.sa, start, end):
+                batch.remove(phi)
 
-        self.sa.phi.append(self.name_tag(el))
+            batch.add(new_phi(self.sa, self.name, self.TYPE,
+                              self.name_tag, start, end))
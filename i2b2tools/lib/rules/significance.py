@@ -0,0 +1,139 @@
+import collections
+import numpy as np
+
+# The result of a significance test of the change from before to after,
+# each the micro F-beta of the documents. low and high bound the
+# change with the test's confidence, or are None for a test which
+# doesn't give an interval.
+Significance = collections.namedtuple("Significance", [
+    "test", "before", "after", "difference", "p_value", "low", "high",
+    "resamples"])
+
+# the elements of a batch of resamples, bounding their memory
+BATCH_ELEMENTS = 2 ** 22
+
+# so a resample scoring exactly as observed counts as extreme, whatever
+# the rounding
+TOLERANCE = 1e-12
+
+def count_arrays(before, after):
+    """Returns the per-document (tp, fp, fn) counts of before and after,
+    dictionaries of doc_id to counts such as a PostProcessor's
+    pre_counts and post_counts, as two arrays of a row per document,
+    for the documents in both."""
+    doc_ids = sorted(set(before) & set(after))
+
+    return (np.array([before[doc_id] for doc_id in doc_ids], dtype=np.float64).reshape(-1, 3),
+            np.array([after[doc_id] for doc_id in doc_ids], dtype=np.float64).reshape(-1, 3))
+
+def f_beta(counts, beta=1):
+    """The micro F-beta of (tp, fp, fn) counts summed over documents,
+    for any number of them at once: counts is an array whose last
+    dimension is (tp, fp, fn), and the result has one F-beta less."""
+    counts = np.asarray(counts, dtype=np.float64)
+    tp, fp, fn = counts[..., 0], counts[..., 1], counts[..., 2]
+
+    numerator = (1 + beta ** 2) * tp
+    denominator = numerator + beta ** 2 * fn + fp
+
+    return np.where(numerator > 0, numerator / np.maximum(denominator, 1), 0.0)
+
+def _batches(resamples, documents):
+    size = max(1, BATCH_ELEMENTS // max(documents, 1))
+
+    for start in range(0, resamples, size):
+        yield min(size, resamples - start)
+
+# Drawing from raw random bytes is several times quicker than randint,
+# which dominates the time otherwise.
+
+def _draws(rng, shape, documents):
+    """An array of shape of random document indices. Taking them modulo
+    documents biases them by less than documents / 2 ** 32."""
+    count = int(np.prod(shape))
+    drawn = np.frombuffer(rng.bytes(4 * count), dtype=np.uint32) % np.uint32(documents)
+
+    return drawn.reshape(shape)
+
+def _coin_flips(rng, shape):
+    """An array of shape of random 0s and 1s."""
+    count = int(np.prod(shape))
+    flips = np.unpackbits(np.frombuffer(rng.bytes((count + 7) // 8), dtype=np.uint8))
+
+    return flips[:count].reshape(shape)
+
+def _p_value(extreme, resamples):
+    return (extreme + 1.0) / (resamples + 1.0)
+
+def paired_bootstrap(before, after, resamples=2000, beta=1, confidence=0.95,
+                     seed=None):
+    """Tests whether the change in micro F-beta from before to after,
+    dictionaries of doc_id to (tp, fp, fn) counts such as a
+    PostProcessor's pre_counts and post_counts, is more than chance
+    over which documents happened to be in the corpus.
+
+    Each resample draws the documents with replacement, the same
+    documents for before and after. low and high are the percentile
+    interval of the change over the resamples, and the p-value is how
+    often a resampled change is as far from the observed change as the
+    observed change is from none, that is, how often the change would
+    be at least as large if it were really none.
+    """
+    before, after = count_arrays(before, after)
+    documents = len(before)
+    rng = np.random.RandomState(seed)
+
+    difference = f_beta(after.sum(axis=0), beta) - f_beta(before.sum(axis=0), beta)
+    counts = np.hstack([before, after])
+    differences = []
+
+    for size in _batches(resamples, documents):
+        # how many times each document is drawn, as a row per resample
+        drawn = _draws(rng, (size, documents), documents) if documents else \
+            np.zeros((size, 0), dtype=np.uint32)
+        drawn += (np.arange(size, dtype=np.uint32) * documents)[:, np.newaxis]
+        weights = np.bincount(drawn.ravel(), minlength=size * documents)
+        weights = weights.reshape(size, documents).astype(np.float64)
+
+        sums = weights.dot(counts)
+        differences.append(f_beta(sums[:, 3:], beta) - f_beta(sums[:, :3], beta))
+
+    differences = np.concatenate(differences)
+    extreme = np.count_nonzero(np.abs(differences - difference) >=
+                               abs(difference) - TOLERANCE)
+    low, high = np.percentile(differences, [50 * (1 - confidence),
+                                            50 * (1 + confidence)])
+
+    return Significance("paired bootstrap", float(f_beta(before.sum(axis=0), beta)),
+                        float(f_beta(after.sum(axis=0), beta)), float(difference),
+                        _p_value(extreme, resamples), float(low), float(high),
+                        resamples)
+
+def approximate_randomization(before, after, resamples=2000, beta=1, seed=None):
+    """Tests whether the change in micro F-beta from before to after,
+    dictionaries of doc_id to (tp, fp, fn) counts, is more than chance,
+    by swapping each document's before and after counts at random and
+    counting how often the change is at least as large as observed.
+    This doesn't give an interval, so low and high are None.
+    """
+    before, after = count_arrays(before, after)
+    documents = len(before)
+    rng = np.random.RandomState(seed)
+
+    total_before, total_after = before.sum(axis=0), after.sum(axis=0)
+    difference = f_beta(total_after, beta) - f_beta(total_before, beta)
+    changes = after - before
+    extreme = 0
+
+    for size in _batches(resamples, documents):
+        swapped = _coin_flips(rng, (size, documents)).astype(np.float64)
+
+        # swapping a document moves its change from after to before
+        moved = swapped.dot(changes)
+        differences = f_beta(total_after - moved, beta) - f_beta(total_before + moved, beta)
+
+        extreme += np.count_nonzero(np.abs(differences) >= abs(difference) - TOLERANCE)
+
+    return Significance("approximate randomization", float(f_beta(total_before, beta)),
+                        float(f_beta(total_after, beta)), float(difference),
+                        _p_value(extreme, resamples), None, None, resamples)
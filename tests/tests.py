@@ -1,13 +1,33 @@
-import unittest, sys, os
+import unittest, sys, os, copy, json, marshal, pickle, shutil, tempfile
+from io import BytesIO
 sys.path.insert(0, "../")
 
-from i2b2tools.lib.standoff_annotations import StandoffAnnotation
-from i2b2tools.lib.standoff_annotations.tags import Tag
-from i2b2tools.lib.document_token import Document, Token
+from i2b2tools.lib.standoff_annotations import StandoffAnnotation, EvaluatePHI
+from i2b2tools.lib.standoff_annotations.tags import Tag, NameTag, DateTag, LocationTag
+from i2b2tools.lib.document_token import Document, Token, TokenSequence, CompactTokenSequence
+from i2b2tools.lib.phi_index import PHIList, PHIBatch, phi_index
+from i2b2tools.lib.corpus import Corpus, paired_documents
+from i2b2tools.lib.cache import DocumentCache
+from i2b2tools.lib.packed import PackedCorpus, PackedDocument, write_packed_corpus
+from i2b2tools.lib.rules.postprocessors import PostProcessor, evaluation_counts, micro_score
+from i2b2tools.lib.rules.significance import paired_bootstrap, approximate_randomization, f_beta
+from i2b2tools.lib import evaluation
+from i2b2tools.lib.evaluation import SpanEvaluator, OverlapEvaluator, TokenEvaluator, Span, align_overlap
+from i2b2tools.lib.rules.profiling import Profiler, profile_apply
+from i2b2tools.lib.rules.ablation import RuleAblation
+from i2b2tools.lib.rules.rules import Rule, RegexRule, RegexRuleSet, RemoveRegexRule, MergeRule, GazetteerRule, new_phi
+from i2b2tools.lib.rules.gazetteer import Gazetteer
+from i2b2tools.lib.rules.predicates import PHIPattern, UNTAGGED, ANY, _trigram_name_predicate
 
-from i2b2tools.helpers.utils import is_valid_sa_file, get_sa_from_dir, has_overlapping_phi, phi_at_offset, phi_within_range
-from i2b2tools.helpers.tokens import n_tokens, get_sa_tagged_tokens
+from i2b2tools.helpers.utils import is_valid_sa_file, iter_phi_records, load_sa_file, get_sa_from_dir, iter_sa_from_dir, has_overlapping_phi, phi_at_offset, phi_within_range
+from i2b2tools.helpers.tokens import n_tokens, iter_n_tokens, anchored_n_tokens, get_sa_tagged_tokens, get_sa_tagged_token_arrays
 from i2b2tools.helpers.mutable import sa_filter_by_phi_attrs
+from i2b2tools.converters.inline import standoff_to_inline, inline_to_standoff, stream_inline_to_standoff
+from i2b2tools.converters.mat import mat_json_to_standoff, convert_mat_batch
+from i2b2tools.converters.lbj import standoff_to_lbj, lbj_to_standoff_annotation, lbj_segments, stream_lbj_to_standoff
+
+from lxml import etree
+import numpy as np
 
 FIXTURES_PATH = "fixtures"
 
@@ -23,6 +43,38 @@ class TestIsValidSaFile(unittest.TestCase):
         self.assertFalse(is_valid_sa_file(os.path.join(FIXTURES_PATH, "invalid_sa_file2.xml")))
         self.assertFalse(is_valid_sa_file(os.path.join(FIXTURES_PATH, "invalid_sa_file3.xml")))
 
+    def test_stops_once_structure_is_confirmed(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, "truncated.xml")
+
+        try:
+            with open(filename, "w") as outfile:
+                outfile.write("<deIdi2b2><TEXT><![CDATA[Hi Jeff.]]></TEXT><TAGS><NAME ")
+
+            # the rest of the file is never read
+            self.assertTrue(is_valid_sa_file(filename))
+
+            # but it can't be loaded
+            self.assertIsNone(load_sa_file(filename))
+        finally:
+            shutil.rmtree(directory)
+
+class TestIterPhiRecords(unittest.TestCase):
+    def test_records(self):
+        records = list(iter_phi_records(os.path.join(FIXTURES_PATH, "no_overlap1.xml")))
+
+        self.assertEqual([record[:4] for record in records],
+                         [("NAME", 13, 17, "NAME"), ("DATE", 44, 53, "DATE")])
+        self.assertEqual(records[0][4]["text"], "Jeff")
+
+    def test_same_spans_as_phi(self):
+        filename = os.path.join(FIXTURES_PATH, "staple.xml")
+
+        self.assertEqual(sorted((name, start, end, TYPE)
+                                for (name, start, end, TYPE, _) in iter_phi_records(filename)),
+                         sorted((phi.name, phi.get_start(), phi.get_end(), phi.TYPE)
+                                for phi in StandoffAnnotation(filename).get_phi()))
+
 class TestGetSaFromDir(unittest.TestCase):
     def setUp(self):
         pass
@@ -42,6 +94,718 @@ class TestGetSaFromDir(unittest.TestCase):
             self.assertIsInstance(key, str)
             self.assertIsInstance(value, StandoffAnnotation)
 
+    def test_pools_load_the_same_files(self):
+        serial = get_sa_from_dir(FIXTURES_PATH)
+
+        for pool in ("thread", "process"):
+            sas = get_sa_from_dir(FIXTURES_PATH, workers=2, pool=pool)
+
+            self.assertEqual(sorted(sas.keys()), sorted(serial.keys()))
+
+            for (key, value) in sas.iteritems():
+                self.assertEqual(value.text, serial[key].text)
+                self.assertEqual(len(value.get_phi()), len(serial[key].get_phi()))
+
+    def test_progress(self):
+        reports = []
+
+        for _ in iter_sa_from_dir(FIXTURES_PATH,
+                                  progress=lambda *report: reports.append(report)):
+            pass
+
+        self.assertEqual([done for (done, total, rate) in reports],
+                         range(1, len(os.listdir(FIXTURES_PATH)) + 1))
+
+class TestCorpus(unittest.TestCase):
+    def setUp(self):
+        self.corpus = Corpus(FIXTURES_PATH, cache_size=2)
+
+    def test_same_documents_as_get_sa_from_dir(self):
+        sas = get_sa_from_dir(FIXTURES_PATH)
+
+        self.assertEqual(self.corpus.keys(), sorted(sas.keys()))
+
+        for (key, value) in self.corpus.iteritems():
+            self.assertEqual(value.text, sas[key].text)
+
+    def test_least_recently_used_are_evicted(self):
+        first, second, third = self.corpus.keys()[:3]
+
+        sa = self.corpus[first]
+        self.corpus[second]
+        self.assertIs(self.corpus[first], sa)
+
+        self.corpus[third]
+        self.corpus[second]
+        self.assertIsNot(self.corpus[first], sa)
+
+    def test_paired_documents(self):
+        sas = get_sa_from_dir(FIXTURES_PATH)
+        pairs = list(paired_documents(self.corpus, sas))
+
+        self.assertEqual([doc_id for (doc_id, system, gold) in pairs], sorted(sas.keys()))
+
+        for (doc_id, system, gold) in pairs:
+            self.assertIs(gold, sas[doc_id])
+
+    def test_truncated_file(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            shutil.copy(os.path.join(FIXTURES_PATH, "no_overlap1.xml"), directory)
+
+            with open(os.path.join(FIXTURES_PATH, "no_overlap1.xml")) as infile:
+                raw = infile.read()
+
+            # valid as far as is_valid_sa_file reads, but cut off after TAGS
+            truncated = os.path.join(directory, "truncated.xml")
+
+            with open(truncated, "w") as outfile:
+                outfile.write(raw[:raw.index("<TAGS>") + len("<TAGS>")] + "\n    <NAME id=")
+
+            self.assertTrue(is_valid_sa_file(truncated))
+
+            corpus = Corpus(directory)
+            self.assertEqual(corpus.keys(), ["no_overlap1", "truncated"])
+
+            with self.assertRaises(KeyError) as raised:
+                corpus["truncated"]
+
+            self.assertTrue(truncated in str(raised.exception))
+            self.assertFalse("truncated" in corpus)
+            self.assertEqual(corpus.keys(), ["no_overlap1"])
+            self.assertEqual([doc_id for (doc_id, sa) in corpus.iteritems()], ["no_overlap1"])
+
+            # skipped as get_sa_from_dir skips it, rather than scored as None
+            self.assertEqual(sorted(get_sa_from_dir(directory).keys()), ["no_overlap1"])
+            self.assertEqual([doc_id for (doc_id, system, gold)
+                              in paired_documents(Corpus(directory), Corpus(directory))],
+                             ["no_overlap1"])
+
+            for system_sas in (Corpus(directory), get_sa_from_dir(directory)):
+                p = PostProcessor(system_sas, Corpus(directory), [(RemoveRegexRule, ["Jeff"])])
+                p.process()
+
+                self.assertEqual(p.pre_counts.keys(), ["no_overlap1"])
+                self.assertEqual(p.post_counts.keys(), ["no_overlap1"])
+                self.assertEqual(p.pre_evaluation_score, 1.0)
+
+            # or without a gold document, first loaded by process()
+            PostProcessor(Corpus(directory), {}, [(RemoveRegexRule, ["Jeff"])]).process()
+        finally:
+            shutil.rmtree(directory)
+
+class ParseCountingDocument(Document):
+    parsed = 0
+
+    def parse_text_and_tags(self, text=None):
+        ParseCountingDocument.parsed += 1
+        return super(ParseCountingDocument, self).parse_text_and_tags(text)
+
+class TestDocumentCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = DocumentCache(self.directory, document_class=ParseCountingDocument)
+        ParseCountingDocument.parsed = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertSameDocument(self, sa, other_sa):
+        self.assertEqual(sa.text, other_sa.text)
+        self.assertEqual(sa.root, other_sa.root)
+        self.assertEqual([(phi.__class__, phi.name, phi.id, phi.start, phi.end, phi.text, phi.TYPE)
+                          for phi in sa.get_phi()],
+                         [(phi.__class__, phi.name, phi.id, phi.start, phi.end, phi.text, phi.TYPE)
+                          for phi in other_sa.get_phi()])
+        self.assertEqual([(t.token, t.pre_ws, t.post_ws, t.index, t.start, t.end)
+                          for t in sa.token_sequence],
+                         [(t.token, t.pre_ws, t.post_ws, t.index, t.start, t.end)
+                          for t in other_sa.token_sequence])
+
+    def test_cached_documents_are_not_parsed(self):
+        filename = os.path.join(FIXTURES_PATH, "staple.xml")
+
+        first = self.cache.load(filename)
+        second = self.cache.load(filename)
+
+        self.assertEqual(ParseCountingDocument.parsed, 1)
+        self.assertEqual(second.id, "staple")
+        self.assertSameDocument(second, Document(filename))
+        self.assertSameDocument(second, first)
+
+    def test_invalid_files(self):
+        self.assertIsNone(self.cache.load(os.path.join(FIXTURES_PATH, "invalid_sa_file1.xml")))
+        self.assertIsNone(self.cache.load(os.path.join(FIXTURES_PATH, "does_not_exist.xml")))
+
+    def test_get_sa_from_dir(self):
+        sas = get_sa_from_dir(FIXTURES_PATH)
+
+        for workers in (1, 2, 1):
+            cached = get_sa_from_dir(FIXTURES_PATH, workers=workers, cache=self.cache)
+
+            self.assertEqual(sorted(cached.keys()), sorted(sas.keys()))
+
+            for doc_id in sas:
+                self.assertEqual(cached[doc_id].text, sas[doc_id].text)
+                self.assertEqual(cached[doc_id].get_phi(), sas[doc_id].get_phi())
+
+    def test_document_cache_attribute(self):
+        class CachedDocument(ParseCountingDocument):
+            cache = self.cache
+
+        filename = os.path.join(FIXTURES_PATH, "no_overlap1.xml")
+
+        CachedDocument(filename)
+        document = CachedDocument(filename)
+
+        self.assertEqual(ParseCountingDocument.parsed, 1)
+        self.assertSameDocument(document, Document(filename))
+
+    def test_directory_permissions(self):
+        created = os.path.join(self.directory, "created")
+        DocumentCache(created)
+
+        self.assertFalse(os.stat(created).st_mode & 0o077)
+
+        shared = os.path.join(self.directory, "shared")
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+
+        self.assertRaises(ValueError, DocumentCache, shared)
+
+    def test_entries_only_restore_tag_classes(self):
+        filename = os.path.join(FIXTURES_PATH, "no_overlap1.xml")
+        self.cache.load(filename)
+
+        # an entry naming some other module is parsed again, not imported
+        path = self.cache.path(open(filename).read())
+        entry = marshal.load(open(path, "rb"))
+        entry["classes"] = ["os:getcwd" for _ in entry["classes"]]
+        marshal.dump(entry, open(path, "wb"))
+
+        self.assertSameDocument(self.cache.load(filename), Document(filename))
+        self.assertEqual(ParseCountingDocument.parsed, 2)
+
+    def test_least_recently_used_are_evicted(self):
+        filenames = [os.path.join(FIXTURES_PATH, name)
+                     for name in ("staple.xml", "no_overlap1.xml", "has_overlap1.xml",
+                                  "valid_sa_file1.xml")]
+
+        for filename in filenames[:3]:
+            self.cache.load(filename)
+
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        self.cache.max_bytes = sum(os.path.getsize(entry) for entry in entries)
+
+        # staple.xml was used longest ago
+        os.utime(self.cache.path(open(filenames[0]).read()), (0, 0))
+
+        self.cache.load(filenames[3])
+        ParseCountingDocument.parsed = 0
+
+        self.cache.load(filenames[3])
+        self.assertEqual(ParseCountingDocument.parsed, 0)
+
+        self.cache.load(filenames[0])
+        self.assertEqual(ParseCountingDocument.parsed, 1)
+
+class TestPackedCorpus(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sas = get_sa_from_dir(FIXTURES_PATH)
+
+        write_packed_corpus(self.sas, self.directory)
+        self.corpus = PackedCorpus(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertSamePHI(self, phi, other_phi):
+        self.assertEqual([(tag.__class__, tag.name, tag.get_start(), tag.get_end(), tag.TYPE)
+                          for tag in phi],
+                         [(tag.__class__, tag.name, tag.get_start(), tag.get_end(), tag.TYPE)
+                          for tag in other_phi])
+
+    def test_same_documents_as_get_sa_from_dir(self):
+        self.assertEqual(self.corpus.keys(), sorted(self.sas.keys()))
+
+        for (doc_id, sa) in self.corpus.items():
+            self.assertIsInstance(sa, Document)
+            self.assertEqual(sa.id, doc_id)
+            self.assertEqual(sa.text, self.sas[doc_id].text)
+            self.assertSamePHI(sa.get_phi(), self.sas[doc_id].get_phi())
+
+    def test_only_tag_classes(self):
+        meta_path = os.path.join(self.directory, "meta.json")
+        meta = json.load(open(meta_path))
+        meta["classes"] = ["os:getcwd" for _ in meta["classes"]]
+        json.dump(meta, open(meta_path, "w"))
+
+        self.assertRaises(ValueError, lambda: PackedCorpus(self.directory).classes)
+
+    def test_spans(self):
+        sa = self.corpus["no_overlap1"]
+        spans = sa.spans
+
+        self.assertEqual([(start, end) for (_, start, end, _, _, _) in spans.tolist()],
+                         [(13, 17), (44, 53)])
+        self.assertEqual([self.corpus.TYPEs[TYPE] for TYPE in spans[:, 3]], ["NAME", "DATE"])
+        self.assertEqual([self.corpus.names[name] for name in spans[:, 4]], ["NAME", "DATE"])
+
+    def test_helpers_work_on_views(self):
+        self.assertTrue(has_overlapping_phi(self.corpus["has_overlap1"]))
+        self.assertEqual(get_sa_tagged_tokens(self.corpus["no_overlap1"])[4][1].text, "Jeff")
+
+    def test_pickling_keeps_changed_phi(self):
+        sa = pickle.loads(pickle.dumps(self.corpus["staple"], 2))
+
+        self.assertIsInstance(sa, PackedDocument)
+        self.assertSamePHI(sa.get_phi(), self.sas["staple"].get_phi())
+
+        del sa.phi[0]
+        sa = pickle.loads(pickle.dumps(sa, 2))
+
+        self.assertSamePHI(sa.get_phi(), self.sas["staple"].get_phi()[1:])
+
+class RemoveAllPhiRule(Rule):
+    def targets(self):
+        return list(self.sa.get_phi())
+
+    def action(self, target):
+        self.sa.phi.remove(target)
+
+class TestPostProcessor(unittest.TestCase):
+    def test_scores(self):
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          [(RemoveAllPhiRule, [])])
+        self.assertEqual(p.pre_evaluation_score, 1.0)
+
+        p.process()
+        self.assertEqual(p.post_evaluation_score, 0.0)
+
+    def test_corpus_matches_dict(self):
+        scores = []
+
+        for sas in (get_sa_from_dir(FIXTURES_PATH), Corpus(FIXTURES_PATH, cache_size=1)):
+            p = PostProcessor(sas, Corpus(FIXTURES_PATH, cache_size=1))
+            p.process()
+            scores.append((p.pre_evaluation_score, p.post_evaluation_score))
+
+        self.assertEqual(scores[0], scores[1])
+
+    def test_parallel_matches_serial(self):
+        processors = [(RegexRule, ["(o)", "NAME", "O", NameTag]),
+                      (RemoveRegexRule, ["Jeff"])]
+        results = []
+
+        for workers in (1, 2):
+            system_sas = get_sa_from_dir(FIXTURES_PATH)
+            p = PostProcessor(system_sas, get_sa_from_dir(FIXTURES_PATH), processors)
+            p.process(workers=workers)
+
+            results.append((p.post_evaluation_score, p.post_counts,
+                            dict((doc_id, phi_spans(sa)) for (doc_id, sa) in system_sas.iteritems())))
+
+        self.assertEqual(results[0], results[1])
+
+    def test_rule_report(self):
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          [(RegexRule, ["(o)", "NAME", "O", NameTag]),
+                           (RemoveRegexRule, ["Jeff"]),
+                           (RemoveRegexRule, ["no PHI matches this"])])
+        p.process()
+
+        report = p.rule_report()
+
+        self.assertEqual(len(report), 3)
+        self.assertEqual(report[-1][2], p.post_evaluation_score)
+        self.assertAlmostEqual(sum(delta for (rule, args, score, delta) in report),
+                               p.post_evaluation_score - p.pre_evaluation_score)
+        self.assertEqual(report[-1][3], 0.0)
+
+    def test_process_twice(self):
+        system_sas = get_sa_from_dir(FIXTURES_PATH)
+        p = PostProcessor(system_sas, get_sa_from_dir(FIXTURES_PATH), [(RemoveRegexRule, [".*"])])
+
+        p.process()
+        self.assertEqual((p.pre_evaluation_score, p.post_evaluation_score), (1.0, 0.0))
+
+        # the second run starts from the documents the first left
+        p.process()
+        fresh = PostProcessor(system_sas, get_sa_from_dir(FIXTURES_PATH))
+
+        self.assertEqual(p.pre_evaluation_score, 1.0)
+        self.assertEqual(p.post_evaluation_score, fresh.pre_evaluation_score)
+        self.assertEqual(p.post_evaluation_score, 0.0)
+        self.assertEqual(p.rule_report()[0][2:], (0.0, 0.0))
+
+    def test_evaluator_only_built_for_documents(self):
+        class DocumentEvaluator(EvaluatePHI):
+            def __init__(self, system_sas, gold_sas):
+                assert len(system_sas) == len(gold_sas) == 1
+                super(DocumentEvaluator, self).__init__(system_sas, gold_sas)
+
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          [(RemoveRegexRule, ["Jeff"])], evaluator=DocumentEvaluator)
+        p.process()
+
+        self.assertEqual(p.pre_evaluation_score, 1.0)
+        self.assertTrue(p.post_evaluation_score < 1.0)
+
+    def test_only_changed_documents_are_evaluated(self):
+        evaluated = []
+
+        class CountingEvaluator(EvaluatePHI):
+            def __init__(self, system_sas, gold_sas):
+                evaluated.extend(system_sas.keys())
+                super(CountingEvaluator, self).__init__(system_sas, gold_sas)
+
+        cache = {}
+        processors = [(RemoveRegexRule, ["Jeff"])]
+
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          processors, evaluator=CountingEvaluator, count_cache=cache)
+        del evaluated[:]
+        p.process()
+
+        # valid_sa_file1 has no PHI named Jeff, so isn't evaluated again
+        self.assertEqual(sorted(evaluated), ["has_overlap1", "no_overlap1", "staple"])
+
+        # a second run over the same documents is answered from the cache
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          processors, evaluator=CountingEvaluator, count_cache=cache)
+        del evaluated[:]
+        p.process()
+
+        self.assertEqual(evaluated, [])
+
+        # counts worked out in worker processes are kept as well
+        cache = {}
+
+        PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                      processors, count_cache=cache).process(workers=2)
+
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          processors, evaluator=CountingEvaluator, count_cache=cache)
+        del evaluated[:]
+        p.process()
+
+        self.assertEqual(evaluated, [])
+
+class TestSpanEvaluator(unittest.TestCase):
+    def setUp(self):
+        # Oh hey there Jeff. How are you doing today, 2/21/2015?
+        self.gold_sas = {"no_overlap1": StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))}
+        sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+        # 2/21/2015 becomes 2/21, and hey is marked
+        RemoveRegexRule(sa, r"\d+/\d+(/\d+)", 0).apply()
+        sa.phi.append(new_phi(sa, "NAME", "PATIENT", NameTag, 3, 6))
+
+        self.system_sas = {"no_overlap1": sa}
+
+    def test_matches(self):
+        for (evaluator, counts) in [(SpanEvaluator, (1, 2, 1)),
+                                    (OverlapEvaluator, (2, 1, 0)),
+                                    (TokenEvaluator, (3, 1, 1))]:
+            e = evaluator(self.system_sas, self.gold_sas)
+
+            self.assertEqual(evaluation_counts(e), counts)
+            self.assertEqual(e.counts(), counts)
+
+    def test_scores(self):
+        e = SpanEvaluator(self.system_sas, self.gold_sas, match="overlap")
+
+        self.assertEqual(e.micro_precision(), 2 / 3.0)
+        self.assertEqual(e.micro_recall(), 1.0)
+        self.assertAlmostEqual(e.F_beta(e.micro_precision(), e.micro_recall()), 0.8)
+
+    def test_attributes(self):
+        # hey's TYPE isn't one the gold PHI have, but its name is
+        self.assertEqual(SpanEvaluator(self.system_sas, self.gold_sas, "overlap", ["name"]).counts(),
+                         (2, 1, 0))
+        self.assertEqual(SpanEvaluator(self.system_sas, self.gold_sas, "strict", []).counts(),
+                         (1, 2, 1))
+
+    def test_breakdown_and_errors(self):
+        e = SpanEvaluator(self.system_sas, self.gold_sas)
+
+        self.assertEqual(e.breakdown(), {"NAME": (1, 0, 0), "PATIENT": (0, 1, 0),
+                                         "DATE": (0, 1, 1)})
+        self.assertEqual(e.breakdown("name"), {"NAME": (1, 1, 0), "DATE": (0, 1, 1)})
+        self.assertEqual(e.errors("no_overlap1"), ([Span(3, 6, "PATIENT", "NAME"),
+                                                    Span(44, 48, "DATE", "DATE")],
+                                                   [Span(44, 53, "DATE", "DATE")]))
+
+    def test_overlap_scales(self):
+        accesses = [0]
+
+        class CountingList(list):
+            def __getitem__(self, i):
+                accesses[0] += 1
+                return list.__getitem__(self, i)
+
+        class CountingActiveEnds(evaluation._ActiveEnds):
+            def __init__(self, keys):
+                super(CountingActiveEnds, self).__init__(keys)
+                self.tree = CountingList(self.tree)
+
+        def tree_accesses(n):
+            # every gold Span is still unmatched by the time each system
+            # Span, after them all, is aligned
+            gold = [Span(2 * i, 2 * i + 1, "NAME", "NAME") for i in range(n)]
+            system = [Span(2 * (n + i), 2 * (n + i) + 1, "NAME", "NAME") for i in range(n)]
+            accesses[0] = 0
+
+            tp, fp, fn = align_overlap(system, gold, ("TYPE",))
+            self.assertEqual((len(tp), len(fp), len(fn)), (0, n, n))
+
+            return accesses[0]
+
+        original = evaluation._ActiveEnds
+        evaluation._ActiveEnds = CountingActiveEnds
+
+        try:
+            # a few O(log n) tree walks for each Span, rather than O(n)
+            for n in (1000, 8000):
+                self.assertTrue(0 < tree_accesses(n) <= 4 * 2 * n * (n.bit_length() + 1))
+        finally:
+            evaluation._ActiveEnds = original
+
+        # overlapping Spans are still paired up as many as can be
+        gold = [Span(0, 10, "NAME", "NAME"), Span(4, 6, "NAME", "NAME")]
+        system = [Span(5, 20, "NAME", "NAME"), Span(0, 5, "NAME", "NAME")]
+        self.assertEqual([len(spans) for spans in align_overlap(system, gold, ("TYPE",))],
+                         [2, 0, 0])
+
+    def test_postprocessor(self):
+        for evaluator in (SpanEvaluator, TokenEvaluator):
+            results = []
+
+            for workers in (1, 2):
+                p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                                  [(RemoveRegexRule, ["Jeff"])], evaluator=evaluator)
+                p.process(workers=workers)
+
+                results.append((p.pre_evaluation_score, p.post_evaluation_score))
+
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0][0], 1.0)
+            self.assertTrue(results[0][1] < 1.0)
+
+class TestRuleAblation(unittest.TestCase):
+    processors = [(RegexRule, ["(o)", "NAME", "O", NameTag]),
+                  (RemoveRegexRule, ["Jeff"]),
+                  (RemoveRegexRule, [r"\d+/\d+(/\d+)", 0]),
+                  (RemoveRegexRule, ["no PHI matches this"])]
+
+    def postprocessor_score(self, processors):
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          processors)
+        p.process()
+
+        return p.post_evaluation_score
+
+    def test_matches_postprocessor(self):
+        a = RuleAblation(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                         self.processors)
+
+        self.assertEqual(a.baseline_score(), 1.0)
+        self.assertEqual(a.full_score(), self.postprocessor_score(self.processors))
+
+        for (i, (rule, args, score, contribution)) in enumerate(a.leave_one_out()):
+            self.assertEqual(score, self.postprocessor_score(self.processors[:i] +
+                                                             self.processors[i + 1:]))
+            self.assertEqual(contribution, a.full_score() - score)
+
+        for (i, (rule, args, score, contribution)) in enumerate(a.add_one_in()):
+            self.assertEqual(score, self.postprocessor_score([self.processors[i]]))
+
+    def test_interacting_rules(self):
+        # the second rule skips the Jeff the first tagged, and the
+        # RemoveRegexRule removes the hey tagged before it
+        for processors in [[(RegexRule, ["(Jeff)", "NAME", "PATIENT", NameTag]),
+                            (RegexRule, ["(there Jeff)", "NAME", "PATIENT", NameTag])],
+                           [(RegexRule, ["(hey)", "NAME", "PATIENT", NameTag]),
+                            (RemoveRegexRule, ["hey"])]]:
+            a = RuleAblation(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                             processors)
+
+            self.assertEqual(a.full_score(), self.postprocessor_score(processors))
+            self.assertTrue(a.interacting)
+
+            for (i, (rule, args, score, contribution)) in enumerate(a.leave_one_out()):
+                self.assertEqual(score, self.postprocessor_score(processors[:i] +
+                                                                 processors[i + 1:]))
+
+        a = RuleAblation(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                         self.processors)
+        a.compute_deltas()
+
+        self.assertEqual(a.interacting, set())
+
+    def test_system_documents_unchanged(self):
+        system_sas = get_sa_from_dir(FIXTURES_PATH)
+        before = dict((doc_id, phi_spans(sa)) for (doc_id, sa) in system_sas.iteritems())
+
+        RuleAblation(system_sas, get_sa_from_dir(FIXTURES_PATH), self.processors).full_score()
+
+        self.assertEqual(before, dict((doc_id, phi_spans(sa))
+                                      for (doc_id, sa) in system_sas.iteritems()))
+
+    def test_parallel_matches_serial(self):
+        results = []
+
+        for workers in (1, 2):
+            a = RuleAblation(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                             self.processors, workers=workers)
+            results.append((a.leave_one_out(), a.add_one_in(), a.forward_selection()))
+
+        self.assertEqual(results[0], results[1])
+
+    def test_forward_selection(self):
+        # removing gold PHI only ever lowers the score
+        a = RuleAblation(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                         self.processors)
+
+        self.assertEqual(a.forward_selection(), [])
+        self.assertEqual(a.forward_selection(max_rules=0), [])
+
+        # with the rules as the gold standard, putting them back helps
+        gold_sas = get_sa_from_dir(FIXTURES_PATH)
+        PostProcessor(gold_sas, {}, self.processors[:2]).process()
+
+        a = RuleAblation(get_sa_from_dir(FIXTURES_PATH), gold_sas, self.processors)
+        selection = a.forward_selection()
+
+        self.assertEqual(sorted(args for (rule, args, score, gain) in selection),
+                         sorted(args for (rule, args) in self.processors[:2]))
+        self.assertTrue(all(gain > 0 for (rule, args, score, gain) in selection))
+        self.assertEqual(selection[-1][2], 1.0)
+
+class TestSignificance(unittest.TestCase):
+    before = dict((i, (5, 5, 5)) for i in range(100))
+    after = dict((i, (10, 0, 0)) for i in range(100))
+
+    def test_f_beta(self):
+        counts = [(3, 1, 2), (0, 4, 1), (7, 0, 0)]
+
+        self.assertAlmostEqual(f_beta(np.sum(counts, axis=0)), micro_score(counts))
+        self.assertEqual(list(f_beta([(0, 0, 0), (0, 3, 0), (2, 0, 0)])), [0.0, 0.0, 1.0])
+
+    def test_no_change(self):
+        for test in (paired_bootstrap, approximate_randomization):
+            result = test(self.before, self.before, resamples=500, seed=0)
+
+            self.assertEqual(result.difference, 0.0)
+            self.assertEqual(result.p_value, 1.0)
+
+        self.assertEqual(paired_bootstrap(self.before, self.before, 500, seed=0)[5:7], (0.0, 0.0))
+
+    def test_clear_change(self):
+        for test in (paired_bootstrap, approximate_randomization):
+            result = test(self.before, self.after, resamples=500, seed=0)
+
+            self.assertEqual((result.before, result.after), (0.5, 1.0))
+            self.assertEqual(result.p_value, 1 / 501.0)
+
+        result = paired_bootstrap(self.before, self.after, resamples=500, seed=0)
+        self.assertEqual((result.low, result.high), (0.5, 0.5))
+
+    def test_seed(self):
+        after = dict((i, (5 + i % 3, 5 - i % 3, 5)) for i in range(100))
+
+        for test in (paired_bootstrap, approximate_randomization):
+            self.assertEqual(test(self.before, after, seed=1), test(self.before, after, seed=1))
+
+    def test_postprocessor(self):
+        p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                          [(RemoveRegexRule, ["Jeff"])])
+        p.process()
+
+        result = p.significance(resamples=200, seed=0)
+
+        self.assertAlmostEqual(result.before, p.pre_evaluation_score)
+        self.assertAlmostEqual(result.after, p.post_evaluation_score)
+        self.assertTrue(0 < result.p_value <= 1)
+        self.assertTrue(result.low <= result.difference <= result.high)
+
+class LookupRule(Rule):
+    """Looks up the PHI at the start of each PHI, lazily."""
+    def targets(self):
+        return (phi.get_start() for phi in list(self.sa.get_phi()))
+
+    def action(self, target):
+        phi_at_offset(self.sa, target)
+
+class TestProfiler(unittest.TestCase):
+    processors = [(RegexRule, ["(o)", "NAME", "O", NameTag]),
+                  (RemoveRegexRule, ["Jeff"]),
+                  (LookupRule, [])]
+
+    def test_profile_apply(self):
+        sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "staple.xml"))
+        phi = len(sa.get_phi())
+
+        rule = LookupRule(sa)
+        profile = profile_apply(rule, 0, sa.id)
+
+        self.assertEqual((profile.rule, profile.name, profile.doc_id),
+                         (0, "LookupRule", sa.id))
+        self.assertEqual(profile.targets, phi)
+        self.assertEqual(profile.lookups, phi)
+        self.assertEqual((profile.added, profile.removed), (0, 0))
+        self.assertTrue(profile.apply_time >= profile.action_time)
+
+        # the rule goes back to how it was
+        self.assertEqual(vars(rule), {"sa": sa})
+
+        profile = profile_apply(RemoveAllPhiRule(sa))
+        self.assertEqual((profile.targets, profile.added, profile.removed), (phi, 0, phi))
+
+    def test_report(self):
+        system_sas = get_sa_from_dir(FIXTURES_PATH)
+        jeffs = sum(1 for sa in system_sas.values() for phi in sa.get_phi()
+                    if phi.text.startswith("Jeff"))
+        matches = sum(sa.text.count("o") for sa in system_sas.values())
+
+        profiler = Profiler()
+        profiled = []
+        profiler.subscribe(profiled.append)
+
+        p = PostProcessor(system_sas, get_sa_from_dir(FIXTURES_PATH),
+                          self.processors, profiler=profiler)
+        p.process()
+
+        self.assertEqual(profiled, profiler.profiles)
+        self.assertEqual(len(profiled), len(system_sas) * len(self.processors))
+
+        report = profiler.report()
+
+        self.assertEqual([(row["rule"], row["args"]) for row in report], self.processors)
+        self.assertEqual([row["documents"] for row in report], [len(system_sas)] * 3)
+        self.assertEqual(report[0]["targets"], matches)
+        self.assertEqual(report[1]["removed"], jeffs)
+        self.assertEqual(report[2]["lookups"], report[2]["targets"])
+        self.assertEqual([profile.rule for profile in profiler.document_report("staple")],
+                         [0, 1, 2])
+
+    def test_parallel_matches_serial(self):
+        reports = []
+
+        for workers in (1, 2):
+            profiler = Profiler()
+            p = PostProcessor(get_sa_from_dir(FIXTURES_PATH), get_sa_from_dir(FIXTURES_PATH),
+                              self.processors, profiler=profiler)
+            p.process(workers=workers)
+
+            reports.append(sorted((profile.rule, profile.doc_id, profile.targets,
+                                   profile.added, profile.removed, profile.lookups)
+                                  for profile in profiler.profiles))
+
+        self.assertEqual(reports[0], reports[1])
+
 class TestHasOverlappingPhi(unittest.TestCase):
     def setUp(self):
         self.empty_sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "valid_sa_file1.xml"))
@@ -77,6 +841,29 @@ class TestPhiWithinRange(unittest.TestCase):
 
         self.assertEqual(all_phi_maybe, self.has_overlap_sa.get_phi())
 
+class TestPhiIndex(unittest.TestCase):
+    def setUp(self):
+        self.has_overlap_sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "has_overlap1.xml"))
+
+    def test_matches_linear_scan(self):
+        index = phi_index(self.has_overlap_sa)
+
+        for offset in range(len(self.has_overlap_sa.text) + 1):
+            self.assertEqual(index.at_offset(offset),
+                             [phi for phi in self.has_overlap_sa.get_phi()
+                              if phi.get_start() <= offset <= phi.get_end()])
+
+    def test_index_follows_list_changes(self):
+        phi_index(self.has_overlap_sa)
+        self.assertIsInstance(self.has_overlap_sa.phi, PHIList)
+
+        removed = phi_at_offset(self.has_overlap_sa, 14)[0]
+        self.has_overlap_sa.phi.remove(removed)
+        self.assertEqual(phi_at_offset(self.has_overlap_sa, 14), [])
+
+        self.has_overlap_sa.phi.append(removed)
+        self.assertEqual(phi_at_offset(self.has_overlap_sa, 14), [removed])
+
 
 class TestNTokens(unittest.TestCase):
     def setUp(self):
@@ -91,6 +878,121 @@ class TestNTokens(unittest.TestCase):
         for tokens in tokenset:
             assert(len(tokens) == n)
 
+    def test_iter_n_tokens(self):
+        self.assertEqual(list(iter_n_tokens(self.document.token_sequence, 3)),
+                         n_tokens(self.document.token_sequence, 3))
+
+class TestTokenSequence(unittest.TestCase):
+    def setUp(self):
+        self.document = Document(os.path.join(FIXTURES_PATH, "staple.xml"))
+
+    def test_index_of(self):
+        seq = self.document.token_sequence
+
+        for token in seq:
+            self.assertEqual(seq.index_of(token), seq.tokens.index(token))
+
+        self.assertRaises(ValueError, seq.index_of, Token("", "", "", 0, -1, -1))
+
+    def test_neighbors_are_not_copied(self):
+        seq = self.document.token_sequence
+
+        self.assertEqual(seq.tokens_before(seq[5], 2).tokens, seq.tokens[3:5])
+        self.assertIs(seq.tokens_after(seq[5], 2)[0], seq[6])
+
+    def test_tag_token_indices(self):
+        seq = self.document.token_sequence
+
+        indices = [token.index for (tag, tag_seq) in self.document.phi_with_token_sequences()
+                   for token in tag_seq]
+
+        # tokens only part of a document token have no index
+        self.assertTrue(any(index is not None for index in indices))
+
+        for (tag, tag_seq) in self.document.phi_with_token_sequences():
+            for token in tag_seq:
+                if token.index is not None:
+                    self.assertEqual(seq[token.index], token)
+
+class TestCompactTokenSequence(unittest.TestCase):
+    def setUp(self):
+        self.text = Document(os.path.join(FIXTURES_PATH, "staple.xml")).text
+
+    def assertSameTokens(self, tokens, other_tokens):
+        self.assertEqual([(t.token, t.pre_ws, t.post_ws, t.index, t.start, t.end) for t in tokens],
+                         [(t.token, t.pre_ws, t.post_ws, t.index, t.start, t.end) for t in other_tokens])
+
+    def test_same_tokens_as_token_sequence(self):
+        for start in (0, 10):
+            seq = TokenSequence(self.text, start=start)
+            compact = CompactTokenSequence(self.text, start=start)
+
+            self.assertEqual(len(compact), len(seq))
+            self.assertSameTokens(compact, seq)
+            self.assertSameTokens([compact[-1]], [seq[-1]])
+
+    def test_tokenizer(self):
+        # the same positional arguments as a TokenSequence
+        self.assertSameTokens(CompactTokenSequence(self.text, None, 10),
+                              TokenSequence(self.text, None, 10))
+        self.assertSameTokens(CompactTokenSequence(self.text, TokenSequence.tokenizer),
+                              TokenSequence(self.text))
+
+        self.assertRaises(ValueError, CompactTokenSequence, self.text,
+                          lambda text, start=0: TokenSequence.tokenizer(text, start))
+        self.assertRaises(ValueError, CompactTokenSequence, list(TokenSequence(self.text)))
+
+    def test_neighbors(self):
+        seq = TokenSequence(self.text)
+        compact = CompactTokenSequence(self.text)
+        token = seq[5]
+
+        self.assertSameTokens(compact.tokens_before(token, 3), seq.tokens_before(token, 3))
+        self.assertSameTokens(compact.tokens_after(token, 3), seq.tokens_after(token, 3))
+
+    def test_document_token_sequence_class(self):
+        class CompactDocument(Document):
+            token_sequence_class = CompactTokenSequence
+
+        document = CompactDocument(os.path.join(FIXTURES_PATH, "staple.xml"))
+
+        self.assertIsInstance(document.token_sequence, CompactTokenSequence)
+
+class TestBulkTokenize(unittest.TestCase):
+    def setUp(self):
+        self.texts = [Document(os.path.join(FIXTURES_PATH, name)).text
+                      for name in ("staple.xml", "no_overlap1.xml")] + ["", "  "]
+
+    def test_same_tokens_as_token_sequence(self):
+        starts, ends, boundaries = TokenSequence.bulk_tokenize(self.texts)
+
+        self.assertEqual(len(boundaries), len(self.texts) + 1)
+
+        for (i, text) in enumerate(self.texts):
+            a, b = boundaries[i], boundaries[i + 1]
+
+            self.assertEqual(zip(starts[a:b], ends[a:b]),
+                             [(t.start, t.end) for t in TokenSequence(text)])
+
+    def test_interning(self):
+        token_ids = {}
+        starts, ends, boundaries, ids = TokenSequence.bulk_tokenize(self.texts, token_ids)
+
+        tokens = dict((i, token) for (token, i) in token_ids.items())
+
+        self.assertEqual(len(ids), len(starts))
+
+        for (i, text) in enumerate(self.texts):
+            a, b = boundaries[i], boundaries[i + 1]
+
+            self.assertEqual([tokens[j] for j in ids[a:b]],
+                             [t.token for t in TokenSequence(text)])
+
+        # tokens seen before keep their ids
+        ids_again = TokenSequence.bulk_tokenize(self.texts, token_ids)[3]
+
+        self.assertEqual(list(ids_again), list(ids))
+
 class TestGetSaTaggedTokens(unittest.TestCase):
     def setUp(self):
         self.has_overlap_sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "has_overlap1.xml"))
@@ -117,6 +1019,40 @@ class TestGetSaTaggedTokens(unittest.TestCase):
             self.assertIsInstance(token, Token)
             assert(associated_phi is None or isinstance(associated_phi, Tag))
 
+    def test_tags_tokens_within_phi(self):
+        tagged = [(token.token, phi.text if phi else None)
+                  for (token, phi) in get_sa_tagged_tokens(self.no_overlap_sa)]
+
+        self.assertEqual([t for t in tagged if t[1]],
+                         [("Jeff", "Jeff"), ("2", "2/21/2015"),
+                          ("21", "2/21/2015"), ("2015", "2/21/2015")])
+
+    def test_uses_phi_in_memory(self):
+        del self.no_overlap_sa.phi[0]
+
+        tagged = get_sa_tagged_tokens(self.no_overlap_sa)
+
+        self.assertEqual([phi for (token, phi) in tagged if token.token == "Jeff"], [None])
+
+    def test_token_arrays(self):
+        token_ids = {}
+        label_ids = {"O": 0}
+
+        tokens, labels, boundaries = get_sa_tagged_token_arrays(
+            [self.no_overlap_sa, self.no_overlap_sa], token_ids, label_ids)
+
+        self.assertEqual(len(tokens), len(labels))
+        self.assertEqual(list(boundaries), [0, 13, 26])
+        self.assertEqual(list(tokens[:13]), list(tokens[13:]))
+        self.assertEqual(token_ids["Jeff"], tokens[4])
+
+        id_labels = dict((i, label) for (label, i) in label_ids.items())
+        self.assertEqual([id_labels[i] for i in labels[:13] if i],
+                         ["B-NAME", "B-DATE", "I-DATE", "I-DATE"])
+
+    def test_token_arrays_raise_for_overlapping_phi(self):
+        self.assertRaises(Exception, get_sa_tagged_token_arrays, [self.has_overlap_sa])
+
 class TestSaFilterByPhiAttrs(unittest.TestCase):
     def setUp(self):
         self.sa1 = StandoffAnnotation(os.path.join(FIXTURES_PATH, "has_overlap1.xml"))
@@ -131,5 +1067,443 @@ class TestSaFilterByPhiAttrs(unittest.TestCase):
         # There should only be one PHI with the id P1.
         assert(len(sa_filter_by_phi_attrs(self.sa1, {"id": "P1"})) == 1)
 
+def phi_spans(sa):
+    return [(phi.name, phi.get_start(), phi.get_end(), phi.TYPE) for phi in sa.get_phi()]
+
+class TestPHIBatch(unittest.TestCase):
+    def setUp(self):
+        self.sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+    def test_changes_wait_for_commit(self):
+        name, date = self.sa.get_phi()
+
+        with PHIBatch(self.sa) as batch:
+            batch.remove(name)
+            batch.trim(date, end=48)
+            self.assertEqual(len(self.sa.get_phi()), 2)
+
+            # nested batches commit with the outermost
+            with batch:
+                batch.add(new_phi(self.sa, "NAME", "NAME", NameTag, 0, 2))
+
+            self.assertEqual(len(self.sa.get_phi()), 2)
+
+        self.assertEqual(phi_spans(self.sa), [("DATE", 44, 48, "DATE"),
+                                              ("NAME", 0, 2, "NAME")])
+
+    def test_replace_contained(self):
+        with PHIBatch(self.sa) as batch:
+            batch.add(new_phi(self.sa, "DATE", "DAY", DateTag, 44, 46))
+            batch.add(new_phi(self.sa, "DATE", "DATE", DateTag, 37, 53),
+                      replace_contained=True)
+            batch.add(new_phi(self.sa, "NAME", "NAME", NameTag, 13, 14))
+
+        self.assertEqual(phi_spans(self.sa), [("NAME", 13, 17, "NAME"),
+                                              ("DATE", 37, 53, "DATE"),
+                                              ("NAME", 13, 14, "NAME")])
+
+def name_trigram(target, rule):
+    first, middle, last = [phi_within_range(rule.sa, token.start, token.end)
+                           for token in target]
+
+    return bool(first and last and not middle and
+                first[0].name == last[0].name == rule.name)
+
+class TestMergeRule(unittest.TestCase):
+    def document(self):
+        # Oh hey there Jeff. How are you doing today, 2/21/2015?
+        sa = Document(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+        for (start, end) in [(0, 2), (7, 12), (19, 22), (27, 30)]:
+            sa.phi.append(new_phi(sa, "NAME", "PATIENT", NameTag, start, end))
+
+        return sa
+
+    def test_merge(self):
+        sa = self.document()
+        MergeRule(sa, 3, "NAME", "PATIENT", NameTag, name_trigram).apply()
+
+        self.assertTrue(("NAME", 0, 12, "PATIENT") in phi_spans(sa))
+        self.assertTrue(("NAME", 19, 30, "PATIENT") in phi_spans(sa))
+
+    def test_anchored_windows(self):
+        sa = self.document()
+        windows = list(anchored_n_tokens(sa, 3, "NAME"))
+
+        self.assertTrue(len(windows) < len(n_tokens(sa.token_sequence, 3)))
+        self.assertTrue(all(phi_within_range(sa, window[0].start, window[0].end) or
+                            phi_within_range(sa, window[-1].start, window[-1].end)
+                            for window in windows))
+
+    def test_anchored_matches_exhaustive(self):
+        results = []
+
+        for (token_sequence_class, anchored) in [(TokenSequence, False),
+                                                 (TokenSequence, True),
+                                                 (CompactTokenSequence, True)]:
+            sa = self.document()
+            sa.token_sequence_class = token_sequence_class
+
+            MergeRule(sa, 3, "NAME", "PATIENT", NameTag, name_trigram, anchored).apply()
+            results.append(sorted(phi_spans(sa)))
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+    def test_token_labels(self):
+        sa = self.document()
+        labels, values = sa.token_labels()
+
+        for token in sa.token_sequence:
+            phi = phi_within_range(sa, token.start, token.end)
+            self.assertEqual(values[labels[token.index]] if labels[token.index] >= 0 else None,
+                             phi[0].name if phi else None)
+
+    def test_token_labels_follow_phi(self):
+        sa = self.document()
+        labels, values = sa.token_labels("TYPE")
+        token = sa.token_sequence[2]
+
+        self.assertEqual(labels[token.index], -1)
+
+        sa.phi.append(new_phi(sa, "DATE", "DAY", DateTag, token.start, token.end))
+        labels, values = sa.token_labels("TYPE")
+
+        self.assertEqual(values[labels[token.index]], "DAY")
+
+    def test_pattern_matches_callable(self):
+        results = []
+
+        for predicate in [name_trigram, _trigram_name_predicate,
+                          PHIPattern(["NAME", UNTAGGED, "NAME"])]:
+            sa = self.document()
+
+            MergeRule(sa, 3, "NAME", "PATIENT", NameTag, predicate).apply()
+            results.append(sorted(phi_spans(sa)))
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+    def test_pattern_call(self):
+        sa = self.document()
+        rule = MergeRule(sa, 3, "NAME", "PATIENT", NameTag, name_trigram)
+        windows = n_tokens(sa.token_sequence, 3)
+
+        for pattern in [["NAME", UNTAGGED, "NAME"], ["NAME", ANY, ANY], ["DATE", ANY, ANY]]:
+            predicate = PHIPattern(pattern)
+            self.assertEqual([window for window in windows if predicate(window, rule)],
+                             list(predicate.windows(sa)))
+
+class TestRegexRule(unittest.TestCase):
+    def setUp(self):
+        self.sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+    def test_marks_every_occurrence(self):
+        RegexRule(self.sa, "(o)", "NAME", "O", NameTag).apply()
+
+        self.assertEqual([phi.get_start() for phi in self.sa.get_phi() if phi.TYPE == "O"],
+                         [i for (i, c) in enumerate(self.sa.text) if c == "o"])
+
+    def test_match_group(self):
+        RegexRule(self.sa, r"(\d+)/(\d+/\d+)", "DATE", "DAY", DateTag, 0, 1).apply()
+
+        self.assertEqual(phi_spans(self.sa), [("NAME", 13, 17, "NAME"),
+                                              ("DATE", 44, 53, "DATE"),
+                                              ("DATE", 46, 53, "DAY")])
+
+    def test_replaces_contained_phi(self):
+        RegexRule(self.sa, r"(today, \S+)", "DATE", "DATE", DateTag).apply()
+
+        self.assertEqual(phi_spans(self.sa), [("NAME", 13, 17, "NAME"),
+                                              ("DATE", 37, 54, "DATE")])
+
+class TestRemoveRegexRule(unittest.TestCase):
+    def setUp(self):
+        self.sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+    def test_remove(self):
+        RemoveRegexRule(self.sa, "Jeff").apply()
+
+        self.assertEqual(phi_spans(self.sa), [("DATE", 44, 53, "DATE")])
+
+    def test_trim(self):
+        RemoveRegexRule(self.sa, r"\d+/\d+(/\d+)", 0).apply()
+
+        self.assertEqual(phi_spans(self.sa), [("NAME", 13, 17, "NAME"),
+                                              ("DATE", 44, 48, "DATE")])
+        self.assertEqual(phi_at_offset(self.sa, 50), [])
+
+class TestRegexRuleSet(unittest.TestCase):
+    rules = [("(Jeff)", "NAME", "PATIENT", NameTag),
+             (r"(\d+/\d+/\d+)", "DATE", "DATE", DateTag),
+             ("(o)", "NAME", "O", NameTag),
+             ("(y)", "NAME", "Y", NameTag, 1)]
+
+    def setUp(self):
+        self.sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+        self.expected = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+        for rule in self.rules:
+            RegexRule(*([self.expected] + list(rule))).apply()
+
+    def test_same_as_each_rule_in_turn(self):
+        RegexRuleSet(self.sa, self.rules).apply()
+
+        self.assertEqual(phi_spans(self.sa), phi_spans(self.expected))
+
+    def test_combined(self):
+        RegexRuleSet(self.sa, self.rules, combine=True).apply()
+
+        self.assertEqual(phi_spans(self.sa), phi_spans(self.expected))
+
+class TestGazetteer(unittest.TestCase):
+    def setUp(self):
+        # Oh hey there Jeff. How are you doing today, 2/21/2015?
+        self.sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+    def test_find_every_occurrence(self):
+        gazetteer = Gazetteer(["he", "she", "his", "hers"], "NAME")
+
+        self.assertEqual(sorted(gazetteer.find("ushers")),
+                         [(1, 4, "NAME"), (2, 4, "NAME"), (2, 6, "NAME")])
+
+    def test_matches_brute_force(self):
+        terms = ["a", "ab", "bab", "bc", "bca", "c", "caa", "abcab"]
+        text = "abccabcaabcabbcababcaa"
+        gazetteer = Gazetteer(terms, "NAME")
+
+        self.assertEqual(sorted(gazetteer.find(text)),
+                         sorted((i, i + len(term), "NAME") for term in terms
+                                for i in range(len(text)) if text.startswith(term, i)))
+
+    def test_missing_type(self):
+        self.assertRaises(ValueError, Gazetteer, ["Jeff"])
+        self.assertRaises(ValueError, Gazetteer, {"Jeff": "PATIENT", "today": None})
+
+    def test_pickle(self):
+        gazetteer = Gazetteer({"jeff": "PATIENT", "today": "DATE"}, ignore_case=True)
+        copied = pickle.loads(pickle.dumps(gazetteer, pickle.HIGHEST_PROTOCOL))
+
+        self.assertEqual(list(copied.find(self.sa.text)), list(gazetteer.find(self.sa.text)))
+        self.assertEqual(list(copied.find(self.sa.text)), [(13, 17, "PATIENT"), (37, 42, "DATE")])
+
+    def test_rule(self):
+        gazetteer = Gazetteer({"Jeff": "PATIENT", "How are": "CITY", "How": "STATE",
+                               "o": "ZIP"})
+        GazetteerRule(self.sa, gazetteer).apply()
+
+        self.assertEqual(sorted(phi_spans(self.sa), key=lambda span: span[1]),
+                         [("NAME", 13, 17, "PATIENT"),
+                          ("LOCATION", 19, 26, "CITY"),
+                          ("DATE", 44, 53, "DATE")])
+        self.assertTrue(isinstance(phi_at_offset(self.sa, 20)[0], LocationTag))
+
+    def test_every_occurrence(self):
+        # Oh hey there Jeff. How are you doing today, 2/21/2015?
+        gazetteer = Gazetteer(["there", "there Jeff", "Jeff", "Jeff. How"], "PATIENT")
+        GazetteerRule(self.sa, gazetteer, longest=False).apply()
+
+        # including those within others, whichever order they're found
+        # in, while the NAME PHI Jeff is replaced
+        self.assertEqual(sorted(phi_spans(self.sa), key=lambda span: span[1:3]),
+                         [("NAME", 7, 12, "PATIENT"),
+                          ("NAME", 7, 17, "PATIENT"),
+                          ("NAME", 13, 17, "PATIENT"),
+                          ("NAME", 13, 22, "PATIENT"),
+                          ("DATE", 44, 53, "DATE")])
+
+    def test_token_boundaries(self):
+        gazetteer = Gazetteer(["o"], "ZIP")
+        GazetteerRule(self.sa, gazetteer, token_boundaries=False).apply()
+
+        self.assertEqual([phi.get_start() for phi in self.sa.get_phi() if phi.TYPE == "ZIP"],
+                         [i for (i, c) in enumerate(self.sa.text) if c == "o"])
+
+    def test_parallel_matches_serial(self):
+        processors = [(GazetteerRule, [Gazetteer(["jeff", "how"], "DOCTOR", True)])]
+        results = []
+
+        for workers in (1, 2):
+            system_sas = get_sa_from_dir(FIXTURES_PATH)
+            PostProcessor(system_sas, get_sa_from_dir(FIXTURES_PATH), processors).process(workers)
+
+            results.append(dict((doc_id, phi_spans(sa)) for (doc_id, sa) in system_sas.iteritems()))
+
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(("NAME", 19, 22, "DOCTOR") in results[0]["no_overlap1"])
+
+class TestStandoffToInline(unittest.TestCase):
+    def setUp(self):
+        self.no_overlap_sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+    def test_conversion(self):
+        self.assertEqual(etree.tostring(standoff_to_inline(self.no_overlap_sa)),
+                         "<ROOT>Oh hey there <NAME>Jeff</NAME>. How are you doing "
+                         "today, <DATE>2/21/2015</DATE>?</ROOT>")
+
+class TestStandoffToLbj(unittest.TestCase):
+    def setUp(self):
+        self.no_overlap_sa = StandoffAnnotation(os.path.join(FIXTURES_PATH, "no_overlap1.xml"))
+
+    def test_conversion(self):
+        self.assertEqual(standoff_to_lbj(self.no_overlap_sa),
+                         "Oh hey there [PER Jeff  ]. How are you doing "
+                         "today, [MISC 2/21/2015  ]?")
+
+def standoff_contents(xml):
+    root = etree.fromstring(xml)
+    return (root.find("TEXT").text, [dict(tag.attrib) for tag in root.find("TAGS")])
+
+class TestStreamingConverters(unittest.TestCase):
+    lbj = ("Oh hey there [PER Jeff  ]. Jeff said [LOC\nNew York  ] was\n"
+           "[ORG Acme \n] and [PER  x [MISC 2/21/2015  ]?")
+
+    def test_lbj_segments_match_whole_input(self):
+        whole = list(lbj_segments([self.lbj]))
+
+        for chunk_size in (1, 2, 3, 7):
+            chunks = [self.lbj[i:i + chunk_size] for i in range(0, len(self.lbj), chunk_size)]
+            segments = list(lbj_segments(chunks))
+
+            self.assertEqual([tag for (text, tag) in segments if tag],
+                             [tag for (text, tag) in whole if tag])
+            self.assertEqual("".join(text + (tag[1] + " " if tag else "")
+                                     for (text, tag) in segments),
+                             "".join(text + (tag[1] + " " if tag else "")
+                                     for (text, tag) in whole))
+
+    def test_lbj_stray_bracket(self):
+        # a long line with a bracket which never closes, then a tag
+        chunk = "word " * 1000
+        chunks = ["[ "] + [chunk] * 200 + ["[PER Jeff  ]"]
+        read = []
+
+        def reading():
+            for c in chunks:
+                read.append(len(c))
+                yield c
+
+        segments = []
+        written = 0
+
+        for (text, tag) in lbj_segments(reading(), max_tag_text=100):
+            written += len(text)
+            segments.append((text, tag))
+
+            # only about a tag's length is held back
+            self.assertTrue(sum(read) - written <= len(chunk) + 120)
+
+        whole = list(lbj_segments(["".join(chunks)], max_tag_text=100))
+
+        self.assertTrue("".join(text for (text, tag) in segments) ==
+                        "".join(text for (text, tag) in whole))
+        self.assertEqual([tag for (text, tag) in segments if tag], [("PER", "Jeff")])
+        self.assertEqual([tag for (text, tag) in whole if tag], [("PER", "Jeff")])
+
+        # a tag with longer text isn't matched
+        self.assertEqual([tag for (text, tag) in lbj_segments(["[PER " + "x" * 101 + "  ]"],
+                                                              max_tag_text=100) if tag], [])
+
+    def test_lbj_offsets_come_from_matches(self):
+        text, tags = standoff_contents(lbj_to_standoff_annotation(self.lbj))
+
+        # "Jeff" appears in the text again before the second tag
+        self.assertEqual([text[int(tag["start"]):int(tag["end"])] for tag in tags],
+                         ["Jeff", "New York", "Acme", " x [MISC 2/21/2015"])
+
+    def test_stream_lbj_matches_lbj_to_standoff_annotation(self):
+        output = BytesIO()
+        tags = stream_lbj_to_standoff(BytesIO(self.lbj), output, chunk_size=4)
+
+        self.assertEqual(tags, 4)
+        self.assertEqual(standoff_contents(output.getvalue()),
+                         standoff_contents(lbj_to_standoff_annotation(self.lbj)))
+
+    def test_stream_inline_matches_inline_to_standoff(self):
+        inline = ("<ROOT>Oh hey there <NAME>Jeff</NAME>. &amp; <CITY>New\nYork</CITY>"
+                  "<DATE>2/21/2015</DATE>?</ROOT>")
+        output = BytesIO()
+
+        self.assertEqual(stream_inline_to_standoff(BytesIO(inline), output), 3)
+        self.assertEqual(standoff_contents(output.getvalue()),
+                         standoff_contents(inline_to_standoff(inline)))
+
+    def test_streamed_output_is_a_standoff_annotation(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            filename = os.path.join(directory, "streamed.xml")
+            stream_lbj_to_standoff(BytesIO(self.lbj), filename)
+
+            sa = StandoffAnnotation(filename)
+
+            self.assertEqual([phi.text for phi in sa.get_phi()],
+                             ["Jeff", "New York", "Acme", " x [MISC 2/21/2015"])
+        finally:
+            shutil.rmtree(directory)
+
+class TestMatJsonToStandoff(unittest.TestCase):
+    mat_json = {"version": 2,
+                "signal": "Oh hey there Jeff. How are you doing today, 2/21/2015?",
+                "asets": [{"type": "NAME", "annots": [[13, 17]]},
+                          {"type": "lex", "annots": [[0, 2], [3, 6]]},
+                          {"type": "DATE", "annots": [[44, 53]]}]}
+
+    def test_conversion(self):
+        mat_json = copy.deepcopy(self.mat_json)
+        text, tags = standoff_contents(mat_json_to_standoff(mat_json))
+
+        self.assertEqual(text, self.mat_json["signal"])
+        self.assertEqual([(tag["TYPE"], tag["text"]) for tag in tags],
+                         [("NAME", "Jeff"), ("DATE", "2/21/2015")])
+
+        # internal types are left out without altering the input
+        self.assertEqual(mat_json, self.mat_json)
+
+    def test_compact_output(self):
+        compact = mat_json_to_standoff(self.mat_json, pretty_print=False)
+
+        self.assertFalse("\n" in compact)
+        self.assertEqual(standoff_contents(compact),
+                         standoff_contents(mat_json_to_standoff(self.mat_json)))
+
+    def test_batch(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            json_dir = os.path.join(directory, "json")
+            os.makedirs(json_dir)
+            jsonl = os.path.join(directory, "documents.jsonl")
+
+            with open(jsonl, "w") as outfile:
+                for i in range(3):
+                    with open(os.path.join(json_dir, "doc%d.json" % i), "w") as json_file:
+                        json.dump(self.mat_json, json_file)
+
+                    outfile.write(json.dumps(self.mat_json) + "\n")
+
+            expected = mat_json_to_standoff(self.mat_json, pretty_print=False)
+
+            for (source, workers) in [(json_dir, 1), (json_dir, 2), (jsonl, 2)]:
+                output_dir = os.path.join(directory, "out%d" % workers)
+                written = convert_mat_batch(source, output_dir, pretty_print=False,
+                                            workers=workers)
+
+                self.assertEqual(len(written), 3)
+
+                for filename in written:
+                    with open(filename) as infile:
+                        self.assertEqual(infile.read(), expected)
+
+                shutil.rmtree(output_dir)
+
+            with open(jsonl) as infile:
+                written = convert_mat_batch(infile, directory, workers=1)
+
+            self.assertEqual([os.path.basename(filename) for filename in written],
+                             ["00000000.xml", "00000001.xml", "00000002.xml"])
+        finally:
+            shutil.rmtree(directory)
+
 if __name__ == "__main__":
     unittest.main()